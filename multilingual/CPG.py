@@ -10,6 +10,9 @@ from config import LANG_NAMES
 
 
 class CPG(nn.Module):
+    # the generated params of every group are cut into chunks of this many params, see `chunk_W`
+    CHUNK_SIZE = 4096
+
     def __init__(self, shapes: List[List[Tuple[int]]], args: Dict[str, str]):
         """
         Args:
@@ -29,11 +32,11 @@ class CPG(nn.Module):
 
         self.shapes = shapes
         self.group_num, self.group_param_num, self.group_param_sizes = self.get_param_meta(shapes)
+        self.init_chunks()
 
         # init every layer of CPG for different groups
         self.L = nn.Linear(num_lang, self.lang_embed_size, bias=False)
         self.Ps = nn.ModuleList([nn.Linear(self.lang_embed_size, self.low_rank, bias=False) for _ in range(self.group_num)])
-        self.Ws = nn.ModuleList([nn.Linear(self.low_rank, self.group_param_sizes[i], bias=False) for i in range(self.group_num)])
 
         # init language embeddings
         self.word_embeddings = nn.ModuleList([nn.Embedding(self.vocab_size, self.word_embed_size)
@@ -42,6 +45,64 @@ class CPG(nn.Module):
         # initialize the parameters using uniform distribution
         for param in self.parameters():
             nn.init.uniform_(param.data, a=-0.1, b=0.1)
+        # the W_j of all the groups in one parameter, dim = (num_chunks, low_rank, CHUNK_SIZE)
+        self.W = nn.Parameter(self.chunk_W([torch.empty(size, self.low_rank).uniform_(-0.1, 0.1)
+                                            for size in self.group_param_sizes]))
+
+        # the generated params of the language combinations seen without grad, see `get_params`
+        self.param_cache = {}
+        self.param_cache_version = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the cached params are derived from the parameters, so they are not saved with the model
+        state['param_cache'] = {}
+        state['param_cache_version'] = None
+        return state
+
+    def __setstate__(self, state):
+        super(CPG, self).__setstate__(state)
+        # models saved before the cache existed
+        self.__dict__.setdefault('param_cache', {})
+        self.__dict__.setdefault('param_cache_version', None)
+        # models saved before the W_j were chunked into one parameter
+        if 'Ws' in self._modules:
+            self.init_chunks()
+            Ws = self._modules.pop('Ws')
+            self.W = nn.Parameter(self.chunk_W([W_j.weight.data for W_j in Ws]))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints written before the W_j were chunked into one parameter
+        keys = [prefix + 'Ws.%d.weight' % j for j in range(self.group_num)]
+        if keys[0] in state_dict:
+            state_dict[prefix + 'W'] = self.chunk_W([state_dict.pop(key) for key in keys])
+        super(CPG, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def init_chunks(self):
+        # the first chunk of every group, and the number of chunks at the end
+        self.group_chunk_offsets = [0]
+        for size in self.group_param_sizes:
+            self.group_chunk_offsets.append(self.group_chunk_offsets[-1] - (-size // CPG.CHUNK_SIZE))
+        # the group of every chunk
+        self.chunk_groups = torch.tensor([j for j in range(self.group_num)
+                                          for _ in range(self.group_chunk_offsets[j], self.group_chunk_offsets[j + 1])],
+                                         device=device)
+
+    def chunk_W(self, Ws: List[Tensor]) -> Tensor:
+        """
+        Lays out the W_j, of size (group_param_size_j, low_rank), so that the params of all the groups
+        are generated by one bmm. Every W_j is cut into chunks of CHUNK_SIZE rows, the last one padded
+        with zeros, and every chunk is stored transposed, so the params of a chunk are a weighted sum
+        of `low_rank` contiguous rows
+
+        Return:
+            W: the chunks of all the groups, dim = (num_chunks, low_rank, CHUNK_SIZE)
+        """
+        W = Ws[0].new_zeros(self.group_chunk_offsets[-1] * CPG.CHUNK_SIZE, self.low_rank)
+        for j, W_j in enumerate(Ws):
+            offset = self.group_chunk_offsets[j] * CPG.CHUNK_SIZE
+            W[offset:offset + W_j.shape[0]] = W_j
+        return W.view(-1, CPG.CHUNK_SIZE, self.low_rank).transpose(1, 2).contiguous()
 
     @staticmethod
     def get_param_meta(shapes: List[List[Tuple[int]]]):
@@ -70,31 +131,68 @@ class CPG(nn.Module):
         Gets the grouped parameters required by the model
 
         Args:
-            langs: a list of language indices representing the language using utils.LANG_INDICES
+            langs: a list of language indices representing the language using utils.LANG_INDICES,
+                   the groups with a None language are not generated
 
         Return:
-            grouped_params: a list of groups of parameters in tensor form
+            grouped_params: a list of groups of parameters in tensor form, None for the skipped groups
         """
         assert (len(langs) == self.group_num)
 
-        # generate parameters for this language by group
-        params = []
-        for j in range(self.group_num):
-            ell_j = self.L(self.lang_encode[langs[j]])
-            P_j = self.Ps[j]
-            W_j = self.Ws[j]
-            W_j_P_j_ell_j = W_j(P_j(ell_j))
-            params.append(W_j_P_j_ell_j)
-
-        # separate the params inside the group and reshape to desired shape
-        for j in range(self.group_num):
-            vecs_in_group = torch.split(params[j], self.group_param_num[j], dim=0)
-
-            tensors_in_group = []
-            for i in range(len(vecs_in_group)):
-                tsr = vecs_in_group[i].reshape(self.shapes[j][i])
-                tensors_in_group.append(tsr)
-            params[j] = tensors_in_group
+        # without grad (evaluation and decoding) the params of a language combination only change
+        # with the parameters, so they are generated once and reused until then
+        if torch.is_grad_enabled():
+            self.param_cache.clear()
+            return self.generate_params(langs)
+
+        version = self.params_version()
+        if version != self.param_cache_version:
+            self.param_cache.clear()
+            self.param_cache_version = version
+        key = tuple(langs)
+        if key not in self.param_cache:
+            self.param_cache[key] = self.generate_params(langs)
+        return self.param_cache[key]
+
+    def params_version(self) -> Tuple[Tuple[int, int]]:
+        """
+        Identifies the current values of the parameters, in-place updates (e.g. by the optimizer or
+        `load_state_dict`) bump the tensor versions and moving the model changes the storages
+        """
+        return tuple((param.data_ptr(), param._version) for param in self.parameters())
+
+    def generate_params(self, langs: List[int]) -> List[List[Tensor]]:
+        """
+        Generates the grouped parameters of the languages from the language embeddings, see `get_params`.
+        The rank projections of all the groups run as one bmm, and so do the W_j of all the groups,
+        whose output is one flat buffer of which the returned tensors are views
+        """
+        groups = [j for j in range(self.group_num) if langs[j] is not None]
+        # dim = (len(groups), lang_embed_size), the language embedding of each group
+        ell = self.L(self.lang_encode[[langs[j] for j in groups]])
+        # dim = (len(groups), low_rank, lang_embed_size)
+        P = torch.stack([self.Ps[j].weight for j in groups])
+        # dim = (len(groups), 1, low_rank)
+        P_ell = torch.bmm(ell.unsqueeze(1), P.transpose(1, 2))
+
+        # the chunks from the first to the last generated group, the groups skipped in between get
+        # zero params, which are not returned
+        first, last = groups[0], groups[-1]
+        if len(groups) < last - first + 1:
+            skipped = P_ell.new_zeros((last - first + 1,) + P_ell.shape[1:])
+            P_ell = skipped.index_copy(0, torch.tensor(groups, device=P_ell.device) - first, P_ell)
+        chunk_begin, chunk_end = self.group_chunk_offsets[first], self.group_chunk_offsets[last + 1]
+        # dim = (num_chunks, 1, low_rank), the P_j ell of the group of every chunk
+        chunk_P_ell = P_ell.index_select(0, self.chunk_groups[chunk_begin:chunk_end] - first)
+        # dim = (num_chunks * CHUNK_SIZE)
+        flat_params = torch.bmm(chunk_P_ell, self.W[chunk_begin:chunk_end]).view(-1)
+
+        # separate the params of every group and reshape to desired shape
+        params = [None] * self.group_num
+        for j in groups:
+            offset = (self.group_chunk_offsets[j] - chunk_begin) * CPG.CHUNK_SIZE
+            vecs_in_group = torch.split(flat_params[offset:offset + self.group_param_sizes[j]], self.group_param_num[j])
+            params[j] = [vec.view(shape) for vec, shape in zip(vecs_in_group, self.shapes[j])]
         return params
 
     def get_embedding(self, lang: int):
@@ -108,21 +206,79 @@ class CPG(nn.Module):
         pass
 
 
+def unchunk_W(cpg: CPG) -> List[Tensor]:
+    """
+    The W_j of every group as a (group_param_size_j, low_rank) tensor, the layout before `CPG.chunk_W`
+    """
+    W = cpg.W.detach().transpose(1, 2).reshape(-1, cpg.low_rank)
+    offsets = [offset * CPG.CHUNK_SIZE for offset in cpg.group_chunk_offsets]
+    return [W[offsets[j]:offsets[j] + cpg.group_param_sizes[j]].contiguous() for j in range(cpg.group_num)]
+
+
+def reference_params(cpg: CPG, Ws: List[Tensor], langs: List[int]) -> List[List[Tensor]]:
+    """
+    The params of `CPG.generate_params` generated group by group as W_j P_j ell_j, one mv per group
+    """
+    params = []
+    for j in range(cpg.group_num):
+        W_j_P_j_ell_j = torch.mv(Ws[j], cpg.Ps[j](cpg.L(cpg.lang_encode[langs[j]])))
+        vecs_in_group = torch.split(W_j_P_j_ell_j, cpg.group_param_num[j])
+        params.append([vec.view(shape) for vec, shape in zip(vecs_in_group, cpg.shapes[j])])
+    return params
+
+
 if __name__ == '__main__':
+    import time
+
     args = dict()
-    args['--lang_embed_size'] = 8
+    args['--lang-embed-size'] = 8
     args['--embed-size'] = 256
-    args['--vocab_size'] = 20000
-    args['--low_rank'] = 4
+    args['--vocab-size'] = 20000
+    args['--low-rank'] = 4
 
     shapes = [[(10, 20), (10, 20, 30), (10, 20, 30)], [(100, 200), (10, 2, 300)], [(1, 20, 45), (10, 2)]]
 
     print(CPG.get_param_meta(shapes))
 
-    cpg = CPG(shapes, args)
+    cpg = CPG(shapes, args).to(device)
     result = cpg.get_params([1, 1, 0])
 
     for tensor_list in result:
         print('%d tensors in this group' % len(tensor_list))
         for tsr in tensor_list:
             print(tsr.shape)
+
+    # benchmark against the group by group generation with the shapes of a 2 layer model,
+    # hidden size 256, embed size 256 and a 20000 subword vocab
+    def lstm_shapes(input_size, hidden_size):
+        return [[(input_size, 4 * hidden_size), (hidden_size, 4 * hidden_size), (1, 4 * hidden_size),
+                 (1, 4 * hidden_size)]]
+    enc_shapes = (lstm_shapes(256, 256) + lstm_shapes(256, 256)) * 2
+    dec_shapes = lstm_shapes(512 + 256, 512) + lstm_shapes(512, 512) + [[(512, 512), (512, 1024), (20000, 512)]]
+    cpg = CPG(enc_shapes + dec_shapes, args).to(device)
+    langs_ = [1] * len(enc_shapes) + [0] * len(dec_shapes)
+
+    Ws = unchunk_W(cpg)
+    with torch.no_grad():
+        reference = reference_params(cpg, Ws, langs_)
+        same = all(torch.allclose(x, y, atol=1e-6) for group_x, group_y in
+                   zip(reference, cpg.generate_params(langs_)) for x, y in zip(group_x, group_y))
+        # the encoder only and decoder only params, as `MultiNMT.get_grouped_params` generates them
+        for skipped in [[1] * len(enc_shapes) + [None] * len(dec_shapes), [None] * len(enc_shapes) + [0] * len(dec_shapes)]:
+            same = same and all(x is None if lang is None else all(torch.allclose(a, b, atol=1e-6) for a, b in zip(x, y))
+                                for lang, x, y in zip(skipped, cpg.generate_params(skipped), reference))
+    print('same params: %s' % same)
+
+    for generate, name in [(lambda cpg, langs: reference_params(cpg, Ws, langs), 'by group'),
+                           (CPG.generate_params, 'chunked')]:
+        for grad in [True, False]:
+            with torch.set_grad_enabled(grad):
+                generate(cpg, langs_)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                begin = time.time()
+                for _ in range(20):
+                    generate(cpg, langs_)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                print('%s, grad %s: %.2f ms per call' % (name, grad, (time.time() - begin) / 20 * 1000))
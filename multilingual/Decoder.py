@@ -10,18 +10,40 @@ from config import device
 from vocab import Vocab
 
 
+# nmt/nmt.py has its own copy, the scripts of multilingual/ run without nmt/ on the import path
+class SourceMemory:
+    """
+    The source encodings seen by the attention, together with their attention keys `Wa h_s`.
+    The keys only depend on the source, so they are projected once per batch and then reused by
+    every decoder step and every hypothesis in the beam.
+    """
+    def __init__(self, encodings: Tensor, keys: Tensor, mask: Tensor=None):
+        """
+        :param encodings: source top hidden states of size [batch_size, src_len, num_direction * enc_hidden_size]
+        :param keys: projected attention keys of size [batch_size, dec_hidden_size, src_len]
+        :param mask: optional (batch_size, 1, src_len) mask, non-zero at padded source positions
+        """
+        self.encodings = encodings
+        self.keys = keys
+        self.mask = mask
+
+    def index_select(self, rows: Tensor) -> 'SourceMemory':
+        """
+        Select (or repeat) the rows of the batch, e.g. to follow the back pointers of a beam
+        """
+        mask = None if self.mask is None else self.mask.index_select(0, rows)
+        return SourceMemory(self.encodings.index_select(0, rows), self.keys.index_select(0, rows), mask)
+
+
 class Decoder:
-    def __init__(self, vocab_size, batch_size, embed_size, hidden_size, num_layers,
-                 embedding: nn.Embedding, lstm_weights: List[List[Tensor]], attn_weights: List[List[Tensor]],
-                 dropout_rate=0):
-        self.embedding = embedding
+    """
+    The decoder is kept by the model and reused by every batch, the generated weights of the target
+    language are bound with `set_weights` before it is used
+    """
+    def __init__(self, vocab_size, embed_size, hidden_size, num_layers, dropout_rate=0):
         self.dec_embed_size = embed_size
         self.dec_hidden_size = hidden_size
         self.num_layers = num_layers
-        self.batch_size = batch_size
-        self.lstm_cell = Stack_FLSTMCell(input_size=hidden_size + embed_size, hidden_size=hidden_size,
-                                         weights=lstm_weights, num_layers=num_layers)
-        self.Wa, self.Wc, self.Ws = attn_weights[0]
         self.log_softmax = nn.LogSoftmax(dim=1)
         self.softmax = nn.Softmax(dim=2)
         weights = torch.ones(vocab_size).to(device)
@@ -30,28 +52,65 @@ class Decoder:
         self.tanh = nn.Tanh()
         self.dropout_rate = dropout_rate
         self.dropout = nn.Dropout(p=self.dropout_rate)
-        sos_batch = torch.tensor([Vocab.SOS_ID for _ in range(batch_size)], dtype=torch.long).to(device)
-        self.init_input = embedding(sos_batch)
+        # the zero initial attention vectors by batch size, they are never written to
+        self.zero_attn = {}
+
+        # the weights of the target language, see `set_weights`
+        self.embedding = None
+        self.lstm_cell = None
+        self.lstm_cells = self.init_lstm_cells()
+        self.Wa, self.Wc, self.Ws = None, None, None
 
-    @staticmethod
-    def init_decoder_step_input(decoder_init_state: Tuple[Tensor, Tensor]) \
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the bound weights are generated again before every use
+        state.update(embedding=None, lstm_cell=None, lstm_cells=self.init_lstm_cells(), Wa=None, Wc=None, Ws=None,
+                     zero_attn={})
+        return state
+
+    def init_lstm_cells(self) -> List[Stack_FLSTMCell]:
+        """
+        The FLSTM and the fused lstm cells, created once without weights, `set_weights` rebinds the
+        weights of the ones in use
+        """
+        return [Stack_FLSTMCell(input_size=self.dec_hidden_size + self.dec_embed_size, hidden_size=self.dec_hidden_size,
+                                num_layers=self.num_layers, fused=fused) for fused in (False, True)]
+
+    def set_weights(self, embedding: nn.Embedding, lstm_weights: List[List[Tensor]],
+                    attn_weights: List[List[Tensor]], fused=False):
+        """
+        Binds the embedding and the generated weights of the target language used by the following calls
+
+        :param embedding: the word embedding of the target language
+        :param lstm_weights: the weights of the stacked lstm cells
+        :param attn_weights: Wa, Wc and Ws of the attention and the output layer
+        :param fused: run the lstm cells on PyTorch's fused kernel
+        """
+        self.embedding = embedding
+        self.lstm_cell = self.lstm_cells[fused]
+        self.lstm_cell.set_weights(lstm_weights)
+        self.Wa, self.Wc, self.Ws = attn_weights[0]
+
+    def init_decoder_step_input(self, decoder_init_state: Tuple[Tensor, Tensor]) \
             -> Tuple[Tensor, Tensor, Tensor]:
         """
         Initial input to decoder step
 
-        :param d: device type
         :param decoder_init_state: decoder GRU/LSTM's initial state
-        :return: h_0, c_0 of shape [num_layers, self.batch_size, dec_hidden_size],
+        :return: h_0, c_0 of shape [num_layers, batch_size, dec_hidden_size],
         attn of shape [batch_size, num_direction * enc_hidden_size]
         """
-        # [num_layers, self.batch_size, dec_hidden_size]
+        # [num_layers, batch_size, dec_hidden_size]
         h_0 = decoder_init_state[0]
         c_0 = decoder_init_state[1]
         # [batch_size, num_direction * enc_hidden_size]
-        attn = torch.zeros(h_0.shape[1:], device=device)
-        return h_0, c_0, attn
+        batch_size = h_0.shape[1]
+        if batch_size not in self.zero_attn:
+            self.zero_attn[batch_size] = torch.zeros(h_0.shape[1:], device=device)
+        return h_0, c_0, self.zero_attn[batch_size]
 
-    def __call__(self, src_encodings: Tensor, decoder_init_state: Tensor, tgt_sent_idx: Tensor) -> Tensor:
+    def __call__(self, src_encodings: Tensor, decoder_init_state: Tensor, tgt_sent_idx: Tensor,
+                 src_lengths: Tensor=None, predict: bool=False) -> Tuple[Tensor, Optional[List[List[int]]]]:
         """
         Given source encodings, compute the log-likelihood of predicting the gold-standard target
         sentence tokens
@@ -61,6 +120,9 @@ class Decoder:
             [src_len, batch_size, num_direction * enc_hidden_size]
             decoder_init_state: decoder GRU/LSTM's initial state
             tgt_sent_idx: indices of gold-standard target sentences with dim [batch_size, sent_len]
+            src_lengths: optional source sentence lengths with dim [batch_size], the attention
+                skips the padded source positions if given
+            predict: whether to also return the greedy predictions of every step
 
         Returns:
             scores: could be a variable of shape [batch_size, ] representing the
@@ -68,37 +130,63 @@ class Decoder:
                 each example in the input batch
                 (extra note) we need this to be in the shape of (batch_size, output_vocab_size)
                 for beam search
+            top_subwords: the greedy predictions of every step for each example if `predict`,
+                otherwise None
         """
-        # dim = (batch_size, embed_size)
-        decoder_input = self.init_input
-        scores = torch.zeros(self.batch_size, device=device)
+        batch_size = tgt_sent_idx.shape[0]
+        # dim = (batch_size, embed_size), the first word of every target sentence is '<s>'
+        decoder_input = self.embedding.weight[Vocab.SOS_ID].expand(batch_size, -1)
+        scores = torch.zeros(batch_size, device=device)
         h_t, c_t, attn = self.init_decoder_step_input(decoder_init_state)
+        src_memory = self.source_memory(src_encodings, src_lengths)
         # dim = (batch_size, sent_len, embed_size)
         tgt_sent_embed = self.embedding(tgt_sent_idx)
-        top_subwords = [[] for _ in range(self.batch_size)]
+        # the greedy predictions stay on the device until all the steps are done
+        top_ids = []
         # skip the '<s>' in the tgt_sents since the output starts from the word after '<s>'
         for i in range(1, tgt_sent_idx.shape[1]):
             decoder_input = self.dropout(decoder_input)
-            h_t, c_t, softmax_output, attn = self.decoder_step(src_encodings, decoder_input, h_t, c_t, attn)
-            _, top_id = torch.topk(softmax_output, 1, dim=1)
-            for j in range(self.batch_size):
-                top_subwords[j].append(int(top_id[j]))
+            h_t, c_t, softmax_output, attn = self.decoder_step(src_memory, decoder_input, h_t, c_t, attn)
+            if predict:
+                # dim = (batch_size)
+                top_ids.append(torch.argmax(softmax_output, dim=1))
             # dim = (batch_size)
-            target_word_indices = tgt_sent_idx[:, i].reshape(self.batch_size)
+            target_word_indices = tgt_sent_idx[:, i].reshape(batch_size)
             score_delta = self.criterion(softmax_output, target_word_indices)
             # update scores
             scores = scores + score_delta
             # dim = (batch_size, embed_size)
             decoder_input = tgt_sent_embed[:, i, :]
+
+        top_subwords = None
+        if predict:
+            # dim = (batch_size, sent_len - 1), copied to the host at once
+            top_subwords = torch.stack(top_ids, dim=1).tolist()
         return scores, top_subwords
 
-    def decoder_step(self, src_encodings: Tensor, decoder_input: Tensor, h_t: Tensor, c_t: Tensor, attn: Tensor)\
+    def source_memory(self, src_encodings: Tensor, src_lengths: Tensor=None) -> SourceMemory:
+        """
+        Wrap the source encodings for the attention and project the attention keys once
+
+        :param src_encodings: [batch_size, src_len, num_direction * enc_hidden_size]
+        :param src_lengths: optional (batch_size, ) source lengths, the padded positions are masked if given
+        :return: the source memory used by `decoder_step`
+        """
+        # [batch_size, dec_hidden_size, src_len]
+        keys = F.linear(src_encodings, self.Wa).transpose(1, 2)
+        mask = None
+        if src_lengths is not None:
+            # dim = (batch_size, 1, src_len), non-zero at the padded positions
+            mask = (torch.arange(src_encodings.shape[1], device=device).unsqueeze(0) >=
+                    src_lengths.to(device).unsqueeze(1)).unsqueeze(1)
+        return SourceMemory(src_encodings, keys, mask)
+
+    def decoder_step(self, src_memory: SourceMemory, decoder_input: Tensor, h_t: Tensor, c_t: Tensor, attn: Tensor)\
             -> (Tensor, Tensor, Tensor, Tensor):
         """
         Perform one decoder step
 
-        :param src_encodings:  the output features (h_t) from the last layer in source sentences of shape
-            [batch_size, src_len, num_direction * enc_hidden_size]
+        :param src_memory: the source encodings and their attention keys, see `source_memory`
         :param decoder_input: (batch_size, embed_size)
         :param h_t: [num_layers, batch_size, dec_hidden_size]
         :param c_t: [num_layers, batch_size, dec_hidden_size]
@@ -109,34 +197,38 @@ class Decoder:
             torch.cat((attn, decoder_input), 1),  # [batch_size,  num_direction * enc_hidden_size + dec_embed_size]
             h_t, c_t)
         # attn_h_t.shape = [batch_size, dec_hidden_size]
-        attn_h_t = self.global_attention(src_encodings, h_t[-1])
+        attn_h_t = self.global_attention(src_memory, h_t[-1])
         # softmax_output.shape = [batch_size, vocab_size]
         softmax_output = self.log_softmax(
             F.linear(attn_h_t, self.Ws))  # [batch_size, vocab_size]
         return h_t, c_t, softmax_output, attn_h_t
 
-    def global_attention(self, h_s: Tensor, h_t_top: Tensor) -> Tensor:
+    def global_attention(self, src_memory: SourceMemory, h_t_top: Tensor) -> Tensor:
         """
         Calculate global attention
 
-        :param h_s: source top hidden state of size [batch_size, src_len, num_direction * enc_hidden_size]
+        :param src_memory: the source encodings and their attention keys, see `source_memory`
         :param h_t_top: decoder hidden state of size [batch_size, dec_hidden_size]
         :return: an attention vector (batch_size, dec_hidden_size)
         """
+        # dim = (batch_size, 1, src_len)
+        score = self.general_score(src_memory, h_t_top)
+        if src_memory.mask is not None:
+            # padded positions must not take any attention weight
+            score = score.masked_fill(src_memory.mask, -float('inf'))
         # dim = (batch_size, num_direction * enc_hidden_size)
-        c_t = torch.bmm(self.softmax(self.general_score(h_s, h_t_top)), h_s)[:, 0, :]
+        c_t = torch.bmm(self.softmax(score), src_memory.encodings)[:, 0, :]
         # dim = (batch_size, num_direction * enc_hidden_size + dec_hidden_size)
         cat_c_h = torch.cat((c_t, h_t_top), 1)
         return self.tanh(F.linear(cat_c_h, self.Wc))
 
-    def general_score(self, h_s: Tensor, h_t_top: Tensor) -> Tensor:
+    def general_score(self, src_memory: SourceMemory, h_t_top: Tensor) -> Tensor:
         """
         Calculate general attention score
 
-        :param h_s: source top hidden state of size [batch_size, src_len, num_direction * enc_hidden_size]
+        :param src_memory: the source encodings and their attention keys `Wa h_s`
+            of size [batch_size, dec_hidden_size, src_len]
         :param h_t_top: decoder hidden state of size [batch_size, dec_hidden_size]
         :return: a score of size (batch_size, 1, src_len)
         """
-        return torch.bmm(h_t_top.unsqueeze(1),
-                         # [batch_size, num_direction * enc_hidden_size = dec_hidden_size, src_len]
-                         F.linear(h_s, self.Wa).transpose(1, 2))
+        return torch.bmm(h_t_top.unsqueeze(1), src_memory.keys)
@@ -1,116 +1,84 @@
 from typing import List, Tuple
 
 import torch
-from FLSTM import Stack_FLSTMCell
+from FLSTM import BiFLSTM, FusedBiLSTM
 from torch import Tensor
-from config import device
 
 
 class Encoder:
     """
-    The encoder is a bidiretional encoder, one can NOT be used as a single direction one
+    The encoder is a bidiretional encoder, one can NOT be used as a single direction one.
+    It is kept by the model and reused by every batch, the generated weights of the source
+    language are bound with `set_weights` before it is used
     """
-    def __init__(self, batch_size, embed_size, hidden_size, embedding: torch.nn.Embedding, weights: List[List[Tensor]],
-                 num_layer=2):
+    def __init__(self, embed_size, hidden_size, num_layer=2):
         self.num_direction = 2
-        # num of cell weights must match the setting
-        assert(len(weights) == self.num_direction * num_layer)
         # init size constant
-        self.batch_size = batch_size
         self.input_size = embed_size
         self.hidden_size = hidden_size
         self.num_layer = num_layer
-
-        # set different layers
-        self.embedding = embedding
         self.embed_size = embed_size
-        self.in_order_cells = Stack_FLSTMCell(self.input_size, self.hidden_size, weights[:self.num_layer],
-                                              num_layers=num_layer)
-        self.rev_order_cells = Stack_FLSTMCell(self.input_size, self.hidden_size, weights[self.num_layer:],
-                                               num_layers=num_layer)
-
-        # set some dummy input states
-        self.h_0 = torch.zeros((self.num_direction * self.num_layer, self.batch_size, self.hidden_size), device=device)
-        self.c_0 = torch.zeros((self.num_direction * self.num_layer, self.batch_size, self.hidden_size), device=device)
 
-    def __call__(self, src_sent_idx: Tensor) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
-        """
-        encode the sequence in bidirection
+        # the weights of the source language, see `set_weights`
+        self.embedding = None
+        self.lstm = None
+        self.lstms = self.init_lstms()
 
-        Args:
-            src_sent_idx: source sentence word indices dim = (batch_size, sent_len)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the bound weights are generated again before every use
+        state.update(embedding=None, lstm=None, lstms=self.init_lstms())
+        return state
 
-        Return:
-            outputs: dim = (batch_size, sent_length, num_direction * hidden_size)
-            h_t, c_t: dim = (num_layers, batch_size, num_direction * hidden_size)
+    def init_lstms(self) -> List:
         """
-        # set the variables that iteratively used in encoding steps
-        h_t = self.h_0
-        c_t = self.c_0
-        outputs = []
-
-        # get the sentence length for this batch
-        sent_len = src_sent_idx.shape[1]
-
-        # dim = (batch_size, sent_length, embed_size)
-        embedding = self.embedding(src_sent_idx)
-
-        # for each of the sent words, encode step by step
-        for step in range(sent_len):
-            output, h_t, c_t = self.encoder_step(embedding[:, step, :], embedding[:, -step-1, :], h_t, c_t)
-            outputs.append(output)
-
-        # pack the list of tensors to one single tensor
-        outputs = torch.stack(outputs, dim=1)
-
-        return outputs, (self.to_tensor(h_t), self.to_tensor(c_t))
+        The FLSTM and the fused lstm, created once without weights, `set_weights` rebinds the weights
+        of the one in use
+        """
+        return [bi_lstm(self.input_size, self.hidden_size, num_layers=self.num_layer)
+                for bi_lstm in (BiFLSTM, FusedBiLSTM)]
 
-    def to_tensor(self, t: List[Tensor]) -> Tensor:
+    def set_weights(self, embedding: torch.nn.Embedding, weights: List[List[Tensor]], fused=False):
         """
-        Concatenates a list of tensors with two directions and stack by layers
-        :param t:
-        :return: dim = (num_layers, batch_size, num_direction * hidden_size)
+        Binds the embedding and the generated weights of the source language used by the following calls
+
+        :param embedding: the word embedding of the source language
+        :param weights: the weights of the lstm cells, the first num_layer ones are the in-order direction,
+            the rest are the reverse-order one
+        :param fused: run the lstm on PyTorch's fused kernels, which computes the same as FLSTM
         """
-        # dim = (num_layers, batch_size, hidden_size)
-        in_t = torch.stack(t[:self.num_layer], dim=0)
-        # dim = (num_layers, batch_size, hidden_size)
-        rev_t = torch.stack(t[self.num_layer:], dim=0)
-        # dim = (num_layers, batch_size, num_direction * hidden_size)
-        return torch.cat((in_t, rev_t), 2)
+        # num of cell weights must match the setting
+        assert(len(weights) == self.num_direction * self.num_layer)
+        self.embedding = embedding
+        self.lstm = self.lstms[fused]
+        self.lstm.set_weights(weights[:self.num_layer], weights[self.num_layer:])
 
-    def encoder_step(self, in_x: Tensor, rev_x: Tensor, h_t: List[Tensor], c_t: List[Tensor]) \
-            -> Tuple[Tensor, List[Tensor], List[Tensor]]:
+    def __call__(self, src_sent_idx: Tensor, src_lengths: Tensor=None) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
         """
-        encode only one step by two direction for stacked flstm
+        encode the sequence in bidirection
+
         Args:
-            in_x: in-order input dim = (batch_size, input_size)
-            rev_x: reverse-order input dim = (batch_size, input_size)
-            h_t: a list of num_direction * num_layers previous hidden layers of shape [batch_size, hidden_size]
-            c_t: a list of num_direction * num_layers previous memory cells of shape [batch_size, hidden_size]
+            src_sent_idx: source sentence word indices dim = (batch_size, sent_len)
+            src_lengths: source sentence lengths dim = (batch_size), the padded positions are skipped if given
 
         Return:
-            output: the hidden state of only the last layer concat with directions,
-                    dim = (batch_size, num_direction * hidden_size)
-            h_t_1: a list of num_direction * num_layers next hidden layers of shape [batch_size, hidden_size]
-            c_t_1: a list of num_direction * num_layers next memory cells of shape [batch_size, hidden_size]
+            outputs: dim = (batch_size, sent_length, num_direction * hidden_size), zeros at the padded positions
+            h_t, c_t: dim = (num_layers, batch_size, num_direction * hidden_size)
         """
-        assert(len(h_t) == self.num_direction * self.num_layer)
-        assert(len(c_t) == self.num_direction * self.num_layer)
-
-        # one step encode for both directions
-        # dim = (num_layers, batch_size, hidden_size)
-        in_h_t_1, in_c_t_1 = self.in_order_cells(in_x, h_t[:self.num_layer], c_t[:self.num_layer])
-        rev_h_t_1, rev_c_t_1 = self.in_order_cells(rev_x, h_t[self.num_layer:], c_t[self.num_layer:])
-        # dim = (batch_size, hidden_size)
-        in_output = in_h_t_1[-1]
-        rev_output = rev_h_t_1[-1]
-
-        output = torch.cat([in_output, rev_output], dim=1)
-        h_t_1 = in_h_t_1 + rev_h_t_1
-        c_t_1 = in_c_t_1 + rev_c_t_1
-
-        return output, h_t_1, c_t_1
-
+        # dim = (batch_size, sent_length, embed_size)
+        embedding = self.embedding(src_sent_idx)
+        if src_lengths is None:
+            return self.lstm(embedding)
 
+        # the lstm shrinks the batch as the sentences end, so the rows are sorted by decreasing length
+        src_lengths, order = torch.sort(src_lengths.to(embedding.device), descending=True)
+        embedding = embedding.index_select(0, order)
 
+        # encode both directions of the whole sentence layer by layer, each reverse pass starts at
+        # the last token of its sentence, and the outputs of both directions are aligned to the tokens
+        # dim = (batch_size, sent_length, num_direction * hidden_size)
+        outputs, (h_t, c_t) = self.lstm(embedding, src_lengths)
 
+        # restore the order of the batch
+        restore = torch.argsort(order)
+        return outputs.index_select(0, restore), (h_t.index_select(1, restore), c_t.index_select(1, restore))
@@ -3,6 +3,8 @@ from typing import List
 import torch
 import torch.tensor as Tensor
 import torch.nn as nn
+from torch import _VF
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 from utils import assert_tensor_size
 
@@ -29,22 +31,39 @@ def unpack_weight(weight, input_size, hidden_size):
     return W_x, W_h, b_x, b_h
 
 
-class Stack_FLSTMCell:
-    def __init__(self, input_size, hidden_size, weights: List[List[Tensor]], num_layers=1):
-        assert (len(weights) == num_layers)
+def same_weights(bound: List, weights: List) -> bool:
+    """
+    Whether the (nested) lists of weights hold the very same tensors, e.g. the cached params of CPG
+    """
+    if bound is None or len(bound) != len(weights):
+        return False
+    return all(same_weights(x, y) if isinstance(x, (list, tuple)) else x is y for x, y in zip(bound, weights))
+
 
+class Stack_FLSTMCell:
+    def __init__(self, input_size, hidden_size, weights: List[List[Tensor]]=None, num_layers=1, fused=False):
         # init the size constants
         self.input_size = input_size
         self.hidden_size = hidden_size
         self.num_layers = num_layers
 
-        # init the cells for each layer with weight references
+        # init the cells for each layer, the weights are bound with `set_weights`
         self.cells = []
         for i in range(num_layers):
             # only the input size of the first layer is the input size of the decoder
             cell_input_size = self.input_size if i == 0 else self.hidden_size
-            cell = FLSTMCell(cell_input_size, self.hidden_size, weights[i])
-            self.cells.append(cell)
+            cell = FusedFLSTMCell if fused else FLSTMCell
+            self.cells.append(cell(cell_input_size, self.hidden_size))
+        if weights is not None:
+            self.set_weights(weights)
+
+    def set_weights(self, weights: List[List[Tensor]]):
+        """
+        Binds the weights of every layer by reference
+        """
+        assert (len(weights) == self.num_layers)
+        for cell, cell_weights in zip(self.cells, weights):
+            cell.set_weights(cell_weights)
 
     def __call__(self, X: Tensor, h_0: List[Tensor], c_0: List[Tensor]) \
             -> (List[Tensor], List[Tensor]):
@@ -82,14 +101,19 @@ class Stack_FLSTMCell:
 
 
 class FLSTMCell:
-    def __init__(self, input_size, hidden_size, weights):
+    def __init__(self, input_size, hidden_size, weights=None):
         # init the size constants
         self.input_size = input_size
         self.hidden_size = hidden_size
-        W_x_shape = [input_size, 4 * hidden_size]
-        W_h_shape = [hidden_size, 4 * hidden_size]
-        b_x_shape = [1, 4 * hidden_size]
-        b_h_shape = [1, 4 * hidden_size]
+        self.W_x = self.W_h = self.b_x = self.b_h = None
+        if weights is not None:
+            self.set_weights(weights)
+
+    def set_weights(self, weights: List[Tensor]):
+        W_x_shape = [self.input_size, 4 * self.hidden_size]
+        W_h_shape = [self.hidden_size, 4 * self.hidden_size]
+        b_x_shape = [1, 4 * self.hidden_size]
+        b_h_shape = [1, 4 * self.hidden_size]
         # init the weights BY REFRENCE
         W_x, W_h, b_x, b_h = weights
         assert_tensor_size(W_x, W_x_shape)
@@ -118,17 +142,296 @@ class FLSTMCell:
         #                                  + [batch_size, hidden_size] * [hidden_size, 4*hidden_size]
         W_x_h_b = torch.mm(X, self.W_x) + torch.mm(h_0, self.W_h) + self.b_x + self.b_h
 
-        # (batch_size, hidden_size)
-        i = torch.sigmoid(W_x_h_b[:, 0:hidden_size])
-        f = torch.sigmoid(W_x_h_b[:, hidden_size:2 * hidden_size])
-        g = torch.tanh(W_x_h_b[:, 2 * hidden_size:3 * hidden_size])
-        o = torch.sigmoid(W_x_h_b[:, 3 * hidden_size:4 * hidden_size])
+        return lstm_gates(W_x_h_b, c_0, hidden_size)
 
-        # (batch_size, hidden_size)
-        c_1 = f * c_0 + i * g
-        h_1 = o * torch.tanh(c_1)
 
-        return h_1, c_1
+class FusedFLSTMCell(FLSTMCell):
+    """
+    A FLSTMCell running on PyTorch's fused LSTM cell kernel
+    """
+    def __init__(self, input_size, hidden_size, weights=None):
+        self.fused_weights = None
+        super(FusedFLSTMCell, self).__init__(input_size, hidden_size, weights)
+
+    def set_weights(self, weights: List[Tensor]):
+        # the weights bound already are not laid out again
+        if same_weights([self.W_x, self.W_h, self.b_x, self.b_h], weights):
+            return
+        super(FusedFLSTMCell, self).set_weights(weights)
+        self.fused_weights = fused_lstm_weights(weights)
+
+    def __call__(self, X: Tensor, h_0: Tensor, c_0: Tensor) -> (Tensor, Tensor):
+        """
+        Performs a step of LSTM, see `FLSTMCell.__call__`
+        """
+        return _VF.lstm_cell(X, (h_0, c_0), *self.fused_weights)
+
+
+class BiFLSTM:
+    """
+    Stacked bidirectional LSTM over whole sequences. The weights of the two directions are stacked
+    so that both directions of a layer run as one batched matmul over a leading direction dimension
+    """
+    def __init__(self, input_size, hidden_size, in_weights: List[List[Tensor]]=None,
+                 rev_weights: List[List[Tensor]]=None, num_layers=1):
+        # init the size constants
+        self.num_direction = 2
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+
+        self.weights = None
+        if in_weights is not None:
+            self.set_weights(in_weights, rev_weights)
+
+    def set_weights(self, in_weights: List[List[Tensor]], rev_weights: List[List[Tensor]]):
+        """
+        Binds the weights of the two directions, the weights bound already are not stacked again
+        """
+        assert (len(in_weights) == self.num_layers)
+        assert (len(rev_weights) == self.num_layers)
+        if same_weights(self.weights, [in_weights, rev_weights]):
+            return
+        self.weights = [in_weights, rev_weights]
+        hidden_size = self.hidden_size
+
+        # stack the weights of the two directions for each layer
+        self.W_x = []
+        self.W_h = []
+        self.b = []
+        for i in range(self.num_layers):
+            # only the input size of the first layer is the input size of the stack
+            layer_input_size = self.input_size if i == 0 else self.hidden_size
+            for W_x, W_h, b_x, b_h in (in_weights[i], rev_weights[i]):
+                assert_tensor_size(W_x, [layer_input_size, 4 * hidden_size])
+                assert_tensor_size(W_h, [hidden_size, 4 * hidden_size])
+                assert_tensor_size(b_x, [1, 4 * hidden_size])
+                assert_tensor_size(b_h, [1, 4 * hidden_size])
+            # dim = (num_direction, layer_input_size, 4*hidden_size)
+            self.W_x.append(torch.stack([in_weights[i][0], rev_weights[i][0]]))
+            # dim = (num_direction, hidden_size, 4*hidden_size)
+            self.W_h.append(torch.stack([in_weights[i][1], rev_weights[i][1]]))
+            # dim = (num_direction, 1, 4*hidden_size)
+            self.b.append(torch.stack([in_weights[i][2] + in_weights[i][3], rev_weights[i][2] + rev_weights[i][3]]))
+
+    def __call__(self, X: Tensor, lengths: Tensor=None) -> (Tensor, (Tensor, Tensor)):
+        """
+        Runs the stacked LSTM in both directions over a whole sequence, starting from zero states.
+        Like `pack_padded_sequence`, every step only processes the rows that are still active, so the
+        rows must be sorted by decreasing length. The reverse direction of each row starts at its last
+        token, and both directions of the outputs are aligned to the token positions
+
+        :param X: input shape = [batch_size, seq_len, input_size]
+        :param lengths: optional sequence lengths shape = [batch_size], sorted in decreasing order,
+                        all the sequences are seq_len long if not given
+        :return: outputs of the last layer shape = [batch_size, seq_len, num_direction * hidden_size],
+                 zeros at the padded positions,
+                 (h_n, c_n) the last states of every layer shape = [num_layers, batch_size, num_direction * hidden_size]
+        """
+        assert (X.shape[2] == self.input_size)
+        batch_size, seq_len, _ = X.shape
+
+        if lengths is None:
+            lengths = torch.full((batch_size,), seq_len, dtype=torch.long)
+        lengths = lengths.to(X.device)
+        # the number of active rows at each step
+        steps = torch.arange(seq_len, device=X.device)
+        batch_sizes = (lengths.unsqueeze(1) > steps).sum(dim=0).tolist()
+        assert (batch_sizes == sorted(batch_sizes, reverse=True)), 'the rows must be sorted by decreasing length'
+
+        # dim = (batch_size, seq_len, 1)
+        rev_index = reverse_index(lengths, seq_len).unsqueeze(2)
+        # dim = (num_direction, batch_size, seq_len, input_size)
+        input_x = torch.stack([X, X.gather(1, rev_index.expand(-1, -1, X.shape[2]))])
+        h_n = []
+        c_n = []
+
+        # the whole sequence of a layer is the input of the next one, direction by direction
+        for i in range(self.num_layers):
+            input_x, (h, c) = self.layer(i, input_x, batch_sizes)
+            h_n.append(h)
+            c_n.append(c)
+
+        # put the reverse outputs back to the token positions
+        rev_outputs = input_x[1].gather(1, rev_index.expand(-1, -1, self.hidden_size))
+        outputs = torch.cat([input_x[0], rev_outputs], dim=2)
+        return outputs, (torch.stack(h_n), torch.stack(c_n))
+
+    def layer(self, i: int, X: Tensor, batch_sizes: List[int]) -> (Tensor, (Tensor, Tensor)):
+        """
+        Runs the i-th layer of both directions
+
+        :param i: the index of the layer
+        :param X: input shape = [num_direction, batch_size, seq_len, layer_input_size]
+        :param batch_sizes: the number of active rows at each step
+        :return: outputs shape = [num_direction, batch_size, seq_len, hidden_size],
+                 (h_n, c_n) last states shape = [batch_size, num_direction * hidden_size]
+        """
+        num_direction, batch_size, seq_len, input_size = X.shape
+        hidden_size = self.hidden_size
+
+        # [num_direction, batch_size * seq_len, 4*hidden_size]
+        #   = [num_direction, batch_size * seq_len, input_size] * [num_direction, input_size, 4*hidden_size]
+        X_W_x = torch.bmm(X.reshape(num_direction, batch_size * seq_len, input_size), self.W_x[i])
+        # dim = (num_direction, batch_size, seq_len, 4*hidden_size)
+        X_W_x_b = X_W_x.reshape(num_direction, batch_size, seq_len, 4 * hidden_size) + self.b[i].unsqueeze(1)
+
+        outputs = X.new_zeros((num_direction, batch_size, seq_len, hidden_size))
+        h_t = X.new_zeros((num_direction, batch_size, hidden_size))
+        c_t = X.new_zeros((num_direction, batch_size, hidden_size))
+        for t, n in enumerate(batch_sizes):
+            if n == 0:
+                break
+            # [num_direction, n, 4*hidden_size]
+            #   = [num_direction, n, hidden_size] * [num_direction, hidden_size, 4*hidden_size]
+            W_x_h_b = X_W_x_b[:, :n, t, :] + torch.bmm(h_t[:, :n], self.W_h[i])
+            h_1, c_1 = lstm_gates(W_x_h_b, c_t[:, :n], hidden_size)
+            outputs[:, :n, t, :] = h_1
+            # the rows that have ended keep their last states
+            if n < batch_size:
+                h_1 = torch.cat([h_1, h_t[:, n:]], dim=1)
+                c_1 = torch.cat([c_1, c_t[:, n:]], dim=1)
+            h_t, c_t = h_1, c_1
+
+        return outputs, (torch.cat([h_t[0], h_t[1]], dim=1), torch.cat([c_t[0], c_t[1]], dim=1))
+
+
+class FusedBiLSTM:
+    """
+    The same stacked bidirectional LSTM as BiFLSTM, each direction runs as a single call of PyTorch's
+    fused LSTM over the whole stack. The CPG generated weights are passed to it as they are (only
+    transposed), so the gradients still flow back to the CPG
+    """
+    def __init__(self, input_size, hidden_size, in_weights: List[List[Tensor]]=None,
+                 rev_weights: List[List[Tensor]]=None, num_layers=1):
+        # init the size constants
+        self.num_direction = 2
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+
+        self.weights = None
+        if in_weights is not None:
+            self.set_weights(in_weights, rev_weights)
+
+    def set_weights(self, in_weights: List[List[Tensor]], rev_weights: List[List[Tensor]]):
+        """
+        Binds the weights of the two directions, the weights bound already are not laid out again
+        """
+        assert (len(in_weights) == self.num_layers)
+        assert (len(rev_weights) == self.num_layers)
+        if same_weights(self.weights, [in_weights, rev_weights]):
+            return
+        self.weights = [in_weights, rev_weights]
+        hidden_size = self.hidden_size
+
+        # the fused LSTM takes the weights of every layer of a direction as one flat list
+        self.in_flat_weights = []
+        self.rev_flat_weights = []
+        for i in range(self.num_layers):
+            # only the input size of the first layer is the input size of the stack
+            layer_input_size = self.input_size if i == 0 else self.hidden_size
+            for weights, flat_weights in ((in_weights[i], self.in_flat_weights),
+                                          (rev_weights[i], self.rev_flat_weights)):
+                W_x, W_h, b_x, b_h = weights
+                assert_tensor_size(W_x, [layer_input_size, 4 * hidden_size])
+                assert_tensor_size(W_h, [hidden_size, 4 * hidden_size])
+                assert_tensor_size(b_x, [1, 4 * hidden_size])
+                assert_tensor_size(b_h, [1, 4 * hidden_size])
+                flat_weights += fused_lstm_weights(weights)
+
+    def __call__(self, X: Tensor, lengths: Tensor=None) -> (Tensor, (Tensor, Tensor)):
+        """
+        Runs the stacked LSTM in both directions over a whole sequence, see `BiFLSTM.__call__`
+
+        :param X: input shape = [batch_size, seq_len, input_size]
+        :param lengths: optional sequence lengths shape = [batch_size], sorted in decreasing order,
+                        all the sequences are seq_len long if not given
+        :return: outputs of the last layer shape = [batch_size, seq_len, num_direction * hidden_size],
+                 zeros at the padded positions,
+                 (h_n, c_n) the last states of every layer shape = [num_layers, batch_size, num_direction * hidden_size]
+        """
+        assert (X.shape[2] == self.input_size)
+        batch_size, seq_len, _ = X.shape
+
+        if lengths is None:
+            lengths = torch.full((batch_size,), seq_len, dtype=torch.long)
+        lengths = lengths.to(X.device)
+        # dim = (batch_size, seq_len, 1)
+        rev_index = reverse_index(lengths, seq_len).unsqueeze(2)
+
+        in_outputs, (in_h_n, in_c_n) = self.run_direction(X, lengths, self.in_flat_weights)
+        # the reverse direction reads every sentence from its last token
+        rev_outputs, (rev_h_n, rev_c_n) = self.run_direction(X.gather(1, rev_index.expand(-1, -1, X.shape[2])),
+                                                             lengths, self.rev_flat_weights)
+        # put the reverse outputs back to the token positions
+        rev_outputs = rev_outputs.gather(1, rev_index.expand(-1, -1, self.hidden_size))
+
+        outputs = torch.cat([in_outputs, rev_outputs], dim=2)
+        return outputs, (torch.cat([in_h_n, rev_h_n], dim=2), torch.cat([in_c_n, rev_c_n], dim=2))
+
+    def run_direction(self, X: Tensor, lengths: Tensor, flat_weights: List[Tensor]) -> (Tensor, (Tensor, Tensor)):
+        """
+        Runs all the layers of one direction in one fused call
+
+        :param X: input in reading order shape = [batch_size, seq_len, input_size]
+        :param lengths: sequence lengths shape = [batch_size], sorted in decreasing order
+        :param flat_weights: the w_ih, w_hh, b_ih, b_hh of every layer
+        :return: outputs shape = [batch_size, seq_len, hidden_size], zeros at the padded positions,
+                 (h_n, c_n) last states shape = [num_layers, batch_size, hidden_size]
+        """
+        packed_X = pack_padded_sequence(X, lengths.cpu(), batch_first=True)
+        zeros = X.new_zeros((self.num_layers, X.shape[0], self.hidden_size))
+        # dim = (num_packed_tokens, hidden_size)
+        packed_outputs, h_n, c_n = _VF.lstm(packed_X.data, packed_X.batch_sizes, (zeros, zeros), flat_weights,
+                                            True, self.num_layers, 0., torch.is_grad_enabled(), False)
+        outputs, _ = pad_packed_sequence(packed_X._replace(data=packed_outputs), batch_first=True,
+                                         total_length=X.shape[1])
+        return outputs, (h_n, c_n)
+
+
+def fused_lstm_weights(weights: List[Tensor]) -> List[Tensor]:
+    """
+    Lays out the W_x, W_h, b_x, b_h of a FLSTM as the w_ih, w_hh, b_ih, b_hh of PyTorch's fused LSTM,
+    both use the i, f, g, o order of the gates
+    """
+    W_x, W_h, b_x, b_h = weights
+    return [W_x.t(), W_h.t(), b_x.view(-1), b_h.view(-1)]
+
+
+def reverse_index(lengths: Tensor, seq_len: int) -> Tensor:
+    """
+    The positions read by the reverse direction at each step, [length - 1, ..., 0] followed by the pads.
+    Gathering with it a second time puts the tokens back to their positions
+
+    :param lengths: sequence lengths shape = [batch_size]
+    :param seq_len: padded sequence length
+    :return: dim = (batch_size, seq_len)
+    """
+    steps = torch.arange(seq_len, device=lengths.device)
+    return torch.where(steps < lengths.unsqueeze(1), lengths.unsqueeze(1) - 1 - steps, steps)
+
+
+def lstm_gates(W_x_h_b: Tensor, c_0: Tensor, hidden_size: int) -> (Tensor, Tensor):
+    """
+    Applies the LSTM gates on the pre-activations
+
+    :param W_x_h_b: gate pre-activations in i, f, g, o order shape = [..., batch_size, 4*hidden_size]
+    :param c_0: cell state shape = [..., batch_size, hidden_size]
+    :param hidden_size: hidden size of the LSTM
+    :return: (h_1, c_1) next hidden state and cell state shape = [..., batch_size, hidden_size]
+    """
+    # (..., batch_size, hidden_size)
+    i = torch.sigmoid(W_x_h_b[..., 0:hidden_size])
+    f = torch.sigmoid(W_x_h_b[..., hidden_size:2 * hidden_size])
+    g = torch.tanh(W_x_h_b[..., 2 * hidden_size:3 * hidden_size])
+    o = torch.sigmoid(W_x_h_b[..., 3 * hidden_size:4 * hidden_size])
+
+    # (..., batch_size, hidden_size)
+    c_1 = f * c_0 + i * g
+    h_1 = o * torch.tanh(c_1)
+
+    return h_1, c_1
 
 
 if __name__ == '__main__':
@@ -142,11 +445,14 @@ if __name__ == '__main__':
 
     lstm = nn.LSTMCell(input_size_, hidden_size_)
 
+    # nn.LSTMCell keeps W_ih, W_hh as [4*hidden_size, *] and the biases as vectors
     weights = []
     for param in lstm.parameters():
         weights.append(param.data)
-    weights[2] = weights[2].unsqueeze(1)
-    weights[3] = weights[3].unsqueeze(1)
+    weights[0] = weights[0].t()
+    weights[1] = weights[1].t()
+    weights[2] = weights[2].unsqueeze(0)
+    weights[3] = weights[3].unsqueeze(0)
 
     flstm = FLSTMCell(input_size_, hidden_size_, weights)
 
@@ -155,3 +461,39 @@ if __name__ == '__main__':
 
     print(lstm_output)
     print(flstm_output)
+
+    # the forward direction of the sequence layer must give the same results as stepping the cell
+    seq_len_ = 20
+    X_seq_ = torch.randn((batch_size_, seq_len_, input_size_))
+    h_t_, c_t_ = torch.zeros_like(h_0_), torch.zeros_like(c_0_)
+    cell_outputs = []
+    for t_ in range(seq_len_):
+        h_t_, c_t_ = flstm(X_seq_[:, t_, :], h_t_, c_t_)
+        cell_outputs.append(h_t_)
+    seq_outputs, (seq_h_, seq_c_) = BiFLSTM(input_size_, hidden_size_, [weights], [weights])(X_seq_)
+
+    print(torch.allclose(torch.stack(cell_outputs, dim=1), seq_outputs[:, :, :hidden_size_], atol=1e-6))
+    print(torch.allclose(c_t_, seq_c_[0, :, :hidden_size_], atol=1e-6))
+
+    # the fused backend must give the same results and gradients as the FLSTM one
+    num_layers_ = 2
+    lengths_ = torch.sort(torch.randint(1, seq_len_ + 1, (batch_size_,)), descending=True)[0]
+    def random_weights(layer_input_size):
+        return [(torch.rand(shape) * 0.2 - 0.1).requires_grad_() for shape in
+                [(layer_input_size, 4 * hidden_size_), (hidden_size_, 4 * hidden_size_),
+                 (1, 4 * hidden_size_), (1, 4 * hidden_size_)]]
+    in_weights_ = [random_weights(input_size_ if i == 0 else hidden_size_) for i in range(num_layers_)]
+    rev_weights_ = [random_weights(input_size_ if i == 0 else hidden_size_) for i in range(num_layers_)]
+    all_weights_ = [w for layer in in_weights_ + rev_weights_ for w in layer]
+
+    results = []
+    for bi_lstm in (BiFLSTM, FusedBiLSTM):
+        outputs_, (h_n_, c_n_) = bi_lstm(input_size_, hidden_size_, in_weights_, rev_weights_,
+                                        num_layers_)(X_seq_, lengths_)
+        grads = torch.autograd.grad((outputs_.sum() + h_n_.sum() + c_n_.sum()), all_weights_)
+        results.append([outputs_, h_n_, c_n_] + list(grads))
+    # the gradients sum over the whole batch, so they are compared relative to their scale
+    print(all(torch.allclose(x, y, rtol=1e-4, atol=1e-4 * float(x.abs().max())) for x, y in zip(*results)))
+
+    fused_cell = FusedFLSTMCell(input_size_, hidden_size_, weights)
+    print(all(torch.allclose(x, y, atol=1e-6) for x, y in zip(flstm(X_, h_0_, c_0_), fused_cell(X_, h_0_, c_0_))))
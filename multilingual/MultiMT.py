@@ -4,6 +4,7 @@ from typing import *
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.tensor as Tensor
 
 from CPG import CPG
@@ -26,6 +27,8 @@ class MultiNMT(nn.Module):
         self.num_layers = int(args['--num-layers'])
         self.dropout_rate = float(args['--dropout'])
         self.NUM_DIR = 2
+        # run the LSTMs on PyTorch's fused kernels instead of FLSTM, a runtime choice set by the caller
+        self.fused_lstm = False
         # init encoder param shapes
         self.enc_in_lstm_shapes = MultiNMT.get_shapes_flstm(self.embed_size, self.hidden_size, self.num_layers)
         self.enc_rev_lstm_shapes = MultiNMT.get_shapes_flstm(self.embed_size, self.hidden_size, self.num_layers)
@@ -46,63 +49,194 @@ class MultiNMT(nn.Module):
         # combine enc and dec param shapes
         self.param_shapes = self.enc_shapes + self.dec_shapes
         # init CPG
+        self.init_params(args)
+        self.init_encoder_decoder()
+
+    def __setstate__(self, state):
+        super(MultiNMT, self).__setstate__(state)
+        # models saved before the encoder and the decoder were kept by the model
+        if 'encoder' not in self.__dict__:
+            self.init_encoder_decoder()
+
+    def init_encoder_decoder(self):
+        """
+        Creates the encoder and the decoder reused by every batch, they get the generated weights of
+        the languages before each use
+        """
+        self.encoder = Encoder(self.embed_size, self.hidden_size, num_layer=self.num_layers)
+        self.decoder = Decoder(self.vocab_size, self.embed_size, self.decoder_hidden_size, self.num_layers)
+
+    def init_params(self, args: Dict[str, str]):
+        """
+        Creates the modules generating the params of every language
+        """
         self.cpg = CPG(self.param_shapes, args)
 
-    def forward(self, src_lang: int, tgt_lang: int, src_sents: List[List[int]], tgt_sents: List[List[int]]) -> Tensor:
+    def forward(self, src_lang: int, tgt_lang: int, src_sents: Tensor, tgt_sents: Tensor,
+                src_lengths: Tensor=None, predict: bool=False) -> Tuple[Tensor, Optional[List[List[int]]]]:
         """
         Takes in a batch of paired src and tgt sentences with lang tags, return the loss
 
-        :param src_lang: source language index
-        :param tgt_lang: target language index
-        :param src_sents: batch_size of sentences
-        :param tgt_sents: batch_size of sentences
-        :return: scores with shape = [batch_size]
+        :param src_lang: source language index, or the source language of every example of a batch
+            mixing several language pairs (see `forward_mixed`)
+        :param tgt_lang: target language index, or the target language of every example
+        :param src_sents: padded source word indices, shape = [batch_size, src_len]
+        :param tgt_sents: padded target word indices, shape = [batch_size, tgt_len]
+        :param src_lengths: source sentence lengths, shape = [batch_size], the padded source positions
+            are skipped by the encoder and the attention if given
+        :param predict: whether to also return the greedy predictions of the decoder
+        :return: scores with shape = [batch_size], and the greedy predictions of every step for each
+            example if `predict` (otherwise None)
         """
+        if torch.is_tensor(src_lang):
+            return self.forward_mixed(src_lang, tgt_lang, src_sents, tgt_sents, src_lengths, predict)
+        # [batch_size, sent_len], the copies of pinned batches do not block the host
+        src_sents_tensor = src_sents.to(device, non_blocking=True)
         # [batch_size, sent_len]
-        src_sents_tensor = sents_to_tensor(src_sents, device)
-        # [batch_size, sent_len]
-        tgt_sents_tensor = sents_to_tensor(tgt_sents, device)
+        tgt_sents_tensor = tgt_sents.to(device, non_blocking=True)
         assert (src_sents_tensor.shape[0] == tgt_sents_tensor.shape[0])
-        batch_size = src_sents_tensor.shape[0]
         grouped_params = self.get_grouped_params(src_lang, tgt_lang)
         # encode
-        src_encodings, decoder_init_state = self.encode(batch_size, src_sents_tensor, src_lang, grouped_params)
+        src_encodings, decoder_init_state = self.encode(src_sents_tensor, src_lang, grouped_params, src_lengths)
         # decode
-        decoder = self.get_decoder(tgt_lang, batch_size, grouped_params)
-        return decoder(src_encodings, decoder_init_state, tgt_sents_tensor)
+        decoder = self.get_decoder(tgt_lang, grouped_params)
+        return decoder(src_encodings, decoder_init_state, tgt_sents_tensor, src_lengths, predict)
+
+    def forward_mixed(self, src_langs: Tensor, tgt_langs: Tensor, src_sents: Tensor, tgt_sents: Tensor,
+                      src_lengths: Tensor=None, predict: bool=False) -> Tuple[Tensor, Optional[List[List[int]]]]:
+        """
+        `forward` for a batch mixing the examples of several language pairs. The encoder params of
+        every distinct source language are generated once and its examples are encoded together, then
+        the decoder runs once for every distinct target language over all the examples translating
+        into it, whatever their source language. Every group is cut to the length of its longest
+        sentences, the scores and the predictions are returned in the order of the batch.
+
+        :param src_langs: the source language of every example, shape = [batch_size]
+        :param tgt_langs: the target language of every example, shape = [batch_size]
+        :return: see `forward`
+        """
+        batch_size, src_len = src_sents.shape
+        if src_lengths is None:
+            src_lengths = torch.full((batch_size,), src_len, dtype=torch.long)
+        # the lengths are only used to cut the groups, keep them on the host
+        src_lengths = src_lengths.cpu()
+        tgt_lengths = (tgt_sents != Vocab.PAD_ID).sum(dim=1).cpu()
+        src_sents = src_sents.to(device, non_blocking=True)
+        tgt_sents = tgt_sents.to(device, non_blocking=True)
+
+        # encode the examples of every source language with its own params
+        src_groups = self.lang_groups(src_langs)
+        outputs, h_t, c_t = [], [], []
+        for lang, rows in src_groups:
+            lengths = src_lengths if rows is None else src_lengths[rows]
+            group_len = int(lengths.max())
+            group_sents = src_sents if rows is None else src_sents.index_select(0, rows.to(device))
+            group_outputs, (group_h, group_c) = self.encode(group_sents[:, :group_len], lang,
+                                                            self.get_grouped_params(lang, None), lengths)
+            # pad the encodings back to the source length of the batch
+            outputs.append(F.pad(group_outputs, [0, 0, 0, src_len - group_len]))
+            h_t.append(group_h)
+            c_t.append(group_c)
+        # [batch_size, src_len, num_direction * hidden_size]
+        src_encodings = self.restore_order(src_groups, outputs)
+        # [num_layers, batch_size, num_direction * hidden_size]
+        h_t, c_t = self.restore_order(src_groups, h_t, dim=1), self.restore_order(src_groups, c_t, dim=1)
+
+        # decode the examples of every target language with its own params
+        tgt_groups = self.lang_groups(tgt_langs)
+        scores, predictions = [], []
+        for lang, rows in tgt_groups:
+            group_src_lengths = src_lengths if rows is None else src_lengths[rows]
+            group_src_len = int(group_src_lengths.max())
+            group_tgt_len = int((tgt_lengths if rows is None else tgt_lengths[rows]).max())
+            if rows is None:
+                group_encodings, group_h, group_c, group_tgt = src_encodings, h_t, c_t, tgt_sents
+            else:
+                rows = rows.to(device)
+                group_encodings = src_encodings.index_select(0, rows)
+                group_h, group_c = h_t.index_select(1, rows), c_t.index_select(1, rows)
+                group_tgt = tgt_sents.index_select(0, rows)
+            decoder = self.get_decoder(lang, self.get_grouped_params(None, lang))
+            group_scores, group_predictions = decoder(group_encodings[:, :group_src_len], (group_h, group_c),
+                                                      group_tgt[:, :group_tgt_len], group_src_lengths, predict)
+            scores.append(group_scores)
+            predictions.append(group_predictions)
+        scores = self.restore_order(tgt_groups, scores)
+
+        top_subwords = None
+        if predict:
+            order = [i for _, rows in tgt_groups for i in (range(batch_size) if rows is None else rows.tolist())]
+            top_subwords = [None] * batch_size
+            for i, sent in zip(order, (sent for group in predictions for sent in group)):
+                top_subwords[i] = sent
+        return scores, top_subwords
+
+    @staticmethod
+    def lang_groups(langs: Tensor) -> List[Tuple[int, Optional[Tensor]]]:
+        """
+        Groups the examples of a mixed batch by language
 
-    def get_grouped_params(self, src_lang: int, tgt_lang: int) -> List[List[Tensor]]:
-        # create a list of language indices corresponding each param group
+        :param langs: the language of every example, shape = [batch_size]
+        :return: the language and the (host) indices of the examples of every group, the indices are
+            None when the whole batch has the same language
+        """
+        langs = langs.cpu()
+        distinct = torch.unique(langs).tolist()
+        if len(distinct) == 1:
+            return [(distinct[0], None)]
+        return [(lang, (langs == lang).nonzero().view(-1)) for lang in distinct]
+
+    @staticmethod
+    def restore_order(groups: List[Tuple[int, Optional[Tensor]]], results: List[Tensor], dim: int=0) -> Tensor:
+        """
+        Concatenates the results of the groups made by `lang_groups` back into the order of the batch
+
+        :param groups: the groups the results were computed for
+        :param results: the result of each group
+        :param dim: the batch dimension of the results
+        """
+        if len(groups) == 1:
+            return results[0]
+        order = torch.cat([rows for _, rows in groups])
+        restore = torch.empty_like(order)
+        restore[order] = torch.arange(order.shape[0])
+        return torch.cat(results, dim=dim).index_select(dim, restore.to(device))
+
+    def get_grouped_params(self, src_lang: Optional[int], tgt_lang: Optional[int]) -> List[List[Tensor]]:
+        # create a list of language indices corresponding each param group, a None language leaves
+        # the params of that side out
         langs = [src_lang for _ in range(self.enc_shapes_len)] + [tgt_lang for _ in range(self.dec_shapes_len)]
         return self.cpg.get_params(langs)
 
-    def encode(self, batch_size: int, src_sent_idx: Tensor, src_lang: int, grouped_params: List[List[Tensor]]) \
-            -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+    def get_embedding(self, lang: int) -> nn.Embedding:
+        return self.cpg.get_embedding(lang)
+
+    def encode(self, src_sent_idx: Tensor, src_lang: int, grouped_params: List[List[Tensor]],
+               src_lengths: Tensor=None) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
         """
 
         :param src_sent_idx: source sentence word indices dim = (batch_size, sent_len)
         :param src_lang: source language index
         :param grouped_params: a list of groups of parameters in tensor form
+        :param src_lengths: optional source sentence lengths dim = (batch_size)
         :return: outputs: shape = [sent_length, batch_size, num_direction * hidden_size]
             h_t, c_t: shape = [num_layers, batch_size, num_direction * hidden_size]
         """
         enc_weights = grouped_params[:self.enc_shapes_len]
-        encoder = Encoder(batch_size, self.embed_size, self.hidden_size, self.cpg.get_embedding(src_lang),
-                          enc_weights, num_layer=self.num_layers)
-        return encoder(src_sent_idx)
+        self.encoder.set_weights(self.get_embedding(src_lang), enc_weights, fused=self.fused_lstm)
+        return self.encoder(src_sent_idx, src_lengths)
 
-    def get_decoder(self, tgt_lang: int, batch_size: int, grouped_params: List[List[Tensor]])\
-            -> Decoder:
+    def get_decoder(self, tgt_lang: int, grouped_params: List[List[Tensor]]) -> Decoder:
         dec_lstm_weights = grouped_params[self.enc_shapes_len:self.enc_shapes_len + self.dec_lstm_shapes_len]
         attn_weights = grouped_params[self.enc_shapes_len + self.dec_lstm_shapes_len:]
-        return Decoder(self.vocab_size, batch_size, self.embed_size, self.decoder_hidden_size, self.num_layers,
-                       self.cpg.get_embedding(tgt_lang), dec_lstm_weights, attn_weights)
+        self.decoder.set_weights(self.get_embedding(tgt_lang), dec_lstm_weights, attn_weights, fused=self.fused_lstm)
+        return self.decoder
 
     def beam_search(self, src_sent: List[int], src_lang: int, tgt_lang: int, beam_size: int=5,
-                    max_decoding_time_step: int=70) -> Tensor:
+                    max_decoding_time_step: int=70) -> List[Hypothesis]:
         """
         Takes in ONE src sentence with language tag, return the corresponding translation (word indices)
-        :param src_sent: batch_size of sentences
+        :param src_sent: the word indices of the src sentence
         :param src_lang: source language index
         :param tgt_lang: target language index
         :param beam_size: beam size
@@ -111,49 +245,197 @@ class MultiNMT(nn.Module):
                 value: List[int]: the decoded target sentence, represented as a list of word index
                 score: float: the log-likelihood of the target sentence
         """
+        return self.beam_search_batch([src_sent], src_lang, tgt_lang, beam_size, max_decoding_time_step)[0]
+
+    def beam_search_batch(self, src_sents: List[List[int]], src_lang: int, tgt_lang: int, beam_size: int=5,
+                          max_decoding_time_step: int=70) -> List[List[Hypothesis]]:
+        """
+        Beam search for a batch of src sentences of the same language pair at once. The params of the
+        pair are generated once, the sentences are encoded together and the beams of all the sentences
+        are fed through `decoder_step` as one batch of `batch_size * beam_size` rows, a sentence leaves
+        the batch as soon as all of its hypotheses end.
+        :param src_sents: the word indices of the src sentences
+        :param src_lang: source language index
+        :param tgt_lang: target language index
+        :param beam_size: beam size
+        :param max_decoding_time_step: maximum number of time steps to unroll the decoding RNN
+        :return: hypotheses: a list of beam_size hypotheses for each src sentence, see `beam_search`
+        """
+        return self.beam_search_multi(src_sents, src_lang, [tgt_lang], beam_size, max_decoding_time_step)[0]
+
+    def beam_search_multi(self, src_sents: List[List[int]], src_lang: int, tgt_langs: List[int], beam_size: int=5,
+                          max_decoding_time_step: int=70) -> List[List[List[Hypothesis]]]:
+        """
+        Beam search for a batch of src sentences into several target languages, the sentences are
+        encoded only once and the encodings are decoded into every target language in turn. An empty
+        src sentence has nothing to attend to, its translation is a single empty hypothesis.
+        :param src_sents: the word indices of the src sentences
+        :param src_lang: source language index
+        :param tgt_langs: target language indices
+        :return: hypotheses: for each target language, the hypotheses of every src sentence, see `beam_search_batch`
+        """
+        hypotheses = [[[Hypothesis([], 0.)] for _ in src_sents] for _ in tgt_langs]
+        rows = [i for i, sent in enumerate(src_sents) if len(sent) > 0]
+        if len(rows) == 0:
+            return hypotheses
+        src_encoding = self.encode_batch([src_sents[i] for i in rows], src_lang)
+        for tgt_hyps, tgt_lang in zip(hypotheses, tgt_langs):
+            for i, sent_hyps in zip(rows, self.beam_search_encoded(src_encoding, tgt_lang, beam_size,
+                                                                   max_decoding_time_step)):
+                tgt_hyps[i] = sent_hyps
+        return hypotheses
+
+    def encode_batch(self, src_sents: List[List[int]], src_lang: int) \
+            -> Tuple[Tensor, Tuple[Tensor, Tensor], Tensor]:
+        """
+        Encodes a batch of src sentences for `beam_search_encoded`, only the params of the source
+        language are generated
+        :param src_sents: the word indices of the src sentences
+        :param src_lang: source language index
+        :return: src_encodings of shape [batch_size, sent_length, num_direction * hidden_size],
+            the decoder initial state and the src lengths
+        """
         with torch.no_grad():
-            grouped_params = self.get_grouped_params(src_lang, tgt_lang)
             # [batch_size, sent_len]
-            src_sents_tensor = sents_to_tensor([src_sent], device)
-            # src_encodings.shape = [sent_length, 1, embed_size]
-            src_encodings, decoder_init_state = self.encode(1, src_sents_tensor, src_lang, grouped_params)
-            h_t_0, c_t_0, attn = Decoder.init_decoder_step_input(decoder_init_state)
-            # candidates for best hypotheses
-            hypotheses_cand = [(Hypothesis([Vocab.SOS_ID], 0), h_t_0, c_t_0, attn)]
-            decoder = self.get_decoder(tgt_lang, 1, grouped_params)
+            src_sents_tensor = sents_to_tensor(src_sents, device)
+            src_lengths = torch.tensor([len(sent) for sent in src_sents], dtype=torch.long, device=device)
+            src_encodings, decoder_init_state = self.encode(src_sents_tensor, src_lang,
+                                                            self.get_grouped_params(src_lang, None), src_lengths)
+            return src_encodings, decoder_init_state, src_lengths
+
+    def beam_search_encoded(self, src_encoding: Tuple[Tensor, Tuple[Tensor, Tensor], Tensor], tgt_lang: int,
+                            beam_size: int=5, max_decoding_time_step: int=70) -> List[List[Hypothesis]]:
+        """
+        Beam search of src sentences encoded by `encode_batch` into the target language, the
+        encodings are left untouched so that they can be decoded again into another language
+        :param src_encoding: the output of `encode_batch`
+        :param tgt_lang: target language index
+        :return: hypotheses: see `beam_search_batch`
+        """
+        with torch.no_grad():
+            src_encodings, decoder_init_state, src_lengths = src_encoding
+            batch_size = src_encodings.shape[0]
+            decoder = self.get_decoder(tgt_lang, self.get_grouped_params(None, tgt_lang))
+            h_t, c_t, attn = decoder.init_decoder_step_input(decoder_init_state)
+
+            # repeat every sentence beam_size times, row i * beam_size + j is hypothesis j of sentence i
+            beam_rows = torch.arange(batch_size, device=device).unsqueeze(1).expand(batch_size, beam_size).reshape(-1)
+            src_memory = decoder.source_memory(src_encodings, src_lengths).index_select(beam_rows)
+            h_t = [h.index_select(0, beam_rows) for h in h_t]
+            c_t = [c.index_select(0, beam_rows) for c in c_t]
+            attn = attn.index_select(0, beam_rows)
+            # only the first hypothesis of every sentence is alive at the beginning
+            beam_scores = torch.full((batch_size, beam_size), -float('inf'), device=device)
+            beam_scores[:, 0] = 0.
+            # dim = (active_num * beam_size, decoded_len)
+            hyp_words = torch.full((batch_size * beam_size, 1), Vocab.SOS_ID, dtype=torch.long, device=device)
+            # the sentences still in the batch
+            active = torch.arange(batch_size, device=device)
+            results = [None] * batch_size
+
             for i in range(max_decoding_time_step):
-                new_hypotheses_cand = []
-                for (sent, log_likelihood), h_t, c_t, attn in hypotheses_cand:
-                    input_word_idx = sent[-1]
-                    # skip ended sentence
-                    if input_word_idx == Vocab.EOS_ID:
-                        # directly add ended sentence to new candidates
-                        new_hypotheses_cand.append((Hypothesis(sent, log_likelihood), h_t, c_t, attn))
-                        continue
-                    # dim = (1 (single_word), embed_size)
-                    decoder_input = decoder.embedding(torch.tensor([input_word_idx]).to(device))
-                    assert_tensor_size(decoder_input, [1, self.embed_size])
-                    # softmax_output.shape = [1, vocab_size]
-                    h_t, c_t, softmax_output, attn = decoder.decoder_step(src_encodings, decoder_input, h_t, c_t, attn)
-                    # dim = (1, beam_size)
-                    _, top_i = torch.topk(softmax_output, beam_size, dim=1)
-                    for word_idx_tensor in top_i[0]:
-                        word_idx = word_idx_tensor.item()
-                        new_hyp = Hypothesis(sent + [word_idx], log_likelihood + float(softmax_output[0][word_idx]))
-                        new_hypotheses_cand.append((new_hyp, h_t, c_t, attn))
-                # combine ended sentences with new candidates to form new hypotheses
-                hypotheses_cand = sorted(new_hypotheses_cand, key=lambda x: x[0].score, reverse=True)[:beam_size]
-                # break if all sentences have ended
-                if all(c[0].value[-1] == Vocab.EOS_ID for c in hypotheses_cand):
+                active_num = beam_scores.shape[0]
+                input_word_idx = hyp_words[:, -1]
+                # dim = (active_num * beam_size, embed_size)
+                decoder_input = decoder.embedding(input_word_idx)
+                # softmax_output.shape = [active_num * beam_size, vocab_size]
+                h_t, c_t, softmax_output, attn = decoder.decoder_step(src_memory, decoder_input, h_t, c_t, attn)
+                # an ended hypothesis is carried over unchanged, as the only candidate of its row
+                ended = (input_word_idx == Vocab.EOS_ID).unsqueeze(1)
+                softmax_output = softmax_output.masked_fill(ended, -float('inf'))
+                softmax_output[:, Vocab.EOS_ID] = softmax_output[:, Vocab.EOS_ID].masked_fill(ended.squeeze(1), 0.)
+                # dim = (active_num, beam_size * vocab_size)
+                cand_scores = (beam_scores.view(-1, 1) + softmax_output).view(active_num, -1)
+                # dim = (active_num, beam_size)
+                beam_scores, top_i = torch.topk(cand_scores, beam_size, dim=1)
+                prev_beams = top_i // self.vocab_size
+                word_idx = top_i - prev_beams * self.vocab_size
+                # reorder the states w.r.t. the back pointers
+                rows = (torch.arange(active_num, device=device).unsqueeze(1) * beam_size + prev_beams).view(-1)
+                h_t = [h.index_select(0, rows) for h in h_t]
+                c_t = [c.index_select(0, rows) for c in c_t]
+                attn = attn.index_select(0, rows)
+                hyp_words = torch.cat((hyp_words.index_select(0, rows), word_idx.view(-1, 1)), dim=1)
+
+                # a sentence is finished when all of its hypotheses have ended
+                finished = (word_idx == Vocab.EOS_ID).all(dim=1)
+                if not bool(finished.any()):
+                    continue
+                for j in finished.nonzero().view(-1).tolist():
+                    results[int(active[j])] = (hyp_words[j * beam_size:(j + 1) * beam_size], beam_scores[j])
+                if bool(finished.all()):
                     break
-            return [c[0] for c in hypotheses_cand]
+                # drop the finished sentences from the batch
+                keep = (~finished).nonzero().view(-1)
+                keep_rows = (keep.unsqueeze(1) * beam_size + torch.arange(beam_size, device=device)).view(-1)
+                h_t = [h.index_select(0, keep_rows) for h in h_t]
+                c_t = [c.index_select(0, keep_rows) for c in c_t]
+                attn = attn.index_select(0, keep_rows)
+                hyp_words = hyp_words.index_select(0, keep_rows)
+                src_memory = src_memory.index_select(keep_rows)
+                beam_scores = beam_scores.index_select(0, keep)
+                active = active.index_select(0, keep)
+            else:
+                # reached the maximum decoding time step, return whatever is in the beams
+                for j, sent_idx in enumerate(active.tolist()):
+                    results[sent_idx] = (hyp_words[j * beam_size:(j + 1) * beam_size], beam_scores[j])
+
+            hypotheses = []
+            for sent_words, sent_scores in results:
+                sent_hyps = []
+                for sent, score in zip(sent_words.tolist(), sent_scores.tolist()):
+                    # ended hypotheses are padded with </s> after they end
+                    if Vocab.EOS_ID in sent:
+                        sent = sent[:sent.index(Vocab.EOS_ID) + 1]
+                    sent_hyps.append(Hypothesis(sent, score))
+                hypotheses.append(sent_hyps)
+            return hypotheses
+
+    def export_pair(self, src_lang: int, tgt_lang: int) -> 'PairNMT':
+        """
+        Materializes the params of a language pair into a fixed-weight model of only that pair
+        """
+        args = {'--embed-size': self.embed_size, '--hidden-size': self.hidden_size,
+                '--vocab-size': self.vocab_size, '--num-layers': self.num_layers, '--dropout': self.dropout_rate}
+        pair_model = PairNMT(args, src_lang, tgt_lang).to(self.cpg.L.weight.device)
+        with torch.no_grad():
+            grouped_params = self.get_grouped_params(src_lang, tgt_lang)
+            for params, generated_params in zip(pair_model.params, grouped_params):
+                for param, generated_param in zip(params, generated_params):
+                    param.copy_(generated_param)
+            pair_model.src_embedding.weight.copy_(self.get_embedding(src_lang).weight)
+            pair_model.tgt_embedding.weight.copy_(self.get_embedding(tgt_lang).weight)
+        return pair_model
+
+    def checkpoint(self, state_dict: Dict[str, Tensor]=None) -> Dict:
+        """
+        The args and the params `from_checkpoint` builds the model again from. The trainer passes a host
+        snapshot of the state_dict, so that the checkpoint can be written in the background
+        """
+        args = {'--embed-size': self.embed_size, '--hidden-size': self.hidden_size,
+                '--vocab-size': self.vocab_size, '--num-layers': self.num_layers, '--dropout': self.dropout_rate,
+                '--lang-embed-size': self.cpg.lang_embed_size, '--low-rank': self.cpg.low_rank}
+        return {'args': args, 'state_dict': self.state_dict() if state_dict is None else state_dict}
 
     def save(self, path: str):
-        torch.save(self, path)
+        torch.save(self.checkpoint(), path)
+
+    @staticmethod
+    def from_checkpoint(checkpoint: Dict) -> 'MultiNMT':
+        model = MultiNMT(checkpoint['args'])
+        model.load_state_dict(checkpoint['state_dict'])
+        return model
 
     @staticmethod
     def load(model_path: str):
-        return torch.load(model_path)
+        """
+        Loads a model saved by `save`, or a single pair model saved by `PairNMT.save`
+        """
+        model = torch.load(model_path)
+        # models saved before the checkpoints were pickled whole
+        if isinstance(model, dict):
+            model = PairNMT.from_checkpoint(model) if 'langs' in model else MultiNMT.from_checkpoint(model)
+        return model.to(device)
 
     @staticmethod
     def get_shapes_flstm(input_size, hidden_size, num_layers):
@@ -181,20 +463,87 @@ class MultiNMT(nn.Module):
 
         Returns:
             ppl: the perplexity on dev sentences
+            output: the greedy predictions of every dev sentence
+            all_tgt_sents: the reference of every dev sentence
+            tgt_langs: the target language of every dev sentence
         """
         cum_loss = 0.
         cum_tgt_words = 0.
         output = []
         all_tgt_sents = []
+        tgt_langs = []
         with torch.no_grad():
-            for src_lang, tgt_lang, src_sents, tgt_sents in batch_iter(dev_data, batch_size):
-                loss, best_sents = self(src_lang, tgt_lang, src_sents, tgt_sents)
+            for batch in batch_iter(dev_data, batch_size):
+                loss, best_sents = self(batch.src_lang, batch.tgt_lang, batch.src_sents, batch.tgt_sents,
+                                        batch.src_lengths, predict=True)
                 output += best_sents
-                all_tgt_sents += tgt_sents
+                # a batch mixing the pairs has the target language of every example
+                tgt_langs += batch.tgt_lang.tolist() if torch.is_tensor(batch.tgt_lang) else \
+                    [batch.tgt_lang] * len(best_sents)
+                all_tgt_sents += [sent[:length] for sent, length in
+                                  zip(batch.tgt_sents.tolist(), batch.tgt_lengths.tolist())]
                 cum_loss += loss.sum()
-                tgt_word_num_to_predict = sum(len(s[1:]) for s in tgt_sents)  # omitting the leading `<s>`
+                tgt_word_num_to_predict = int((batch.tgt_lengths - 1).sum())  # omitting the leading `<s>`
                 cum_tgt_words += tgt_word_num_to_predict
 
             ppl = np.exp(cum_loss / cum_tgt_words)
 
-            return ppl, output, all_tgt_sents
+            return ppl, output, all_tgt_sents, tgt_langs
+
+
+class PairNMT(MultiNMT):
+    """
+    The model of a single language pair with the params generated by the CPG fixed, it keeps
+    neither the CPG nor the embeddings of the other languages
+    """
+    def __init__(self, args: Dict[str, str], src_lang: int, tgt_lang: int):
+        super(PairNMT, self).__init__(args)
+        self.args = args
+        self.src_lang = src_lang
+        self.tgt_lang = tgt_lang
+
+    def init_params(self, args: Dict[str, str]):
+        """
+        Creates the fixed params and the embeddings of the pair, their values are set by
+        `MultiNMT.export_pair` or loaded from a checkpoint
+        """
+        self.params = nn.ModuleList([nn.ParameterList([nn.Parameter(torch.empty(shape), requires_grad=False)
+                                                       for shape in group])
+                                     for group in self.param_shapes])
+        self.src_embedding = nn.Embedding(self.vocab_size, self.embed_size)
+        self.tgt_embedding = nn.Embedding(self.vocab_size, self.embed_size)
+
+    def get_grouped_params(self, src_lang: Optional[int], tgt_lang: Optional[int]) -> List[List[Tensor]]:
+        assert src_lang in (None, self.src_lang) and tgt_lang in (None, self.tgt_lang), \
+            'the model only translates %s to %s' % (LANG_NAMES[self.src_lang], LANG_NAMES[self.tgt_lang])
+        return [list(params) for params in self.params]
+
+    def get_embedding(self, lang: int) -> nn.Embedding:
+        if lang == self.src_lang:
+            return self.src_embedding
+        if lang == self.tgt_lang:
+            return self.tgt_embedding
+        raise ValueError('the model only translates %s to %s' % (LANG_NAMES[self.src_lang], LANG_NAMES[self.tgt_lang]))
+
+    def export_pair(self, src_lang: int, tgt_lang: int) -> 'PairNMT':
+        """
+        The model is already the fixed-weight model of its pair
+        """
+        if (src_lang, tgt_lang) != (self.src_lang, self.tgt_lang):
+            raise ValueError('the model only translates %s to %s' % (LANG_NAMES[self.src_lang],
+                                                                     LANG_NAMES[self.tgt_lang]))
+        return self
+
+    def checkpoint(self, state_dict: Dict[str, Tensor]=None) -> Dict:
+        checkpoint = {
+            'args': self.args,
+            'langs': (self.src_lang, self.tgt_lang),
+            'state_dict': self.state_dict() if state_dict is None else state_dict
+        }
+        return checkpoint
+
+    @staticmethod
+    def from_checkpoint(checkpoint: Dict) -> 'PairNMT':
+        model = PairNMT(checkpoint['args'], *checkpoint['langs'])
+        model.load_state_dict(checkpoint['state_dict'])
+        return model
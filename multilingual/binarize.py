@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Encode the parallel corpora data/<data-type>.<tgt>-<src>.<lang>.txt with the subword models once,
+in parallel processes. Every corpus is stored next to its text file as one flat int32 array of the
+subword indices plus the sentence offsets, and data/binarized.json records the hashes of the text
+files and subword models they were made from. nmt.py then memory-maps the binarized corpora that
+are up to date instead of encoding the text files again. Corpora that did not change are skipped.
+
+Usage:
+    binarize.py [options]
+
+Options:
+    -h --help                  Show this screen.
+    --data-types=<types>       comma separated data types to binarize [default: train,dev]
+    --workers=<int>            number of processes encoding the corpora [default: 4]
+"""
+import json
+import os
+import re
+from multiprocessing import Pool
+
+from docopt import docopt
+
+from config import LANG_INDICES
+from subword import MANIFEST_PATH, binarize_corpus, is_binarized, load_manifest
+
+
+def find_corpora(data_types):
+    corpora = []
+    for file_name in sorted(os.listdir('data')):
+        match = re.match(r'^(\w+)\.(\w+)-(\w+)\.(\w+)\.txt$', file_name)
+        if match is None:
+            continue
+        data_type, tgt_lang, src_lang, lang = match.groups()
+        if data_type in data_types and all(l in LANG_INDICES for l in (tgt_lang, src_lang)):
+            corpora.append(('data/' + file_name, lang, lang == tgt_lang))
+    return corpora
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    manifest = load_manifest()
+    corpora = [corpus for corpus in find_corpora(args['--data-types'].split(','))
+               if not is_binarized(manifest, corpus[0], corpus[1])]
+    print('binarizing %d corpora' % len(corpora))
+
+    with Pool(int(args['--workers'])) as pool:
+        entries = pool.starmap(binarize_corpus, corpora)
+
+    for (file_path, _, _), entry in zip(corpora, entries):
+        manifest[file_path] = entry
+        print('%s: %d sentences, %d subwords' % (file_path, entry['sents'], entry['tokens']))
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
@@ -6,6 +6,7 @@ A very basic implementation of neural machine translation
 Usage:
     nmt.py train --vocab-size=<int> [options]
     nmt.py decode [options] MODEL_PATH SRC_LANG TGT_LANG OUTPUT_FILE
+    nmt.py export [options] MODEL_PATH SRC_LANG TGT_LANG EXPORT_PATH
 
 Options:
     -h --help                               show this screen.
@@ -15,6 +16,13 @@ Options:
     --low-rank=<int>                        low rank size [default: 4]
     --seed=<int>                            seed [default: 0]
     --batch-size=<int>                      batch size [default: 32]
+    --batch-tokens=<int>                    build batches of up to this many source or target tokens (padding
+                                            included) instead of --batch-size sentences
+    --mix-pairs                             build batches mixing the examples of all the language pairs
+    --pair-temperature=<float>              sample the language pair of every batch with probability proportional
+                                            to its size ** (1 / T), 1 follows the data and larger values move
+                                            towards uniform. Otherwise every batch is trained on once an epoch.
+                                            Not with --mix-pairs, whose batches hold every pair
     --lang-embed-size=<int>                 language embedding size [default: 8]
     --embed-size=<int>                      word embedding size [default: 256]
     --num-layers=<int>                      number of layers [default: 2]
@@ -30,12 +38,26 @@ Options:
     --uniform-init=<float>                  uniformly initialize all parameters [default: 0.1]
     --save-to=<file>                        model save path
     --save-opt=<file>                       optimizer state save path
+    --save-state=<file>                     path of the resumable training state (model, optimizer, RNG states and
+                                            position in the data), written in the background
+    --state-every=<int>                     write the training state after how many iterations [default: 1000]
+    --resume                                resume the training from the state at --save-state
+    --best-fp16                             keep the in-memory copy of the best model, restored when the learning
+                                            rate decays, in fp16
     --valid-niter=<int>                     perform validation after how many iterations [default: 2000]
+    --data-workers=<int>                    number of background threads preparing batches [default: 2]
+    --prefetch-batches=<int>                number of batches prepared ahead of training [default: 8]
     --dropout=<float>                       dropout [default: 0]
+    --fused-lstm                            run the LSTMs with the generated weights on PyTorch's fused LSTM
+                                            kernels instead of FLSTM
     --max-decoding-time-step=<int>          maximum number of decoding time steps [default: 70]
+    --decode-batch-size=<int>               number of sentences decoded together [default: 32]
+    --test-src=<file>                       decode the sentences of this file instead of the source side of the
+                                            test data of SRC_LANG and the (first) TGT_LANG
 """
 
 import math
+import os
 import sys
 import time
 from typing import *
@@ -45,12 +67,12 @@ import torch
 from docopt import docopt
 from nltk.translate.bleu_score import corpus_bleu
 from tqdm import tqdm
-import sentencepiece as spm
 
 from MultiMT import Hypothesis, MultiNMT
 from config import device, LANG_INDICES, LANG_NAMES
-from subword import get_corpus_pairs, get_corpus_ids, decode_corpus_ids, decode_sent_ids
-from utils import batch_iter, PairedData, LangPair, read_corpus
+from subword import get_corpus_pairs, get_corpus_ids, get_file_ids, decode_corpus_ids, decode_sent_ids
+from utils import batch_iter, PairedData, PairedDataBatch, MixedDataBatch, LangPair, BatchPrefetcher, \
+    PairThroughput, CheckpointWriter, BestState, snapshot, get_rng_state, set_rng_state, read_corpus
 
 
 def compute_corpus_level_bleu_score(references: List[List[str]], hypotheses: List[Hypothesis]) -> float:
@@ -78,6 +100,7 @@ def get_data_pairs(langs: List[List[str]], data_type: str):
     for src_name, tgt_name in langs:
         src = LANG_INDICES[src_name]
         tgt = LANG_INDICES[tgt_name]
+        # the corpora binarized by binarize.py are memory-mapped, the others are encoded here
         data_pair = get_corpus_pairs(src, tgt, data_type)
         data.append(PairedData(data_pair, LangPair(src, tgt)))
         print('Done loading %s data for %s-%s parallel translation' \
@@ -86,21 +109,33 @@ def get_data_pairs(langs: List[List[str]], data_type: str):
 
 
 def train(args: Dict[str, str]):
+    if args['--resume'] and not args['--save-state']:
+        raise RuntimeError('--resume needs --save-state, the path of the training state to resume from')
+    if not args['--save-to'] or not args['--save-opt']:
+        raise RuntimeError('--save-to and --save-opt are needed, the best model and its optimizer state are written '
+                           'there and read back by --resume')
+    if args['--pair-temperature'] and args['--mix-pairs']:
+        raise RuntimeError('--pair-temperature samples one language pair per batch, it cannot be used with --mix-pairs')
     lang_pairs = args['--langs']
     langs = [p.split('-') for p in lang_pairs.split(',')]
     train_data = get_data_pairs(langs, 'train')
     dev_data = get_data_pairs(langs, 'dev')
 
     train_batch_size = int(args['--batch-size'])
+    train_batch_tokens = int(args['--batch-tokens']) if args['--batch-tokens'] else None
+    pair_temperature = float(args['--pair-temperature']) if args['--pair-temperature'] else None
     clip_grad = float(args['--clip-grad'])
     valid_niter = int(args['--valid-niter'])
     log_every = int(args['--log-every'])
     model_save_path = args['--save-to']
     optimizer_save_path = args['--save-opt']
+    state_path = args['--save-state']
+    state_every = int(args['--state-every'])
 
     # initialize the model
     print('Model initializing...')
     model = MultiNMT(args).to(device)
+    model.fused_lstm = args['--fused-lstm']
 
     num_trial = 0
     train_iter = patience = cum_loss = report_loss = cumulative_tgt_words = report_tgt_words = 0
@@ -116,29 +151,70 @@ def train(args: Dict[str, str]):
         print(type(param.data), param.size())
     optimizer = torch.optim.Adam(model.parameters(), lr=lr, amsgrad=True)
 
-    # TODO: [remove this] temporaily save inited model for testing
-    model.save(model_save_path)
-    print('save currently the best model to [%s]' % model_save_path)
-    sps = []
-    sp = spm.SentencePieceProcessor()
-    for i in range(len(LANG_NAMES)):
-        sp.Load('subword_files/%s.model' % LANG_NAMES[i])
-        sps.append(sp)
+    checkpoint_writer = CheckpointWriter()
+    # the best model and optimizer so far, the learning rate decay restores them from memory
+    best_state = BestState(half=args['--best-fp16'])
+    # the order of the training batches has its own RNG, so that an interrupted epoch can be replayed
+    data_rng = np.random.RandomState(np.random.randint(2 ** 31 - 1))
+    # the position in the interrupted epoch
+    resume_epoch_iter = 0
+    if args['--resume']:
+        print('resume training from [%s]' % state_path)
+        state = torch.load(state_path)
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        trainer = state['trainer']
+        # the epoch is counted again when it begins
+        epoch = trainer['epoch'] - 1
+        train_iter, patience, num_trial, valid_num, lr = \
+            trainer['train_iter'], trainer['patience'], trainer['num_trial'], trainer['valid_num'], trainer['lr']
+        hist_valid_scores = trainer['hist_valid_scores']
+        cum_loss, cumulative_tgt_words, cumulative_examples = \
+            trainer['cum_loss'], trainer['cumulative_tgt_words'], trainer['cumulative_examples']
+        resume_epoch_iter = trainer['epoch_iter']
+        # the best model so far is only on the disk after a restart, it is loaded before the RNGs are
+        # restored, since building the model draws its initial params
+        if os.path.exists(optimizer_save_path):
+            best_state.update(snapshot(MultiNMT.load(model_save_path).state_dict()),
+                              snapshot(torch.load(optimizer_save_path)))
+        data_rng.set_state(state['data_rng'])
+        set_rng_state(state['rng'])
+    else:
+        # TODO: [remove this] temporaily save inited model for testing
+        model.save(model_save_path)
+        print('save currently the best model to [%s]' % model_save_path)
+    # bucket the training data once, every epoch only shuffles the order of the batches
+    mix_pairs = args['--mix-pairs']
+    if mix_pairs:
+        train_pairs = [MixedDataBatch(train_data, train_batch_size, train_batch_tokens)]
+    else:
+        train_pairs = [PairedDataBatch(i, pd, train_batch_size, train_batch_tokens)
+                       for i, pd in enumerate(train_data)]
+    prefetcher = BatchPrefetcher(num_workers=int(args['--data-workers']), prefetch=int(args['--prefetch-batches']),
+                                 pin_memory=torch.cuda.is_available())
+    pair_throughput = PairThroughput()
 
     while True:
         epoch += 1
+        # the batch order of the epoch is drawn from this state, an interrupted epoch skips the batches done
+        epoch_rng = data_rng.get_state()
+        epoch_iter = resume_epoch_iter
 
-        for src_lang, tgt_lang, src_sents, tgt_sents in batch_iter(train_data, batch_size=train_batch_size):
+        for batch in batch_iter(train_data, batch_size=train_batch_size, pairs=train_pairs, prefetcher=prefetcher,
+                                temperature=pair_temperature, skip=resume_epoch_iter, rng=data_rng):
             train_iter += 1
-            batch_size = len(src_sents)
+            epoch_iter += 1
+            src_lang, tgt_lang = batch.src_lang, batch.tgt_lang
+            batch_size = batch.src_sents.shape[0]
 
             if train_iter % 5 == 0:
                 print("#", end="", flush=True)
 
             # start training routine
             #torch.cuda.empty_cache()
+            step_start = time.time()
             optimizer.zero_grad()
-            loss_v, _ = model(src_lang, tgt_lang, src_sents, tgt_sents)
+            loss_v, _ = model(src_lang, tgt_lang, batch.src_sents, batch.tgt_sents, batch.src_lengths)
             loss = torch.sum(loss_v)
             loss.backward()
             torch.nn.utils.clip_grad_norm(model.parameters(), clip_grad)
@@ -147,8 +223,9 @@ def train(args: Dict[str, str]):
             report_loss += float(loss)
             cum_loss += float(loss)
             del loss
+            pair_throughput.update(batch, time.time() - step_start)
             with torch.no_grad():
-                tgt_words_num_to_predict = sum(len(s[1:]) for s in tgt_sents)  # omitting leading `<s>`
+                tgt_words_num_to_predict = int((batch.tgt_lengths - 1).sum())  # omitting leading `<s>`
                 report_tgt_words += tgt_words_num_to_predict
                 cumulative_tgt_words += tgt_words_num_to_predict
                 report_examples += batch_size
@@ -156,12 +233,16 @@ def train(args: Dict[str, str]):
 
                 if train_iter % log_every == 0:
                     print('epoch %d, iter %d, avg. loss %.2f, avg. ppl %.2f '
-                          'cum. examples %d, speed %.2f words/sec, time elapsed %.2f sec' %
+                          'cum. examples %d, speed %.2f words/sec, time elapsed %.2f sec, waiting for data %.2f%%' %
                           (epoch, train_iter, report_loss / report_examples, math.exp(report_loss / report_tgt_words),
-                           cumulative_examples, report_tgt_words / (time.time() - train_time), time.time() - begin_time),
+                           cumulative_examples, report_tgt_words / (time.time() - train_time), time.time() - begin_time,
+                           100. * prefetcher.wait_time / (time.time() - train_time)),
                           flush=True)
+                    print('per pair: %s' % pair_throughput.report(), flush=True)
 
                     train_time = time.time()
+                    prefetcher.wait_time = 0.
+                    pair_throughput.reset()
                     report_loss = report_tgt_words = report_examples = 0.
 
                 # the following code performs validation on dev set, and controls the learning schedule
@@ -184,13 +265,12 @@ def train(args: Dict[str, str]):
                     model.eval()
                     # compute dev. ppl and bleu
                     # dev batch size can be a bit larger
-                    dev_ppl, output, tgt_sents = model.evaluate_ppl(dev_data, batch_size=128)
-                    dev_data_src, _ = get_corpus_ids(src_lang, tgt_lang, data_type='dev', is_tgt=False, is_train=False)
-                    top_hypotheses = [Hypothesis(sps[tgt_lang].DecodeIds(sent).split(' '), 1)
-                                      for sent in output]
+                    dev_ppl, output, tgt_sents, tgt_langs = model.evaluate_ppl(dev_data, batch_size=128)
+                    # the sentences of every dev pair are decoded with the subword model of its target language
+                    top_hypotheses = [Hypothesis(sent.split(' '), 1) for sent in decode_by_lang(output, tgt_langs)]
                     bleu_score = \
-                        compute_corpus_level_bleu_score([sps[tgt_lang].DecodeIds(sent).split(' ')
-                                                         for sent in tgt_sents], top_hypotheses)
+                        compute_corpus_level_bleu_score([sent.split(' ') for sent in
+                                                         decode_by_lang(tgt_sents, tgt_langs)], top_hypotheses)
                     print(f'################ Corpus BLEU: {bleu_score} ###########################')
                     # set model back to training mode
                     model.train()
@@ -204,8 +284,12 @@ def train(args: Dict[str, str]):
                     if is_better:
                         patience = 0
                         print('save currently the best model to [%s]' % model_save_path)
-                        model.save(model_save_path)
-                        torch.save(optimizer, optimizer_save_path)
+                        # one host copy of the states is kept for the patience reload and written in the background
+                        model_state = snapshot(model.state_dict())
+                        optimizer_state = snapshot(optimizer.state_dict())
+                        best_state.update(model_state, optimizer_state)
+                        checkpoint_writer.write_all([(model.checkpoint(model_state), model_save_path),
+                                                     (optimizer_state, optimizer_save_path)], copy=False)
 
                     elif patience < int(args['--patience']):
                         patience += 1
@@ -218,9 +302,8 @@ def train(args: Dict[str, str]):
                                 print('early stop!')
                                 exit(0)
 
-                            # load model
-                            model = model.load(model_save_path)
-                            optimizer = torch.load(optimizer_save_path)
+                            # load model, in place so that the optimizer keeps the parameters of the model
+                            best_state.restore(model, optimizer)
 
                             # decay learning rate, and restore from previously best checkpoint
                             lr = lr * float(args['--lr-decay'])
@@ -235,15 +318,59 @@ def train(args: Dict[str, str]):
                         print('reached maximum number of epochs!')
                         exit(0)
 
+            if state_path and train_iter % state_every == 0:
+                checkpoint_writer.write({
+                    'model': model.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'rng': get_rng_state(),
+                    'data_rng': epoch_rng,
+                    'trainer': {'epoch': epoch, 'epoch_iter': epoch_iter, 'train_iter': train_iter,
+                                'patience': patience, 'num_trial': num_trial, 'valid_num': valid_num, 'lr': lr,
+                                'hist_valid_scores': hist_valid_scores, 'cum_loss': cum_loss,
+                                'cumulative_tgt_words': cumulative_tgt_words,
+                                'cumulative_examples': cumulative_examples}
+                }, state_path)
+
+        resume_epoch_iter = 0
+
+
+def decode_by_lang(sents: List[List[int]], langs: List[int]) -> List[str]:
+    """
+    Decodes the subword indices of every sentence with the subword model of its language
+    """
+    decoded = [None] * len(sents)
+    for lang in set(langs):
+        rows = [i for i, sent_lang in enumerate(langs) if sent_lang == lang]
+        for i, sent in zip(rows, decode_corpus_ids(LANG_NAMES[lang], [sents[i] for i in rows])):
+            decoded[i] = sent
+    return decoded
 
-def beam_search(model: MultiNMT, test_data_src: List[List[int]], src_lang: int, tgt_lang: int, \
-                beam_size: int, max_decoding_time_step: int) -> List[List[Hypothesis]]:
-    hypotheses = []
-    for src_sent in tqdm(test_data_src, desc='Decoding', file=sys.stdout):
-        example_hyps = model.beam_search(src_sent, src_lang, tgt_lang, beam_size=beam_size,
-                                         max_decoding_time_step=max_decoding_time_step)
 
-        hypotheses.append(example_hyps)
+def beam_search(model: MultiNMT, test_data_src: List[List[int]], src_lang: int, tgt_lang: int,
+                beam_size: int, max_decoding_time_step: int, batch_size: int=32) -> List[List[Hypothesis]]:
+    return beam_search_multi(model, test_data_src, src_lang, [tgt_lang], beam_size, max_decoding_time_step,
+                             batch_size)[0]
+
+
+def beam_search_multi(model: MultiNMT, test_data_src: List[List[int]], src_lang: int, tgt_langs: List[int],
+                      beam_size: int, max_decoding_time_step: int, batch_size: int=32) \
+        -> List[List[List[Hypothesis]]]:
+    """
+    translates the sentences into every target language, each batch is encoded once for all of them
+    """
+    # decode sentences of similar length together to keep the padding in each batch small
+    order = sorted(range(len(test_data_src)), key=lambda i: len(test_data_src[i]), reverse=True)
+    hypotheses = [[None] * len(test_data_src) for _ in tgt_langs]
+    with tqdm(total=len(test_data_src), desc='Decoding', file=sys.stdout) as pbar:
+        for i in range(0, len(order), batch_size):
+            batch_indices = order[i: i + batch_size]
+            batch_hyps = model.beam_search_multi([test_data_src[idx] for idx in batch_indices], src_lang, tgt_langs,
+                                                 beam_size=beam_size,
+                                                 max_decoding_time_step=max_decoding_time_step)
+            for tgt_hyps, tgt_batch_hyps in zip(hypotheses, batch_hyps):
+                for idx, example_hyps in zip(batch_indices, tgt_batch_hyps):
+                    tgt_hyps[idx] = example_hyps
+            pbar.update(len(batch_indices))
 
     return hypotheses
 
@@ -273,35 +400,64 @@ def decode(args: Dict[str, str]):
     performs decoding on a test set, and save the best-scoring decoding results.
     If the target gold-standard sentences are given, the function also computes
     corpus-level BLEU score.
+    TGT_LANG can be a comma separated list of languages, the source sentences are then encoded once
+    and the translations into each language are written to OUTPUT_FILE.<lang>
     """
 
     src_lang = args['SRC_LANG']
-    tgt_lang = args['TGT_LANG']
+    tgt_langs = args['TGT_LANG'].split(',')
     src_lang_idx = LANG_INDICES[src_lang]
-    tgt_lang_idx = LANG_INDICES[tgt_lang]
+    tgt_lang_indices = [LANG_INDICES[tgt_lang] for tgt_lang in tgt_langs]
 
     model_path = args['MODEL_PATH']
     output_file = args['OUTPUT_FILE']
 
-    test_data_src, _ = get_corpus_ids(src_lang_idx, tgt_lang_idx, data_type='test', is_tgt=False, is_train=False)
+    if args['--test-src']:
+        test_data_src = get_file_ids(src_lang, args['--test-src'])
+    else:
+        test_data_src, _ = get_corpus_ids(src_lang_idx, tgt_lang_indices[0], data_type='test', is_tgt=False,
+                                          is_train=False)
     # test_data_tgt = get_corpus_ids(src_lang_idx, tgt_lang_idx, data_type='test', is_tgt=True)
 
     print(f"load model from {model_path}")
     model = MultiNMT.load(model_path)
+    model.fused_lstm = args['--fused-lstm']
 
     # set model to evaluate mode
     model.eval()
 
-    hypotheses = beam_search(model, test_data_src, src_lang_idx, tgt_lang_idx,
-                             beam_size=int(args['--beam-size']),
-                             max_decoding_time_step=int(args['--max-decoding-time-step']))
+    hypotheses = beam_search_multi(model, test_data_src, src_lang_idx, tgt_lang_indices,
+                                   beam_size=int(args['--beam-size']),
+                                   max_decoding_time_step=int(args['--max-decoding-time-step']),
+                                   batch_size=int(args['--decode-batch-size']))
+
+    for tgt_lang, tgt_hypotheses in zip(tgt_langs, hypotheses):
+        top_hypotheses = [hyps[0].value for hyps in tgt_hypotheses]
+        translated_text = decode_corpus_ids(lang_name=tgt_lang, sents=top_hypotheses)
+
+        tgt_output_file = output_file if len(tgt_langs) == 1 else '%s.%s' % (output_file, tgt_lang)
+        with open(tgt_output_file, 'w') as f:
+            for sent in translated_text:
+                f.write(sent + '\n')
+
+
+def export(args: Dict[str, str]):
+    """
+    writes a model of a single language pair, with the params generated by the CPG fixed and only the
+    embeddings of the two languages kept. The exported model can be given to decode as MODEL_PATH.
+    """
+    src_lang = args['SRC_LANG']
+    tgt_lang = args['TGT_LANG']
+    src_lang_idx = LANG_INDICES[src_lang]
+    tgt_lang_idx = LANG_INDICES[tgt_lang]
 
-    top_hypotheses = [hyps[0].value for hyps in hypotheses]
-    translated_text = decode_corpus_ids(lang_name=tgt_lang, sents=top_hypotheses)
+    print(f"load model from {args['MODEL_PATH']}")
+    model = MultiNMT.load(args['MODEL_PATH'])
+    model.eval()
 
-    with open(output_file, 'w') as f:
-        for sent in translated_text:
-            f.write(sent + '\n')
+    pair_model = model.export_pair(src_lang_idx, tgt_lang_idx)
+    pair_model.save(args['EXPORT_PATH'])
+    print(f"export {src_lang}-{tgt_lang} model to {args['EXPORT_PATH']}")
 
 
 def main():
@@ -317,6 +473,8 @@ def main():
         train(args)
     elif args['decode']:
         decode(args)
+    elif args['export']:
+        export(args)
     else:
         raise RuntimeError(f'invalid mode')
 
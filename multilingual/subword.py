@@ -11,20 +11,135 @@ Options:
     --lang=<lang-abbr>         Two letter representation of language
     --vocab-size=<file>        The vocabulary size for subword model
 """
-from typing import List, Tuple, Set
+import hashlib
+import json
+import os
+import threading
+from typing import List, Tuple, Set, Dict, Optional, Union
 
+import numpy as np
 import sentencepiece as spm
 from docopt import docopt
 from config import LANG_NAMES
+from utils import NumericCorpus, CorpusPairs
+
+# the binarized corpora written by binarize.py, with the hashes of the files they were made from
+MANIFEST_PATH = 'data/binarized.json'
+# source sentences of more words are left out of the training pairs
+MAX_SRC_WORDS = 50
+
+# the subword models loaded so far by language, see `load_sp`
+_sps = {}
+_sps_lock = threading.Lock()
 
 
 def train(lang, vocab_size):
     spm.SentencePieceTrainer. \
         Train('--pad_id=3 --input=data/%s_mono.txt --model_prefix=subword_files/%s --vocab_size=%d' % (lang, lang, vocab_size))
+    # the new model is loaded by the next `load_sp`
+    with _sps_lock:
+        _sps.pop(lang, None)
+
+
+def load_sp(lang_name: str) -> spm.SentencePieceProcessor:
+    """
+    The subword model of a language, every model is loaded once per process by the first call for
+    its language. Safe to call from several threads.
+    """
+    sp = _sps.get(lang_name)
+    if sp is None:
+        with _sps_lock:
+            if lang_name not in _sps:
+                sp = spm.SentencePieceProcessor()
+                sp.Load('subword_files/%s.model' % lang_name)
+                _sps[lang_name] = sp
+            sp = _sps[lang_name]
+    return sp
+
+
+def encode_sents(lang_name: str, sents: List[str]) -> List[List[int]]:
+    sp = load_sp(lang_name)
+    return [sp.EncodeAsIds(sent) for sent in sents]
+
+
+def decode_sents(lang_name: str, sents: List[List[int]]) -> List[str]:
+    sp = load_sp(lang_name)
+    return [sp.DecodeIds(sent) for sent in sents]
+
+
+def corpus_path(src_lang: str, tgt_lang: str, data_type: str, lang: str) -> str:
+    return 'data/%s.%s-%s.%s.txt' % (data_type, tgt_lang, src_lang, lang)
+
+
+def file_hash(file_path: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def binarize_corpus(file_path: str, lang: str, is_tgt: bool) -> Dict[str, Union[str, int]]:
+    """
+    Encodes a corpus into a NumericCorpus saved next to the text file, together with the number of
+    words of every line in <file_path>.words.npy. Target sentences get <s> and </s>.
+
+    Returns:
+        the manifest entry of the corpus, see `load_binarized`
+    """
+    sp = load_sp(lang)
+    lines = [line.strip() for line in open(file_path, encoding="utf-8")]
+    words = [len(sent.split(' ')) for sent in lines]
+    sents = encode_sents(lang, lines)
+    if is_tgt:
+        sents = [[sp.bos_id()] + sent + [sp.eos_id()] for sent in sents]
+    corpus = NumericCorpus.from_sents(sents)
+    corpus.save(file_path)
+    np.save(file_path + '.words.npy', np.array(words, dtype=np.int32))
+    return {'text_hash': file_hash(file_path), 'model_hash': file_hash('subword_files/%s.model' % lang),
+            'is_tgt': is_tgt, 'sents': len(corpus), 'tokens': len(corpus.ids)}
+
+
+def load_manifest() -> Dict[str, Dict]:
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH) as f:
+        return json.load(f)
+
+
+def is_binarized(manifest: Dict[str, Dict], file_path: str, lang: str) -> bool:
+    """
+    Whether the binarized corpus is there and was made from the current text file and subword model
+    """
+    entry = manifest.get(file_path)
+    return entry is not None and os.path.exists(file_path + '.ids.npy') and \
+        entry['text_hash'] == file_hash(file_path) and \
+        entry['model_hash'] == file_hash('subword_files/%s.model' % lang)
+
+
+def load_binarized(manifest: Dict[str, Dict], file_path: str, lang: str) -> Optional[NumericCorpus]:
+    """
+    Memory-maps the binarized corpus of a text file, None if it is missing or out of date
+    """
+    if not is_binarized(manifest, file_path, lang):
+        return None
+    return NumericCorpus.load(file_path)
 
 
 def get_corpus_pairs(src_lang_idx: int, tgt_lang_idx: int, data_type: str) \
-        -> List[Tuple[List[int], List[int]]]:
+        -> Union[List[Tuple[List[int], List[int]]], CorpusPairs]:
+    # corpora binarized by binarize.py are memory-mapped instead of encoded again
+    src_lang = LANG_NAMES[src_lang_idx]
+    tgt_lang = LANG_NAMES[tgt_lang_idx]
+    manifest = load_manifest()
+    src_path = corpus_path(src_lang, tgt_lang, data_type, src_lang)
+    tgt_path = corpus_path(src_lang, tgt_lang, data_type, tgt_lang)
+    src_corpus = load_binarized(manifest, src_path, src_lang)
+    tgt_corpus = load_binarized(manifest, tgt_path, tgt_lang)
+    if src_corpus is not None and tgt_corpus is not None:
+        src_words = np.load(src_path + '.words.npy')
+        return CorpusPairs(src_corpus, tgt_corpus, np.nonzero(src_words <= MAX_SRC_WORDS)[0])
+
     # get src and tgt corpus ids separately
     src_sents, long_sent = get_corpus_ids(src_lang_idx, tgt_lang_idx, data_type, False)
     tgt_sents, _ = get_corpus_ids(src_lang_idx, tgt_lang_idx, data_type, True, long_sent=long_sent)
@@ -37,20 +152,18 @@ def get_corpus_pairs(src_lang_idx: int, tgt_lang_idx: int, data_type: str) \
 
 def get_corpus_ids(src_lang_idx: int, tgt_lang_idx: int, data_type: str, is_tgt: bool, is_train=True, long_sent=None)\
         -> Tuple[List[List[int]], Set[int]]:
-    sents = []
-
     src_lang = LANG_NAMES[src_lang_idx]
     tgt_lang = LANG_NAMES[tgt_lang_idx]
     lang = tgt_lang if is_tgt else src_lang
 
     # load the subword models for encoding these sents to indices
-    sp = spm.SentencePieceProcessor()
-    sp.Load('subword_files/%s.model' % lang)
+    sp = load_sp(lang)
 
     # read corpus for corpus
-    file_path = 'data/%s.%s-%s.%s.txt' % (data_type, tgt_lang, src_lang, lang)
+    file_path = corpus_path(src_lang, tgt_lang, data_type, lang)
     line_count = 0
     long_sent_in_src = set()
+    lines = []
     for line in open(file_path, encoding="utf-8"):
         sent = line.strip()
         line_count += 1
@@ -58,32 +171,27 @@ def get_corpus_ids(src_lang_idx: int, tgt_lang_idx: int, data_type: str, is_tgt:
             if line_count in long_sent:
                 continue
         else:
-            if is_train and len(sent.split(' ')) > 50:
+            if is_train and len(sent.split(' ')) > MAX_SRC_WORDS:
                 long_sent_in_src.add(line_count)
                 continue
-        sent_encode = sp.EncodeAsIds(sent)
-        if is_tgt:
-            # add <s> and </s> to the tgt sents
-            sent_encode = [sp.bos_id()] + sent_encode + [sp.eos_id()]
-        sents.append(sent_encode)
+        lines.append(sent)
+    sents = encode_sents(lang, lines)
+    if is_tgt:
+        # add <s> and </s> to the tgt sents
+        sents = [[sp.bos_id()] + sent + [sp.eos_id()] for sent in sents]
     return sents, long_sent_in_src
 
 
-def decode_corpus_ids(lang_name: str, sents: List[List[int]]) -> List[str]:
-    sp = spm.SentencePieceProcessor()
-    sp.Load('subword_files/%s.model' % lang_name)
+def get_file_ids(lang_name: str, file_path: str) -> List[List[int]]:
+    return encode_sents(lang_name, [line.strip() for line in open(file_path, encoding="utf-8")])
 
-    decoded_sents = []
-    for line in sents:
-        sent = sp.DecodeIds(line)
-        decoded_sents.append(sent)
 
-    return decoded_sents
+def decode_corpus_ids(lang_name: str, sents: List[List[int]]) -> List[str]:
+    return decode_sents(lang_name, sents)
 
 
 def decode_sent_ids(lang_name: str, sent: List[int]) -> str:
-    sp = spm.SentencePieceProcessor()
-    sp.Load('subword_files/%s.model' % lang_name)
+    sp = load_sp(lang_name)
     return sp.DecodeIds(sent)
 
 
@@ -1,9 +1,15 @@
+import copy
+import itertools
 import math
-from typing import List, Tuple
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Callable, Iterable, Iterator, Dict, Any, Union
 
 import torch
 
-from collections import namedtuple
+from collections import namedtuple, deque, Counter
 
 import numpy as np
 import io
@@ -14,6 +20,7 @@ from vocab import Vocab
 
 LangPair = namedtuple('LangPair', ['src', 'tgt'])
 PairedData = namedtuple('PairedData', ['data', 'langs'])
+Batch = namedtuple('Batch', ['src_lang', 'tgt_lang', 'src_sents', 'src_lengths', 'tgt_sents', 'tgt_lengths'])
 
 
 def input_transpose(sents, pad_token):
@@ -46,6 +53,71 @@ def read_corpus(src_lang_idx: int, tgt_lang_idx: int, data_type: str, is_tgt: bo
     return data
 
 
+class NumericCorpus:
+    """
+    A corpus of subword indices: the indices of all the sentences in one flat int32 array, sentence i
+    is `ids[offsets[i]:offsets[i + 1]]`. Saved corpora are memory-mapped when loaded, so only the
+    sentences that are actually read are paged in.
+    """
+    def __init__(self, ids: np.ndarray, offsets: np.ndarray):
+        self.ids = ids
+        self.offsets = offsets
+        self.lengths = np.diff(offsets)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.ids[self.offsets[i]: self.offsets[i + 1]]
+
+    @staticmethod
+    def from_sents(sents_ids: List[List[int]]) -> 'NumericCorpus':
+        offsets = np.zeros(len(sents_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(sent) for sent in sents_ids])
+        ids = np.fromiter((w for sent in sents_ids for w in sent), dtype=np.int32, count=int(offsets[-1]))
+        return NumericCorpus(ids, offsets)
+
+    @staticmethod
+    def load(prefix: str, mmap=True) -> 'NumericCorpus':
+        mmap_mode = 'r' if mmap else None
+        return NumericCorpus(np.load(prefix + '.ids.npy', mmap_mode=mmap_mode), np.load(prefix + '.offsets.npy'))
+
+    def save(self, prefix: str):
+        np.save(prefix + '.ids.npy', self.ids)
+        np.save(prefix + '.offsets.npy', self.offsets)
+
+
+class CorpusPairs:
+    """
+    The examples of a language pair backed by the binarized source and target corpora, example i is
+    the pair of sentences `indices[i]`. It stands in for the list of (src, tgt) pairs of `PairedData`.
+    """
+    def __init__(self, src: NumericCorpus, tgt: NumericCorpus, indices: np.ndarray):
+        assert len(src) == len(tgt)
+        self.src = src
+        self.tgt = tgt
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        idx = self.indices[i]
+        return self.src[idx], self.tgt[idx]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def example_lengths(data: Union[CorpusPairs, List[Tuple[List[int], List[int]]]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The source and target lengths of the examples of a pair, binarized corpora have them stored
+    """
+    if isinstance(data, CorpusPairs):
+        return data.src.lengths[data.indices], data.tgt.lengths[data.indices]
+    return np.array([len(e[0]) for e in data], dtype=np.int64), np.array([len(e[1]) for e in data], dtype=np.int64)
+
+
 def assert_tensor_size(tensor: Tensor, expected_size: List[int]):
     try:
         assert list(tensor.shape) == expected_size
@@ -54,55 +126,334 @@ def assert_tensor_size(tensor: Tensor, expected_size: List[int]):
         raise
 
 
-def batch_iter(data: List[PairedData], batch_size, shuffle=True) -> Tuple[int, int, List[List[int]], List[List[int]]]:
+def bucket_batches(src_lengths: List[int], tgt_lengths: List[int], batch_size: int, batch_tokens: int=None) \
+        -> List[np.ndarray]:
+    """
+    Sort the examples by source and target length and cut the sorted order into batches of
+    examples with similar lengths. With `batch_tokens` a batch grows as long as neither its padded
+    source nor its padded target has more than `batch_tokens` tokens, otherwise every batch has
+    `batch_size` examples.
+
+    Returns:
+        batches: a list of index arrays, the examples in each batch sorted by decreasing source length
+    """
+    src_lengths = np.asarray(src_lengths)
+    tgt_lengths = np.asarray(tgt_lengths)
+    # sort by decreasing source length, then by decreasing target length
+    order = np.lexsort((-tgt_lengths, -src_lengths))
+    if batch_tokens is None:
+        return [order[i: i + batch_size] for i in range(0, len(order), batch_size)]
+
+    batches = []
+    start = 0
+    max_tgt_len = 0
+    for i in range(len(order)):
+        max_tgt_len = max(max_tgt_len, tgt_lengths[order[i]])
+        # the first example of a batch has the longest source
+        if i > start and max(src_lengths[order[start]], max_tgt_len) * (i - start + 1) > batch_tokens:
+            batches.append(order[start:i])
+            start = i
+            max_tgt_len = tgt_lengths[order[i]]
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+
+def batch_iter(data: List[PairedData], batch_size, shuffle=True, batch_tokens=None,
+               pairs: List['PairedDataBatch']=None, prefetcher: 'BatchPrefetcher'=None,
+               temperature: float=None, skip: int=0, rng: np.random.RandomState=None) -> Batch:
+    """
+    Given a list of examples, shuffle and slice them into mini-batches of padded tensors. The batches
+    of each language pair are bucketed by length, see `bucket_batches`; pass the precomputed `pairs`
+    to reuse the buckets across epochs, e.g. a `MixedDataBatch` bucketing the examples of all the pairs
+    together. With a `prefetcher` the batches are prepared in the background.
+    With a `temperature` the pair of every batch is sampled, see `sample_pair_batches`, otherwise
+    every batch is visited once. The order is drawn from `rng` (the global numpy RNG by default).
+    The first `skip` batches are drawn but not prepared, which resumes an epoch when `rng` is in the
+    state it had at the beginning of the epoch.
+    """
+    rng = np.random if rng is None else rng
+    if pairs is None:
+        pairs = [PairedDataBatch(i, pd, batch_size, batch_tokens) for i, pd in enumerate(data)]
+    if temperature is not None:
+        batch_indices = sample_pair_batches(pairs, temperature, sum(len(p.batch_indices) for p in pairs), rng)
+    else:
+        batch_indices = [batch_idx for p in pairs for batch_idx in p.batch_indices]
+        if shuffle:
+            rng.shuffle(batch_indices)
+    batch_indices = itertools.islice(batch_indices, skip, None)
+
+    def prepare(task: Tuple[int, int]) -> Batch:
+        pair_idx, batch_idx = task
+        return pairs[pair_idx].get_tensor_batch(batch_idx)
+
+    if prefetcher is None:
+        for task in batch_indices:
+            yield prepare(task)
+    else:
+        yield from prefetcher(prepare, batch_indices)
+
+
+def sample_pair_batches(pairs: List['PairedDataBatch'], temperature: float, num_batches: int,
+                        rng: np.random.RandomState=None) -> Iterator[Tuple[int, int]]:
+    """
+    Lazily draws `num_batches` batches. The pair of every batch is sampled with probability
+    proportional to n ** (1 / temperature), n being the number of examples of the pair: a temperature
+    of 1 follows the data, larger ones move towards sampling the pairs uniformly. The batches of a
+    pair are drawn in a random order, which starts over once all of them were drawn.
+    """
+    rng = np.random if rng is None else rng
+    sizes = np.array([len(p.data) for p in pairs], dtype=np.float64)
+    probs = sizes ** (1. / temperature)
+    probs /= probs.sum()
+    # the shuffled positions of the batches of every pair, the batches are looked up when drawn
+    orders = [iter(()) for _ in pairs]
+    for _ in range(num_batches):
+        pair_idx = rng.choice(len(pairs), p=probs)
+        batch_idx = next(orders[pair_idx], None)
+        if batch_idx is None:
+            orders[pair_idx] = iter(rng.permutation(len(pairs[pair_idx].batch_indices)))
+            batch_idx = next(orders[pair_idx])
+        yield pairs[pair_idx].batch_indices[batch_idx]
+
+
+class PairThroughput:
+    """
+    Counts the target words and the training time of every language pair between two reports. The
+    time of a batch mixing several pairs is split by their number of target words.
+    """
+    def __init__(self):
+        self.words = Counter()
+        self.time = Counter()
+
+    def update(self, batch: Batch, seconds: float):
+        # omitting the leading `<s>`
+        tgt_words = (batch.tgt_lengths - 1).tolist()
+        if torch.is_tensor(batch.src_lang):
+            pair_words = Counter()
+            for src_lang, tgt_lang, words in zip(batch.src_lang.tolist(), batch.tgt_lang.tolist(), tgt_words):
+                pair_words[(src_lang, tgt_lang)] += words
+        else:
+            pair_words = Counter({(batch.src_lang, batch.tgt_lang): sum(tgt_words)})
+        total_words = sum(pair_words.values())
+        for pair, words in pair_words.items():
+            self.words[pair] += words
+            self.time[pair] += seconds * words / total_words
+
+    def report(self) -> str:
+        total_time = sum(self.time.values())
+        return ', '.join('%s-%s %.1f%% of time %.2f words/sec' %
+                         (LANG_NAMES[src_lang], LANG_NAMES[tgt_lang], 100. * self.time[(src_lang, tgt_lang)] / total_time,
+                          self.words[(src_lang, tgt_lang)] / self.time[(src_lang, tgt_lang)])
+                         for src_lang, tgt_lang in sorted(self.time))
+
+    def reset(self):
+        self.words.clear()
+        self.time.clear()
+
+
+class BatchPrefetcher:
     """
-    Given a list of examples, shuffle and slice them into mini-batches
+    Prepares batches in background worker threads, so that the training loop only picks up ready
+    (and optionally pinned) tensors. At most `prefetch` batches are prepared ahead of the consumer
+    and they are handed out in order. `wait_time` accumulates the seconds the consumer was blocked
+    waiting for a batch.
     """
-    pairs = [PairedDataBatch(i, pd, batch_size, shuffle) for i, pd in enumerate(data)]
-    batch_indices = [batch_idx for p in pairs for batch_idx in p.batch_indices]
-    if shuffle:
-        np.random.shuffle(batch_indices)
-    for pair_idx, batch_idx in batch_indices:
-        pair = pairs[pair_idx]
-        src_sents, tgt_sents = pair.get_batch(batch_idx)
-        yield pair.src_lang, pair.tgt_lang, src_sents, tgt_sents
+    def __init__(self, num_workers=2, prefetch=8, pin_memory=False):
+        self.prefetch = max(prefetch, 1)
+        self.pin_memory = pin_memory
+        self.wait_time = 0.
+        self.executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+
+    def _prepare(self, prepare_fn: Callable, task) -> Batch:
+        batch = prepare_fn(task)
+        if self.pin_memory:
+            batch = batch._replace(src_sents=batch.src_sents.pin_memory(), tgt_sents=batch.tgt_sents.pin_memory())
+        return batch
+
+    def __call__(self, prepare_fn: Callable, tasks: Iterable) -> Batch:
+        tasks = iter(tasks)
+        if self.executor is None:
+            for task in tasks:
+                start = time.time()
+                batch = self._prepare(prepare_fn, task)
+                self.wait_time += time.time() - start
+                yield batch
+            return
+
+        pending = deque(self.executor.submit(self._prepare, prepare_fn, task)
+                        for task in itertools.islice(tasks, self.prefetch))
+        while len(pending) > 0:
+            start = time.time()
+            batch = pending.popleft().result()
+            self.wait_time += time.time() - start
+            # keep the window full
+            for task in itertools.islice(tasks, 1):
+                pending.append(self.executor.submit(self._prepare, prepare_fn, task))
+            yield batch
+
+
+def get_rng_state() -> Dict[str, Any]:
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: Dict[str, Any]):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(state: Any, half: bool=False) -> Any:
+    """
+    Copies the tensors of a (nested) state, e.g. a state_dict, to the host. The copy can be written
+    while the training goes on updating the original tensors. With `half` the floating point tensors
+    are copied to fp16.
+    """
+    if torch.is_tensor(state):
+        dtype = torch.half if half and state.is_floating_point() else state.dtype
+        return state.detach().to('cpu', dtype=dtype, copy=True)
+    if isinstance(state, dict):
+        copied = type(state)((key, snapshot(value, half)) for key, value in state.items())
+        # the versions of the modules kept by state_dict
+        if hasattr(state, '_metadata'):
+            copied._metadata = state._metadata
+        return copied
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value, half) for value in state)
+    return state
+
+
+class BestState:
+    """
+    Host memory copies of the state_dicts of the best model and of its optimizer. The patience reload
+    restores them in place, so the optimizer stays bound to the parameters of the model. `update`
+    takes snapshots, which are kept as they are, except that with `half` the floating point tensors
+    of the model are kept in fp16.
+    """
+    def __init__(self, half=False):
+        self.half = half
+        self.model_state = None
+        self.optimizer_state = None
+
+    def update(self, model_state: Dict[str, Any], optimizer_state: Dict[str, Any]):
+        self.model_state = snapshot(model_state, half=True) if self.half else model_state
+        self.optimizer_state = optimizer_state
+
+    def restore(self, model: 'torch.nn.Module', optimizer: 'torch.optim.Optimizer'):
+        # the params are copied into (and cast back to the dtype of) the tensors of the model, the
+        # optimizer may keep the given state tensors, so it gets a copy of them
+        model.load_state_dict(self.model_state)
+        optimizer.load_state_dict(copy.deepcopy(self.optimizer_state))
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints with torch.save in a background thread. `write` snapshots the state on the
+    calling thread, so the training only waits for the copy, unless the previous checkpoints are
+    still being written. A state that is already a snapshot is written with `copy=False`. A
+    checkpoint replaces the file only once it is completely written.
+    """
+    def __init__(self):
+        # the interpreter waits for the thread at exit, so a pending checkpoint is not lost
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def write(self, state: Any, path: str, copy: bool=True):
+        self.write_all([(state, path)], copy=copy)
+
+    def write_all(self, checkpoints: List[Tuple[Any, str]], copy: bool=True):
+        """
+        Writes the (state, path) pairs of `checkpoints` one after the other in one background job
+        """
+        self.wait()
+        if copy:
+            checkpoints = [(snapshot(state), path) for state, path in checkpoints]
+        self.pending = self.executor.submit(self._save_all, checkpoints)
+
+    @staticmethod
+    def _save_all(checkpoints: List[Tuple[Any, str]]):
+        for state, path in checkpoints:
+            tmp_path = path + '.tmp'
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+
+    def wait(self):
+        # re-raises the error of a failed write
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
 
 
 class PairedDataBatch:
-    def __init__(self, pair_idx: int, paried_data: PairedData, batch_size, shuffle=True):
+    def __init__(self, pair_idx: int, paried_data: PairedData, batch_size, batch_tokens=None):
         self.data = paried_data.data
         self.src_lang = paried_data.langs.src
         self.tgt_lang = paried_data.langs.tgt
-        self.batch_size = batch_size
-        batch_count = math.ceil(len(self.data) / batch_size)
-        self.index_array = list(range(len(self.data)))
 
-        # sort the pairs w.r.t. the length of the src sent
-        self.data = sorted(self.data, key=lambda e: len(e[0]), reverse=True)
+        # bucket the pairs w.r.t. the length of the src and tgt sents
+        self.batches = bucket_batches(*example_lengths(self.data), batch_size, batch_tokens)
+        self.batch_indices = [(pair_idx, i) for i in range(len(self.batches))]
+
+    def get_batch(self, batch_idx: int) -> Tuple[List[List[int]], List[List[int]]]:
+        examples = [self.data[idx] for idx in self.batches[batch_idx]]
+
+        src_sents = [e[0] for e in examples]
+        tgt_sents = [e[1] for e in examples]
+        return src_sents, tgt_sents
+
+    def get_tensor_batch(self, batch_idx: int) -> Batch:
+        src_sents, tgt_sents = self.get_batch(batch_idx)
+        return Batch(self.src_lang, self.tgt_lang,
+                     sents_to_tensor(src_sents), torch.tensor([len(s) for s in src_sents], dtype=torch.long),
+                     sents_to_tensor(tgt_sents), torch.tensor([len(s) for s in tgt_sents], dtype=torch.long))
 
-        self.batch_indices = [(pair_idx, i) for i in range(batch_count)]
-        if shuffle:
-            np.random.shuffle(self.batch_indices)
-        self.i = 0
+
+class MixedDataBatch:
+    """
+    The examples of all the language pairs bucketed together, so that the batches of the small pairs
+    are filled up with the examples of the other pairs. The `src_lang` and `tgt_lang` of its batches
+    are tensors with the languages of every example, see `MultiNMT.forward_mixed`.
+    """
+    def __init__(self, data: List[PairedData], batch_size, batch_tokens=None):
+        self.data = data
+        # the pair and the index within the pair of every example
+        self.pair_ids = np.concatenate([np.full(len(pd.data), i, dtype=np.int64) for i, pd in enumerate(data)])
+        self.example_ids = np.concatenate([np.arange(len(pd.data)) for pd in data])
+        self.src_langs = np.array([pd.langs.src for pd in data], dtype=np.int64)[self.pair_ids]
+        self.tgt_langs = np.array([pd.langs.tgt for pd in data], dtype=np.int64)[self.pair_ids]
+
+        src_lengths, tgt_lengths = zip(*[example_lengths(pd.data) for pd in data])
+        self.batches = bucket_batches(np.concatenate(src_lengths), np.concatenate(tgt_lengths), batch_size, batch_tokens)
+        self.batch_indices = [(0, i) for i in range(len(self.batches))]
 
     def get_batch(self, batch_idx: int) -> Tuple[List[List[int]], List[List[int]]]:
-        indices = self.index_array[batch_idx * self.batch_size: (batch_idx + 1) * self.batch_size]
-        examples = [self.data[idx] for idx in indices]
+        examples = [self.data[self.pair_ids[idx]].data[self.example_ids[idx]] for idx in self.batches[batch_idx]]
 
         src_sents = [e[0] for e in examples]
         tgt_sents = [e[1] for e in examples]
         return src_sents, tgt_sents
 
+    def get_tensor_batch(self, batch_idx: int) -> Batch:
+        indices = self.batches[batch_idx]
+        src_sents, tgt_sents = self.get_batch(batch_idx)
+        return Batch(torch.from_numpy(self.src_langs[indices]), torch.from_numpy(self.tgt_langs[indices]),
+                     sents_to_tensor(src_sents), torch.tensor([len(s) for s in src_sents], dtype=torch.long),
+                     sents_to_tensor(tgt_sents), torch.tensor([len(s) for s in tgt_sents], dtype=torch.long))
+
 
-def sents_to_tensor(sents: List[List[int]], device: torch.device) -> Tensor:
+def sents_to_tensor(sents: List[List[int]], device: torch.device=None) -> Tensor:
     max_sent_len = max(map((lambda x: len(x)), sents))
-    # min_sent_len = min(map((lambda x: len(x)), sents))
-    # print('longest %d, shortest %d' % (max_sent_len, min_sent_len))
-    # indices are initialized with the index of '<pad>'
-    for sent in sents:
-        while len(sent) < max_sent_len:
-            sent.append(Vocab.PAD_ID)
-    return torch.tensor(sents, dtype=torch.long, device=device)
+    # indices are initialized with the index of '<pad>', the sentences themselves are left untouched
+    padded = np.full((len(sents), max_sent_len), Vocab.PAD_ID, dtype=np.int64)
+    for i, sent in enumerate(sents):
+        padded[i, :len(sent)] = sent
+    padded = torch.from_numpy(padded)
+    return padded if device is None else padded.to(device)
 
 
 def load_matrix(fname, vocabs, emb_dim):
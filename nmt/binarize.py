@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""
+Convert a corpus to word indices once, stored as one flat int32 array of all the word indices
+plus the sentence offsets, and <prefix>.manifest.json records the hashes of the corpus and vocab
+files. Leave OUTPUT_PREFIX out to write the binary files next to the corpus, nmt.py then loads them
+(memory-mapped) instead of the text file as long as the hashes match
+
+Usage:
+    binarize.py --vocab=<file> --source=<side> CORPUS_FILE [OUTPUT_PREFIX]
+
+Options:
+    -h --help                  Show this screen.
+    --vocab=<file>             vocab file
+    --source=<side>            src or tgt, whether the corpus is the source or the target side
+"""
+
+from docopt import docopt
+import pickle
+
+from utils import binarize_corpus
+from vocab import Vocab, VocabEntry
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    vocab = pickle.load(open(args['--vocab'], 'rb'))
+    source = args['--source']
+    vocab_entry = vocab.src if source == 'src' else vocab.tgt
+    output_prefix = args['OUTPUT_PREFIX'] or args['CORPUS_FILE']
+
+    print('read in %s sentences: %s' % (source, args['CORPUS_FILE']))
+    corpus = binarize_corpus(args['CORPUS_FILE'], source, vocab_entry, args['--vocab'], output_prefix)
+    print('binarized %d sentences, %d words, saved to %s.{ids,offsets}.npy' % (len(corpus), len(corpus.ids),
+                                                                              output_prefix))
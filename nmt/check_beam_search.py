@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Checks that NMT.beam_search_batch gives every sentence of a batch the same hypotheses as a plain
+beam search of that sentence alone, which expands one hypothesis at a time. The check runs on a
+small randomly initialized model, so it needs neither data nor a trained model.
+"""
+
+import random
+
+import numpy as np
+import torch
+from typing import List
+
+import nmt
+from nmt import NMT, Hypothesis, device
+from vocab import Vocab, VocabEntry
+
+
+def reference_beam_search(model: NMT, src_sent: List[str], beam_size: int=5,
+                          max_decoding_time_step: int=70) -> List[Hypothesis]:
+    """
+    Beam search of a single source sentence, every hypothesis of the beam is fed through
+    `decoder_step` on its own and the candidates of all of them are sorted together
+    """
+    with torch.no_grad():
+        src_indices = torch.tensor([model.vocab.src.words2indices(src_sent)], dtype=torch.long)
+        src_lengths = torch.tensor([len(src_sent)], dtype=torch.long)
+        src_encodings, (h_t_0, c_t_0) = model.encode(src_indices, src_lengths)
+        src_memory = model.source_memory(src_encodings, src_lengths)
+        attn = torch.zeros(torch.Size([1]) + h_t_0.shape[1:], device=device)
+        # candidates for best hypotheses
+        hypotheses_cand = [(Hypothesis(['<s>'], 0.), h_t_0, c_t_0, attn)]
+        for _ in range(max_decoding_time_step):
+            new_hypotheses_cand = []
+            for (sent, log_likelihood), h_t, c_t, attn in hypotheses_cand:
+                # an ended sentence is a candidate as it is
+                if sent[-1] == '</s>':
+                    new_hypotheses_cand.append((Hypothesis(sent, log_likelihood), h_t, c_t, attn))
+                    continue
+                # dim = (1, 1, embed_size)
+                decoder_input = model.decoder_embed(torch.tensor([[model.vocab.tgt[sent[-1]]]], device=device))
+                # softmax_output.shape = [1, vocab_size]
+                h_t, c_t, softmax_output, attn, a_t = model.decoder_step(src_memory, decoder_input, h_t, c_t, attn)
+                top_v, top_i = torch.topk(softmax_output, beam_size, dim=1)
+                for score, word_idx in zip(top_v[0].tolist(), top_i[0].tolist()):
+                    hyp_word = model.vocab.tgt.id2word[word_idx]
+                    # deal with unknown word
+                    if hyp_word == '<unk>':
+                        src_word = src_sent[int(torch.argmax(a_t.view(-1)))]
+                        # use dictionary if possible, else use src_word
+                        hyp_word = model.vocab.decoder_dict.get(src_word, src_word)
+                    new_hypotheses_cand.append((Hypothesis(sent + [hyp_word], log_likelihood + score),
+                                                h_t, c_t, attn))
+            hypotheses_cand = sorted(new_hypotheses_cand, key=lambda x: x[0].score, reverse=True)[:beam_size]
+            # break if all sentences have ended
+            if all(c[0].value[-1] == '</s>' for c in hypotheses_cand):
+                break
+        return [c[0] for c in hypotheses_cand]
+
+
+def same_hypotheses(hyps_a: List[Hypothesis], hyps_b: List[Hypothesis]) -> bool:
+    return [h.value for h in hyps_a] == [h.value for h in hyps_b] and \
+        np.allclose([h.score for h in hyps_a], [h.score for h in hyps_b], atol=1e-4)
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    random.seed(0)
+    np.random.seed(0)
+
+    vocab = Vocab.__new__(Vocab)
+    vocab.src = VocabEntry()
+    vocab.tgt = VocabEntry()
+    for i in range(40):
+        vocab.src.add('s%d' % i)
+    for i in range(30):
+        vocab.tgt.add('t%d' % i)
+    vocab.decoder_dict = {'s1': 't5'}
+
+    # the check does not need the pretrained embeddings
+    nmt.load_matrix = lambda fname, words, embed_size: np.random.uniform(-0.1, 0.1, (len(words), embed_size))
+    model = NMT(embed_size=16, hidden_size=12, vocab=vocab, dropout_rate=0.).to(device)
+    model.eval()
+    with torch.no_grad():
+        # sharpen the random model so that the hypotheses differ and their lengths vary,
+        # and make '<unk>' likely so that its replacement is checked too
+        for param in model.parameters():
+            param.mul_(8)
+        model.decoder_W_s.weight[vocab.tgt['<unk>']].add_(0.5)
+
+    src_sents = [['s%d' % random.randrange(40) for _ in range(random.randint(1, 9))] for _ in range(13)] + \
+        [['<unk>', 's1', 's2']]
+    for beam_size, max_decoding_time_step in [(4, 12), (1, 6), (3, 40)]:
+        batch_hyps = model.beam_search_batch(src_sents, beam_size, max_decoding_time_step)
+        single_hyps = [reference_beam_search(model, src_sent, beam_size, max_decoding_time_step)
+                       for src_sent in src_sents]
+        print('beam size %d, %d steps: %s' % (beam_size, max_decoding_time_step,
+                                               all(same_hypotheses(a, b) for a, b in zip(batch_hyps, single_hyps))))
@@ -18,6 +18,8 @@ Options:
     --vocab=<file>                          vocab file
     --seed=<int>                            seed [default: 0]
     --batch-size=<int>                      batch size [default: 32]
+    --batch-tokens=<int>                    build batches of up to this many source or target tokens (padding
+                                            included) instead of --batch-size sentences
     --embed-size=<int>                      embedding size [default: 256]
     --hidden-size=<int>                     hidden size [default: 256]
     --clip-grad=<float>                     gradient clipping [default: 5.0]
@@ -31,12 +33,22 @@ Options:
     --uniform-init=<float>                  uniformly initialize all parameters [default: 0.1]
     --save-to=<file>                        model save path
     --save-opt=<file>                       optimizer state save path
+    --save-state=<file>                     path of the resumable training state (model, optimizer, RNG states and
+                                            position in the data), written in the background
+    --state-every=<int>                     write the training state after how many iterations [default: 1000]
+    --resume                                resume the training from the state at --save-state
+    --best-fp16                             keep the in-memory copy of the best model, restored when the learning
+                                            rate decays, in fp16
     --valid-niter=<int>                     perform validation after how many iterations [default: 2000]
+    --data-workers=<int>                    number of background threads preparing batches [default: 2]
+    --prefetch-batches=<int>                number of batches prepared ahead of training [default: 8]
     --dropout=<float>                       dropout [default: 0.2]
     --max-decoding-time-step=<int>          maximum number of decoding time steps [default: 70]
+    --decode-batch-size=<int>               number of sentences decoded together [default: 32]
 """
 
 import math
+import os
 import pickle
 import sys
 import time
@@ -48,7 +60,8 @@ from docopt import docopt
 from tqdm import tqdm
 from nltk.translate.bleu_score import corpus_bleu, sentence_bleu, SmoothingFunction
 
-from utils import read_corpus, batch_iter, load_matrix
+from utils import read_corpus, batch_iter, bucket_batches, load_matrix, load_corpus, NumericCorpus, BatchPrefetcher, \
+    CheckpointWriter, BestState, snapshot, get_rng_state, set_rng_state
 from vocab import Vocab, VocabEntry
 from embed import corpus_to_indices, indices_to_corpus
 
@@ -68,9 +81,34 @@ if torch.cuda.is_available():
 Hypothesis = namedtuple('Hypothesis', ['value', 'score'])
 
 
+class SourceMemory(object):
+    """
+    The source encodings seen by the attention, together with their attention keys `W_a h_s`.
+    The keys only depend on the source, so they are projected once per batch and then reused by
+    every decoder step and every hypothesis in the beam.
+    """
+
+    def __init__(self, encodings: Tensor, keys: Tensor, mask: Tensor=None):
+        """
+        :param encodings: source top hidden states of size [batch_size, max_src_len, num_directions * hidden_size]
+        :param keys: projected attention keys of size [batch_size, decoder_hidden_size, max_src_len]
+        :param mask: optional (batch_size, 1, max_src_len) mask, non-zero at padded source positions
+        """
+        self.encodings = encodings
+        self.keys = keys
+        self.mask = mask
+
+    def index_select(self, rows: Tensor):
+        """
+        Select (or repeat) the rows of the batch, e.g. to follow the back pointers of a beam
+        """
+        mask = None if self.mask is None else self.mask.index_select(0, rows)
+        return SourceMemory(self.encodings.index_select(0, rows), self.keys.index_select(0, rows), mask)
+
+
 class NMT(nn.Module):
 
-    def __init__(self, embed_size, hidden_size, vocab, dropout_rate=0.2):
+    def __init__(self, embed_size, hidden_size, vocab, dropout_rate=0.2, pretrained_embeddings=True):
         super(NMT, self).__init__()
 
         self.embed_size = embed_size
@@ -84,15 +122,22 @@ class NMT(nn.Module):
         # initialize neural network layers...
         # could add drop-out and bidirectional arguments
         # could also change the units to GRU
-        src_weights_matrix = load_matrix("data/cc.400k.de.300.vec", self.vocab.src.word2id.keys(), self.embed_size)
-        self.encoder_embed = self.create_emb_layer(src_vocab_size, src_weights_matrix)
+        # a model built from a checkpoint gets its embeddings from the checkpoint
+        if pretrained_embeddings:
+            src_weights_matrix = load_matrix("data/cc.400k.de.300.vec", self.vocab.src.word2id.keys(), self.embed_size)
+            self.encoder_embed = self.create_emb_layer(src_vocab_size, src_weights_matrix)
+        else:
+            self.encoder_embed = nn.Embedding(src_vocab_size, self.embed_size)
         self.NUM_LAYER = 2
         self.NUM_DIR = 2
         self.BIDIR = self.NUM_DIR == 2
 
         self.encoder_lstm = nn.LSTM(embed_size, hidden_size, num_layers=self.NUM_LAYER, bidirectional=self.BIDIR)
-        tgt_weights_matrix = load_matrix("data/cc.400k.en.300.vec", self.vocab.tgt.word2id.keys(), self.embed_size)
-        self.decoder_embed = self.create_emb_layer(self.tgt_vocab_size, tgt_weights_matrix)
+        if pretrained_embeddings:
+            tgt_weights_matrix = load_matrix("data/cc.400k.en.300.vec", self.vocab.tgt.word2id.keys(), self.embed_size)
+            self.decoder_embed = self.create_emb_layer(self.tgt_vocab_size, tgt_weights_matrix)
+        else:
+            self.decoder_embed = nn.Embedding(self.tgt_vocab_size, self.embed_size)
         decoder_hidden_size = self.NUM_DIR * hidden_size
         self.decoder_lstm = nn.LSTM(decoder_hidden_size + embed_size, decoder_hidden_size, num_layers=self.NUM_LAYER)
         # W_a for attention
@@ -104,9 +149,6 @@ class NMT(nn.Module):
         self.dropout = nn.Dropout(p=self.dropout_rate)
         self.tanh = nn.Tanh()
 
-        weights = torch.ones(self.tgt_vocab_size)
-        weights[0] = 0
-        self.criterion = nn.NLLLoss(weight=weights)
         # W_s for attention
         self.decoder_W_s = nn.Linear(decoder_hidden_size, self.tgt_vocab_size, bias=False)
 
@@ -121,31 +163,55 @@ class NMT(nn.Module):
             emb_layer.weight.requires_grad = False
         return emb_layer
 
-    def forward(self, src_sents: List[List[str]], tgt_sents: List[List[str]]) -> Tensor:
+    def forward(self, src_indices: Tensor, src_lengths: Tensor, tgt_indices: Tensor) -> Tensor:
         """
         take a mini-batch of source and target sentences, compute the log-likelihood of
         target sentences.
 
         Args:
-            src_sents: list of source sentence tokens
-            tgt_sents: list of target sentence tokens, wrapped by `<s>` and `</s>`
+            src_indices: padded source word indices of shape (batch_size, max_src_len),
+                sorted by decreasing source length
+            src_lengths: source sentence lengths of shape (batch_size, )
+            tgt_indices: padded target word indices of shape (batch_size, max_tgt_len),
+                each sentence wrapped by `<s>` and `</s>`
 
         Returns:
             scores: a variable/tensor of shape (batch_size, ) representing the
                 log-likelihood of generating the gold-standard target sentence for
                 each example in the input batch
         """
-        src_encodings, decoder_init_state = self.encode(src_sents)
-        scores = self.decode(src_encodings, decoder_init_state, tgt_sents)
+        src_encodings, decoder_init_state = self.encode(src_indices, src_lengths)
+        scores = self.decode(src_encodings, decoder_init_state, tgt_indices)
 
         return scores
 
-    def encode(self, src_sents: List[List[str]]) -> Tuple[Tensor, Any]:
+    def source_memory(self, src_encodings: Tensor, src_lengths: Tensor=None) -> SourceMemory:
+        """
+        Wrap the source encodings for the attention and project the attention keys once
+
+        :param src_encodings: [max_src_len, batch_size, num_directions * hidden_size]
+        :param src_lengths: optional (batch_size, ) source lengths, the padded positions are masked if given
+        :return: the source memory used by `decoder_step`
+        """
+        # dim = (batch_size, max_src_len, num_directions * hidden_size)
+        h_s_ = src_encodings.transpose(0, 1)
+        # dim = (batch_size, decoder_hidden_size, max_src_len)
+        keys = self.decoder_W_a(h_s_).transpose(1, 2)
+        mask = None
+        if src_lengths is not None:
+            # dim = (batch_size, 1, max_src_len), non-zero at the padded positions
+            mask = (torch.arange(h_s_.shape[1], device=device).unsqueeze(0) >=
+                    src_lengths.to(device).unsqueeze(1)).unsqueeze(1)
+        return SourceMemory(h_s_, keys, mask)
+
+    def encode(self, src_indices: Tensor, src_lengths: Tensor) -> Tuple[Tensor, Any]:
         """
         Use a GRU/LSTM to encode source sentences into hidden states
 
         Args:
-            src_sents: list of source sentence tokens
+            src_indices: padded source word indices of shape (batch_size, max_src_len),
+                sorted by decreasing source length
+            src_lengths: source sentence lengths of shape (batch_size, )
 
         Returns:
             src_encodings: hidden states of tokens in source sentences, this could be a variable
@@ -153,13 +219,11 @@ class NMT(nn.Module):
             decoder_init_state: decoder GRU/LSTM's initial state, computed from source encodings,
                 with dim (1, batch_size, encoding_dim)
         """
-        # first the the vecotrized representation of the batch; dim = (batch_size, max_src_len)
-        sent_length = torch.tensor([len(sent) for sent in src_sents]).to(device)
-        sent_indices = self.vocab.src.words2indices(src_sents)
-        sent_indices_padded = pad_sequence([torch.tensor(sent) for sent in sent_indices]).to(device)
+        # the vecotrized representation of the batch; dim = (max_src_len, batch_size)
+        sent_indices_padded = src_indices.t().to(device, non_blocking=True)
         # embed padded seq
         padded_embedding = self.dropout(self.encoder_embed(sent_indices_padded))
-        packed_seqs = pack_padded_sequence(padded_embedding, sent_length)
+        packed_seqs = pack_padded_sequence(padded_embedding, src_lengths.cpu())
 
         # h_n_.shape = c_n_.shape =  [num_layers * num_directions, batch_size, hidden_size]
         output, (h_n_, c_n_) = self.encoder_lstm(packed_seqs)
@@ -174,7 +238,7 @@ class NMT(nn.Module):
         src_encodings = pad_packed_sequence(output)[0]
         return src_encodings, (h_n, c_n)
 
-    def decode(self, src_encodings: Tensor, decoder_init_state: Tensor, tgt_sents: List[List[str]]) -> Tensor:
+    def decode(self, src_encodings: Tensor, decoder_init_state: Tensor, tgt_indices: Tensor) -> Tensor:
         """
         Given source encodings, compute the log-likelihood of predicting the gold-standard target
         sentence tokens
@@ -183,7 +247,8 @@ class NMT(nn.Module):
             src_encodings: hidden states of tokens in source sentences of shape
             [max_src_len, batch_size, num_directions * hidden_size]
             decoder_init_state: decoder GRU/LSTM's initial state
-            tgt_sents: list of gold-standard target sentences, wrapped by `<s>` and `</s>`
+            tgt_indices: padded word indices of the gold-standard target sentences of shape
+                (batch_size, max_tgt_len), each sentence wrapped by `<s>` and `</s>`
 
         Returns:
             scores: could be a variable of shape (batch_size, ) representing the
@@ -192,78 +257,92 @@ class NMT(nn.Module):
                 (extra note) we need this to be in the shape of (batch_size, output_vocab_size)
                 for beam search
         """
-        batch_size = len(tgt_sents)
-        input = corpus_to_indices(self.vocab.tgt, [["<s>"] for _ in range(batch_size)]).to(device)
-        # dim = (batch_size, 1 (sent_len), embed_size)
-        embedded = self.decoder_embed(input)
-        # dim = (1 (single_word), batch_size, embed_size)
-        decoder_input = embedded.transpose(0, 1)
-        scores = torch.zeros(batch_size, device=device)
+        # dim = (batch_size, max_tgt_len)
+        target_output = tgt_indices.to(device, non_blocking=True)
+        batch_size = target_output.shape[0]
+        # dim = (max_tgt_len, batch_size, embed_size), teacher forcing feeds the gold words of every step
+        embedded = self.decoder_embed(target_output).transpose(0, 1)
         # [num_layers, batch_size, num_directions * hidden_size]
         h_t = decoder_init_state[0]
         c_t = decoder_init_state[1]
-        zero_mask = torch.zeros(batch_size, device=device)
-        one_mask = torch.ones(batch_size, device=device)
-        # convert the target sentences to indices, dim = (batch_size, max_tgt_len)
-        target_output = corpus_to_indices(self.vocab.tgt, tgt_sents).to(device)
         # [1, batch_size, num_directions * hidden_size]
         attn = torch.zeros(torch.Size([1])+h_t.shape[1:], device=device)
+        src_memory = self.source_memory(src_encodings)
+        # only run the recurrence and the attention in the loop, the vocab projection is done once afterwards
+        attn_outputs = []
         # skip the '<s>' in the tgt_sents since the output starts from the word after '<s>'
         for i in range(1, target_output.shape[1]):
-            decoder_input = self.dropout(decoder_input)
-            h_t, c_t, softmax_output, attn, _ = self.decoder_step(src_encodings, decoder_input, h_t, c_t, attn)
-            # dim = (batch_size)
-            target_word_indices = target_output[:, i].reshape(batch_size)
-            score_delta = self.criterion(softmax_output, target_word_indices)
-            # mask '<pad>' with 0
-            pad_mask = torch.where((target_word_indices == self.DECODER_PAD_IDX), zero_mask, one_mask)
-            masked_score_delta = score_delta * pad_mask
-            # update scores
-            scores = scores + masked_score_delta
-            # get the input for the next layer from the embed of the target words
-            embedded = self.decoder_embed(target_word_indices.view(-1, 1))
-            decoder_input = embedded.transpose(0, 1)
+            decoder_input = self.dropout(embedded[i - 1:i])
+            h_t, c_t, attn, _ = self.decoder_attention_step(src_memory, decoder_input, h_t, c_t, attn)
+            attn_outputs.append(attn)
+        # dim = ((max_tgt_len - 1) * batch_size, decoder_hidden_size)
+        attn_outputs = torch.cat(attn_outputs, dim=0).reshape(-1, attn.shape[2])
+        # dim = ((max_tgt_len - 1) * batch_size, vocab_size)
+        vocab_size_output = self.decoder_W_s(attn_outputs)
+        # dim = ((max_tgt_len - 1) * batch_size), '<pad>' targets contribute 0
+        target_word_indices = target_output[:, 1:].transpose(0, 1).reshape(-1)
+        word_losses = F.cross_entropy(vocab_size_output, target_word_indices,
+                                      ignore_index=self.DECODER_PAD_IDX, reduction='none')
+        # dim = (batch_size, )
+        scores = word_losses.reshape(-1, batch_size).sum(dim=0)
         return scores
 
-    def decoder_step(self, src_encodings: Tensor, decoder_input: Tensor, h_t: Tensor, c_t: Tensor, attn: Tensor):
+    def decoder_step(self, src_memory: SourceMemory, decoder_input: Tensor, h_t: Tensor, c_t: Tensor, attn: Tensor):
         """
         Perform one decoder step
 
-        :param src_encodings:  the output features (h_t) from the last layer in source sentences of shape
-            [max_src_len, batch_size, num_directions * hidden_size]
+        :param src_memory: the source encodings and their attention keys, see `source_memory`
         :param decoder_input: (1, batch_size, embed_size)
         :param h_t: [num_layers, batch_size, num_directions * hidden_size]
         :param c_t: [num_layers, batch_size, num_directions * hidden_size]
         :param attn: [1, batch_size, num_directions * hidden_size]
         :return: new h_t, c_t, softmax_output with dim (batch_size, vocab_size), attn (1, batch_size, 2 * hidden_size)
         """
+        h_t, c_t, attn_h_t_, a_t = self.decoder_attention_step(src_memory, decoder_input, h_t, c_t, attn)
+        # dim = (1, batch_size, vocab_size)
+        vocab_size_output = self.decoder_W_s(attn_h_t_)
+        # dim = (batch_size, vocab_size)
+        softmax_output = self.decoder_log_softmax(vocab_size_output).squeeze(0)
+        return h_t, c_t, softmax_output, attn_h_t_, a_t
+
+    def decoder_attention_step(self, src_memory: SourceMemory, decoder_input: Tensor, h_t: Tensor, c_t: Tensor,
+                               attn: Tensor):
+        """
+        Perform the recurrence and the attention of one decoder step, without the vocab projection
+
+        :param src_memory: the source encodings and their attention keys, see `source_memory`
+        :param decoder_input: (1, batch_size, embed_size)
+        :param h_t: [num_layers, batch_size, num_directions * hidden_size]
+        :param c_t: [num_layers, batch_size, num_directions * hidden_size]
+        :param attn: [1, batch_size, num_directions * hidden_size]
+        :return: new h_t, c_t, attn (1, batch_size, 2 * hidden_size), attention weights a_t
+        """
         # dim = (1, batch_size,  num_directions * hidden_size + embed_size)
         cat_input = torch.cat((attn, decoder_input), 2)
         _, (h_t, c_t) = self.decoder_lstm(cat_input, (h_t, c_t))
         # dim = (batch_size, 1, decoder_hidden_size)
-        attn_h_t, a_t = self.global_attention(src_encodings, h_t)
+        attn_h_t, a_t = self.global_attention(src_memory, h_t)
         # dim = (1, batch_size, num_directions * hidden_size + decoder_hidden_size)
         attn_h_t_ = attn_h_t.transpose(0, 1)
-        # dim = (1, batch_size, vocab_size)
-        vocab_size_output = self.decoder_W_s(attn_h_t_)
-        # dim = (batch_size, vocab_size)
-        softmax_output = self.decoder_log_softmax(vocab_size_output).squeeze()
-        return h_t, c_t, softmax_output, attn_h_t_, a_t
+        return h_t, c_t, attn_h_t_, a_t
 
-    def global_attention(self, h_s: Tensor, h_t: Tensor):
+    def global_attention(self, src_memory: SourceMemory, h_t: Tensor):
         """
         Calculate global attention
 
-        :param h_s: source top hidden state of size [max_src_len, batch_size, num_directions * hidden_size]
+        :param src_memory: the source encodings and their attention keys, see `source_memory`
         :param h_t: decoder hidden state of shape [num_layers, batch_size, decoder_hidden_size]
         :return: an attention vector (batch_size, 1, decoder_hidden_size)
         """
         # top hidden layer with dim = (batch_size, 1, decoder_hidden_size)
         h_t_top = h_t[-1].unsqueeze(0).transpose(0, 1)
         # dim = (batch_size, max_src_len, num_directions * hidden_size)
-        h_s_ = h_s.transpose(0, 1)
+        h_s_ = src_memory.encodings
         # dim = (batch_size, 1, max_src_len)
-        score = self.general_score(h_s_, h_t_top)
+        score = self.general_score(src_memory, h_t_top)
+        if src_memory.mask is not None:
+            # padded positions must not take any attention weight
+            score = score.masked_fill(src_memory.mask, -float('inf'))
         # dim = (batch_size, 1, max_src_len)
         a_t = self.decoder_softmax(score)
         # a_t = self.dropout(a_t)
@@ -273,23 +352,21 @@ class NMT(nn.Module):
         cat_c_h = torch.cat((c_t, h_t_top), 2)
         return self.tanh(self.decoder_W_c(cat_c_h)), a_t
 
-    def general_score(self, h_s_: Tensor, h_t_top: Tensor):
+    def general_score(self, src_memory: SourceMemory, h_t_top: Tensor):
         """
         Calculate general attention score
 
-        :param h_s_: transposed source top hidden state of size [batch_size, max_src_len, num_directions * hidden_size]
+        :param src_memory: the source encodings and their attention keys `W_a h_s`
+            of size [batch_size, decoder_hidden_size, max_src_len]
         :param h_t_top: decoder hidden state of size [batch_size, 1, decoder_hidden_size]
         :return: a score of size (batch_size, 1, max_src_len)
         """
-        # dim = (batch_size, max_src_len, num_directions * hidden_size)
-        W_a_h_s = self.decoder_W_a(h_s_)
-        # dim = (batch_size, num_directions * hidden_size, max_src_len)
-        W_a_h_s = W_a_h_s.transpose(1, 2)
-        return torch.bmm(h_t_top, W_a_h_s)
+        return torch.bmm(h_t_top, src_memory.keys)
 
     def beam_search(self, src_sent: List[str], beam_size: int=5, max_decoding_time_step: int=70) -> List[Hypothesis]:
         """
-        Given a single source sentence, perform beam search
+        Given a single source sentence, perform beam search. All the hypotheses in the beam are
+        advanced together as one batch, see `beam_search_batch`
 
         Args:
             src_sent: a single tokenized source sentence
@@ -301,59 +378,138 @@ class NMT(nn.Module):
                 value: List[str]: the decoded target sentence, represented as a list of words
                 score: float: the log-likelihood of the target sentence
         """
-        with torch.no_grad():
-            # dim = (1, 1, embed_size)
-            src_encodings, (h_n, c_n) = self.encode([src_sent])
-            # dim = (1, 1, embed_size)
-            h_t_0 = h_n
-            c_t_0 = c_n
-            attn = torch.zeros(torch.Size([1]) + h_t_0.shape[1:], device=device)
-            # candidates for best hypotheses
-            hypotheses_cand = [(Hypothesis(['<s>'], 0), h_t_0, c_t_0, attn)]
-            for i in range(max_decoding_time_step):
-                new_hypotheses_cand = []
-                for (sent, log_likelihood), h_t, c_t, attn in hypotheses_cand:
-                    input_word = sent[-1]
-                    # skip ended sentence
-                    if input_word == '</s>':
-                        # directly add ended sentence to new candidates
-                        new_hypotheses_cand.append((Hypothesis(sent, log_likelihood), h_t, c_t, attn))
-                        continue
-                    # dim = (1, 1 (single_word), embed_size)
-                    embeded = self.decoder_embed(corpus_to_indices(self.vocab.tgt, [[input_word]]).to(device))
-                    # dim = (1 (single_word), 1, embed_size)
-                    decoder_input = embeded.transpose(0, 1)
-                    # softmax_output.shape = [vocab_size]
-                    h_t, c_t, softmax_output, attn, a_t = self.decoder_step(src_encodings, decoder_input, h_t, c_t, attn)
-                    # dim = (1, beam_size)
-                    top_v, top_i = torch.topk(softmax_output.unsqueeze(0), beam_size, dim=1)
-                    for word_idx_tensor in top_i[0]:
-                        word_idx = word_idx_tensor.item()
-                        hyp_word = self.vocab.tgt.id2word[word_idx]
+        return self.beam_search_batch([src_sent], beam_size=beam_size,
+                                      max_decoding_time_step=max_decoding_time_step)[0]
 
+    def beam_search_batch(self, src_sents: List[List[str]], beam_size: int=5, max_decoding_time_step: int=70) \
+            -> List[List[Hypothesis]]:
+        """
+        Perform beam search for a batch of source sentences at once. The sentences are encoded
+        together and the beams of all the sentences are fed through `decoder_step` as one batch of
+        `batch_size * beam_size` rows; a sentence leaves the batch as soon as all of its hypotheses end.
+
+        Args:
+            src_sents: a list of tokenized source sentences
+            beam_size: beam size
+            max_decoding_time_step: maximum number of time steps to unroll the decoding RNN
+
+        Returns:
+            hypotheses: a list of `beam_size` hypotheses for each source sentence, in the input order
+        """
+        with torch.no_grad():
+            # the encoder packs the batch, so it has to be sorted by decreasing source length
+            order = sorted(range(len(src_sents)), key=lambda i: len(src_sents[i]), reverse=True)
+            sorted_sents = [src_sents[i] for i in order]
+            batch_size = len(sorted_sents)
+            eos_id = self.vocab.tgt['</s>']
+
+            src_corpus = NumericCorpus.from_sents(self.vocab.src.words2indices(sorted_sents))
+            src_indices, src_lengths = src_corpus.pad_batch(np.arange(batch_size))
+            src_indices = torch.from_numpy(src_indices)
+            src_lengths = torch.from_numpy(src_lengths)
+            # src_encodings.shape = [max_src_len, batch_size, num_directions * hidden_size]
+            src_encodings, (h_t, c_t) = self.encode(src_indices, src_lengths)
+            src_memory = self.source_memory(src_encodings, src_lengths)
+
+            # repeat every sentence beam_size times, row i * beam_size + j is hypothesis j of sentence i
+            beam_rows = torch.arange(batch_size, device=device).unsqueeze(1).expand(batch_size, beam_size).reshape(-1)
+            src_memory = src_memory.index_select(beam_rows)
+            h_t = h_t.index_select(1, beam_rows)
+            c_t = c_t.index_select(1, beam_rows)
+            attn = torch.zeros(torch.Size([1]) + h_t.shape[1:], device=device)
+
+            # only the first hypothesis of every sentence is alive at the beginning
+            beam_scores = torch.full((batch_size, beam_size), -float('inf'), device=device)
+            beam_scores[:, 0] = 0.
+            active = list(range(batch_size))
+            hyp_sents = [[['<s>'] for _ in range(beam_size)] for _ in range(batch_size)]
+            input_ids = [self.vocab.tgt['<s>']] * (batch_size * beam_size)
+            results = [None] * batch_size
+
+            for _ in range(max_decoding_time_step):
+                # dim = (1, active_num * beam_size)
+                input_tensor = torch.tensor(input_ids, dtype=torch.long, device=device).unsqueeze(0)
+                # dim = (1, active_num * beam_size, embed_size)
+                decoder_input = self.decoder_embed(input_tensor)
+                # softmax_output.shape = [active_num * beam_size, vocab_size]
+                h_t, c_t, softmax_output, attn, a_t = self.decoder_step(src_memory, decoder_input, h_t, c_t, attn)
+                # an ended hypothesis is carried over unchanged, as the only candidate of its row
+                ended = (input_tensor.squeeze(0) == eos_id).unsqueeze(1)
+                softmax_output = softmax_output.masked_fill(ended, -float('inf'))
+                softmax_output[:, eos_id] = softmax_output[:, eos_id].masked_fill(ended.squeeze(1), 0.)
+                # dim = (active_num, beam_size * vocab_size)
+                cand_scores = (beam_scores.view(-1, 1) + softmax_output).view(len(active), -1)
+                # dim = (active_num, beam_size)
+                top_scores, top_ids = torch.topk(cand_scores, beam_size, dim=1)
+                prev_beams = top_ids // self.tgt_vocab_size
+                word_ids = top_ids - prev_beams * self.tgt_vocab_size
+                # the source position with the largest attention, used to replace '<unk>'
+                _, src_word_pos = torch.max(a_t.squeeze(1), dim=1)
+
+                # move everything needed for the bookkeeping to the host at once
+                prev_beams_list = prev_beams.tolist()
+                word_ids_list = word_ids.tolist()
+                src_word_pos_list = src_word_pos.tolist()
+
+                keep = []
+                new_input_ids = []
+                for i, sent_idx in enumerate(active):
+                    new_hyps = []
+                    sent_input_ids = []
+                    for j in range(beam_size):
+                        prev_row = i * beam_size + prev_beams_list[i][j]
+                        prev_hyp = hyp_sents[sent_idx][prev_beams_list[i][j]]
+                        if input_ids[prev_row] == eos_id:
+                            new_hyps.append(prev_hyp)
+                            sent_input_ids.append(eos_id)
+                            continue
+                        hyp_word = self.vocab.tgt.id2word[word_ids_list[i][j]]
                         # deal with unknown word
                         if hyp_word == '<unk>':
-                            _, src_word_pos = torch.topk(a_t.squeeze(), 1)
-                            src_word = src_sent[src_word_pos]
+                            src_word = sorted_sents[sent_idx][src_word_pos_list[prev_row]]
                             # use dictionary if possible, else use src_word
                             hyp_word = self.vocab.decoder_dict.get(src_word, src_word)
-
-                        new_hyp = Hypothesis(sent + [hyp_word],
-                                             log_likelihood + softmax_output[word_idx])
-                        new_hypotheses_cand.append((new_hyp, h_t, c_t, attn))
-                # combine ended sentences with new candidates to form new hypotheses
-                hypotheses_cand = sorted(new_hypotheses_cand, key=lambda x: x[0].score, reverse=True)[:beam_size]
-                # break if all sentences have ended
-                if all(c[0].value[-1] == '</s>' for c in hypotheses_cand):
+                        new_hyps.append(prev_hyp + [hyp_word])
+                        sent_input_ids.append(self.vocab.tgt[hyp_word])
+                    hyp_sents[sent_idx] = new_hyps
+
+                    if all(word_id == eos_id for word_id in sent_input_ids):
+                        results[sent_idx] = [Hypothesis(hyp, score) for hyp, score in
+                                             zip(new_hyps, top_scores[i].tolist())]
+                    else:
+                        keep.append(i)
+                        new_input_ids += sent_input_ids
+
+                if len(keep) == 0:
                     break
-            return [c[0] for c in hypotheses_cand]
-
-    def evaluate_ppl(self, dev_data: List[Any], batch_size: int=32):
+                # reorder the states w.r.t. the back pointers and drop the finished sentences
+                rows = torch.tensor([i * beam_size + prev_beams_list[i][j] for i in keep for j in range(beam_size)],
+                                    dtype=torch.long, device=device)
+                h_t = h_t.index_select(1, rows)
+                c_t = c_t.index_select(1, rows)
+                attn = attn.index_select(1, rows)
+                src_memory = src_memory.index_select(rows)
+                keep_tensor = torch.tensor(keep, dtype=torch.long, device=device)
+                beam_scores = top_scores.index_select(0, keep_tensor)
+                active = [active[i] for i in keep]
+                input_ids = new_input_ids
+            else:
+                # reached the maximum decoding time step, return whatever is in the beams
+                for i, sent_idx in enumerate(active):
+                    results[sent_idx] = [Hypothesis(hyp, score) for hyp, score in
+                                         zip(hyp_sents[sent_idx], beam_scores[i].tolist())]
+
+            hypotheses = [None] * batch_size
+            for sorted_idx, sent_idx in enumerate(order):
+                hypotheses[sent_idx] = results[sorted_idx]
+            return hypotheses
+
+    def evaluate_ppl(self, dev_data: Tuple[NumericCorpus, NumericCorpus], batch_size: int=32):
         """
         Evaluate perplexity on dev sentences
 
         Args:
-            dev_data: a list of dev sentences
+            dev_data: a pair of source and target NumericCorpus of the dev sentences
             batch_size: batch size
 
         Returns:
@@ -367,11 +523,11 @@ class NMT(nn.Module):
         # by the NN library to signal the backend to not to keep gradient information
         # e.g., `torch.no_grad()`
         with torch.no_grad():
-            for src_sents, tgt_sents in batch_iter(dev_data, batch_size):
-                loss = self(src_sents, tgt_sents).sum()
+            for src_indices, src_lengths, tgt_indices, tgt_lengths in batch_iter(dev_data, batch_size):
+                loss = self(src_indices, src_lengths, tgt_indices).sum()
 
                 cum_loss += loss
-                tgt_word_num_to_predict = sum(len(s[1:]) for s in tgt_sents)  # omitting the leading `<s>`
+                tgt_word_num_to_predict = int((tgt_lengths - 1).sum())  # omitting the leading `<s>`
                 cum_tgt_words += tgt_word_num_to_predict
 
             ppl = np.exp(cum_loss / cum_tgt_words)
@@ -387,13 +543,32 @@ class NMT(nn.Module):
             model: the loaded model
         """
 
-        return torch.load(model_path)
+        model = torch.load(model_path)
+        # models saved before the checkpoints were pickled whole
+        if isinstance(model, dict):
+            model = NMT.from_checkpoint(model)
+        return model.to(device)
+
+    def checkpoint(self, state_dict: Dict[str, Tensor]=None) -> Dict:
+        """
+        The sizes, the vocab and the params `from_checkpoint` builds the model again from. The trainer
+        passes a host snapshot of the state_dict, so that the checkpoint can be written in the background
+        """
+        return {'embed_size': self.embed_size, 'hidden_size': self.hidden_size, 'dropout_rate': self.dropout_rate,
+                'vocab': self.vocab, 'state_dict': self.state_dict() if state_dict is None else state_dict}
+
+    @staticmethod
+    def from_checkpoint(checkpoint: Dict) -> 'NMT':
+        model = NMT(checkpoint['embed_size'], checkpoint['hidden_size'], checkpoint['vocab'],
+                    dropout_rate=checkpoint['dropout_rate'], pretrained_embeddings=False)
+        model.load_state_dict(checkpoint['state_dict'])
+        return model
 
     def save(self, path: str):
         """
         Save current model to file
         """
-        torch.save(self, path)
+        torch.save(self.checkpoint(), path)
 
 
 
@@ -418,23 +593,28 @@ def compute_corpus_level_bleu_score(references: List[List[str]], hypotheses: Lis
 
 
 def train(args: Dict[str, str]):
-    train_data_src = read_corpus(args['--train-src'], source='src')
-    train_data_tgt = read_corpus(args['--train-tgt'], source='tgt')
-
-    dev_data_src = read_corpus(args['--dev-src'], source='src')
-    dev_data_tgt = read_corpus(args['--dev-tgt'], source='tgt')
+    if args['--resume'] and not args['--save-state']:
+        raise RuntimeError('--resume needs --save-state, the path of the training state to resume from')
+    if not args['--save-to'] or not args['--save-opt']:
+        raise RuntimeError('--save-to and --save-opt are needed, the best model and its optimizer state are written '
+                           'there and read back by --resume')
+    vocab = pickle.load(open(args['--vocab'], 'rb'))
 
-    train_data = list(zip(train_data_src, train_data_tgt))
-    dev_data = list(zip(dev_data_src, dev_data_tgt))
+    # corpora binarized with binarize.py are memory-mapped, text files are converted on the fly
+    train_data = (load_corpus(args['--train-src'], 'src', vocab.src, args['--vocab']),
+                  load_corpus(args['--train-tgt'], 'tgt', vocab.tgt, args['--vocab']))
+    dev_data = (load_corpus(args['--dev-src'], 'src', vocab.src, args['--vocab']),
+                load_corpus(args['--dev-tgt'], 'tgt', vocab.tgt, args['--vocab']))
 
     train_batch_size = int(args['--batch-size'])
+    train_batch_tokens = int(args['--batch-tokens']) if args['--batch-tokens'] else None
     clip_grad = float(args['--clip-grad'])
     valid_niter = int(args['--valid-niter'])
     log_every = int(args['--log-every'])
     model_save_path = args['--save-to']
     optimizer_save_path = args['--save-opt']
-
-    vocab = pickle.load(open(args['--vocab'], 'rb'))
+    state_path = args['--save-state']
+    state_every = int(args['--state-every'])
 
     model = NMT(embed_size=int(args['--embed-size']),
                 hidden_size=int(args['--hidden-size']),
@@ -448,6 +628,12 @@ def train(args: Dict[str, str]):
     train_time = begin_time = time.time()
     print('begin Maximum Likelihood training')
 
+    # bucket the training data once, every epoch only shuffles the order of the batches
+    train_batches = bucket_batches(train_data[0].lengths, train_data[1].lengths, train_batch_size, train_batch_tokens)
+    print('%d training batches' % len(train_batches))
+    prefetcher = BatchPrefetcher(num_workers=int(args['--data-workers']), prefetch=int(args['--prefetch-batches']),
+                                 pin_memory=torch.cuda.is_available())
+
     # set the optimizers
     lr = float(args['--lr'])
     model_params = model.parameters()
@@ -455,19 +641,55 @@ def train(args: Dict[str, str]):
         print(type(param.data), param.size())
     optimizer = torch.optim.Adam(model.parameters(), lr=lr)
 
+    checkpoint_writer = CheckpointWriter()
+    # the best model and optimizer so far, the learning rate decay restores them from memory
+    best_state = BestState(half=args['--best-fp16'])
+    # the order of the training batches has its own RNG, so that an interrupted epoch can be replayed
+    data_rng = np.random.RandomState(np.random.randint(2 ** 31 - 1))
+    # the position in the interrupted epoch
+    resume_epoch_iter = 0
+    if args['--resume']:
+        print('resume training from [%s]' % state_path)
+        state = torch.load(state_path)
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        trainer = state['trainer']
+        # the epoch is counted again when it begins
+        epoch = trainer['epoch'] - 1
+        train_iter, patience, num_trial, valid_num, lr = \
+            trainer['train_iter'], trainer['patience'], trainer['num_trial'], trainer['valid_num'], trainer['lr']
+        hist_valid_scores = trainer['hist_valid_scores']
+        cum_loss, cumulative_tgt_words, cumulative_examples = \
+            trainer['cum_loss'], trainer['cumulative_tgt_words'], trainer['cumulative_examples']
+        resume_epoch_iter = trainer['epoch_iter']
+        # the best model so far is only on the disk after a restart, it is loaded before the RNGs are
+        # restored, since building the model draws its initial params
+        if os.path.exists(optimizer_save_path):
+            best_state.update(snapshot(model.load(model_save_path).state_dict()),
+                              snapshot(torch.load(optimizer_save_path)))
+        data_rng.set_state(state['data_rng'])
+        set_rng_state(state['rng'])
+
     while True:
         epoch += 1
-
-        for src_sents, tgt_sents in batch_iter(train_data, batch_size=train_batch_size, shuffle=True):
+        # the batch order of the epoch is drawn from this state, an interrupted epoch skips the batches done
+        epoch_rng = data_rng.get_state()
+        epoch_iter = resume_epoch_iter
+
+        for src_indices, src_lengths, tgt_indices, tgt_lengths in batch_iter(train_data, batch_size=train_batch_size,
+                                                                              shuffle=True, batches=train_batches,
+                                                                              prefetcher=prefetcher,
+                                                                              skip=resume_epoch_iter, rng=data_rng):
             train_iter += 1
-            batch_size = len(src_sents)
+            epoch_iter += 1
+            batch_size = len(src_lengths)
 
             if train_iter % 5 == 0:
                 print("#", end="", flush=True)
 
             # start training routine
             optimizer.zero_grad()
-            loss_v = model(src_sents, tgt_sents)
+            loss_v = model(src_indices, src_lengths, tgt_indices)
             loss = torch.sum(loss_v)
             loss.backward()
             torch.nn.utils.clip_grad_norm(model.parameters(), clip_grad)
@@ -476,7 +698,7 @@ def train(args: Dict[str, str]):
             report_loss += loss
             cum_loss += loss.detach()
 
-            tgt_words_num_to_predict = sum(len(s[1:]) for s in tgt_sents)  # omitting leading `<s>`
+            tgt_words_num_to_predict = int((tgt_lengths - 1).sum())  # omitting leading `<s>`
             report_tgt_words += tgt_words_num_to_predict
             cumulative_tgt_words += tgt_words_num_to_predict
             report_examples += batch_size
@@ -484,14 +706,17 @@ def train(args: Dict[str, str]):
 
             if train_iter % log_every == 0:
                 print('epoch %d, iter %d, avg. loss %.2f, avg. ppl %.2f ' \
-                      'cum. examples %d, speed %.2f words/sec, time elapsed %.2f sec' % (epoch, train_iter,
-                                                                                         report_loss / report_examples,
-                                                                                         math.exp(report_loss / report_tgt_words),
-                                                                                         cumulative_examples,
-                                                                                         report_tgt_words / (time.time() - train_time),
-                                                                                         time.time() - begin_time), flush=True)
+                      'cum. examples %d, speed %.2f words/sec, time elapsed %.2f sec, ' \
+                      'waiting for data %.2f%%' % (epoch, train_iter,
+                                                   report_loss / report_examples,
+                                                   math.exp(report_loss / report_tgt_words),
+                                                   cumulative_examples,
+                                                   report_tgt_words / (time.time() - train_time),
+                                                   time.time() - begin_time,
+                                                   100. * prefetcher.wait_time / (time.time() - train_time)), flush=True)
 
                 train_time = time.time()
+                prefetcher.wait_time = 0.
                 report_loss = report_tgt_words = report_examples = 0.
 
             # the following code performs validation on dev set, and controls the learning schedule
@@ -509,7 +734,7 @@ def train(args: Dict[str, str]):
                 cum_loss = cumulative_examples = cumulative_tgt_words = 0.
                 valid_num += 1
 
-                print('begin validation ... size %d %d' % (len(dev_data), len(dev_data_src)))
+                print('begin validation ... size %d' % len(dev_data[0]))
 
                 # set model to evaluate mode
                 model.eval()
@@ -536,8 +761,12 @@ def train(args: Dict[str, str]):
                 if is_better:
                     patience = 0
                     print('save currently the best model to [%s]' % model_save_path)
-                    model.save(model_save_path)
-                    torch.save(optimizer, optimizer_save_path)
+                    # one host copy of the states is kept for the patience reload and written in the background
+                    model_state = snapshot(model.state_dict())
+                    optimizer_state = snapshot(optimizer.state_dict())
+                    best_state.update(model_state, optimizer_state)
+                    checkpoint_writer.write_all([(model.checkpoint(model_state), model_save_path),
+                                                 (optimizer_state, optimizer_save_path)], copy=False)
 
                 elif patience < int(args['--patience']):
                     patience += 1
@@ -550,9 +779,8 @@ def train(args: Dict[str, str]):
                             print('early stop!')
                             exit(0)
 
-                        # load model
-                        model = model.load(model_save_path)
-                        optimizer = torch.load(optimizer_save_path)
+                        # load model, in place so that the optimizer keeps the parameters of the model
+                        best_state.restore(model, optimizer)
 
                         # decay learning rate, and restore from previously best checkpoint
                         lr = lr * float(args['--lr-decay'])
@@ -567,15 +795,36 @@ def train(args: Dict[str, str]):
                     print('reached maximum number of epochs!')
                     exit(0)
 
-
-def beam_search(model: NMT, test_data_src: List[List[str]], beam_size: int, max_decoding_time_step: int) \
-        -> List[List[Hypothesis]]:
-    hypotheses = []
-    for src_sent in tqdm(test_data_src, desc='Decoding', file=sys.stdout):
-        example_hyps = model.beam_search(src_sent, beam_size=beam_size,
-                                         max_decoding_time_step=max_decoding_time_step)
-
-        hypotheses.append(example_hyps)
+            if state_path and train_iter % state_every == 0:
+                checkpoint_writer.write({
+                    'model': model.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'rng': get_rng_state(),
+                    'data_rng': epoch_rng,
+                    'trainer': {'epoch': epoch, 'epoch_iter': epoch_iter, 'train_iter': train_iter,
+                                'patience': patience, 'num_trial': num_trial, 'valid_num': valid_num, 'lr': lr,
+                                'hist_valid_scores': hist_valid_scores, 'cum_loss': cum_loss,
+                                'cumulative_tgt_words': cumulative_tgt_words,
+                                'cumulative_examples': cumulative_examples}
+                }, state_path)
+
+        resume_epoch_iter = 0
+
+
+def beam_search(model: NMT, test_data_src: List[List[str]], beam_size: int, max_decoding_time_step: int,
+                batch_size: int=32) -> List[List[Hypothesis]]:
+    # decode sentences of similar length together to keep the padding in each batch small
+    order = sorted(range(len(test_data_src)), key=lambda i: len(test_data_src[i]), reverse=True)
+    hypotheses = [None] * len(test_data_src)
+    with tqdm(total=len(test_data_src), desc='Decoding', file=sys.stdout) as pbar:
+        for i in range(0, len(order), batch_size):
+            batch_indices = order[i: i + batch_size]
+            batch_hyps = model.beam_search_batch([test_data_src[idx] for idx in batch_indices],
+                                                 beam_size=beam_size,
+                                                 max_decoding_time_step=max_decoding_time_step)
+            for idx, example_hyps in zip(batch_indices, batch_hyps):
+                hypotheses[idx] = example_hyps
+            pbar.update(len(batch_indices))
 
     return hypotheses
 
@@ -600,7 +849,8 @@ def decode(args: Dict[str, str]):
 
     hypotheses = beam_search(model, test_data_src,
                              beam_size=int(args['--beam-size']),
-                             max_decoding_time_step=int(args['--max-decoding-time-step']))
+                             max_decoding_time_step=int(args['--max-decoding-time-step']),
+                             batch_size=int(args['--decode-batch-size']))
 
     if args['TEST_TARGET_FILE']:
         top_hypotheses = [hyps[0] for hyps in hypotheses]
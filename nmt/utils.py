@@ -1,8 +1,21 @@
+import bisect
+import copy
+import functools
+import hashlib
+import io
+import itertools
+import json
 import math
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import numpy as np
-import io
+import torch
+
 
 def input_transpose(sents, pad_token):
     """
@@ -32,51 +45,414 @@ def read_corpus(file_path, source):
     return data
 
 
-def batch_iter(data, batch_size, shuffle=True):
+class NumericCorpus(object):
+    """
+    A corpus of word indices: the indices of all the sentences in one flat int32 array, sentence i
+    is `ids[offsets[i]:offsets[i + 1]]`. Saved corpora are memory-mapped when loaded, so only the
+    batches that are actually read are paged in.
+    """
+
+    def __init__(self, ids, offsets):
+        self.ids = ids
+        self.offsets = offsets
+        self.lengths = np.diff(offsets)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        return self.ids[self.offsets[i]: self.offsets[i + 1]]
+
+    @staticmethod
+    def from_sents(sents_ids):
+        offsets = np.zeros(len(sents_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(sent) for sent in sents_ids])
+        ids = np.fromiter((w for sent in sents_ids for w in sent), dtype=np.int32, count=int(offsets[-1]))
+        return NumericCorpus(ids, offsets)
+
+    @staticmethod
+    def exists(prefix):
+        return os.path.exists(prefix + '.ids.npy') and os.path.exists(prefix + '.offsets.npy')
+
+    @staticmethod
+    def load(prefix, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        return NumericCorpus(np.load(prefix + '.ids.npy', mmap_mode=mmap_mode),
+                             np.load(prefix + '.offsets.npy'))
+
+    def save(self, prefix):
+        np.save(prefix + '.ids.npy', self.ids)
+        np.save(prefix + '.offsets.npy', self.offsets)
+
+    def pad_batch(self, indices, pad_id=0):
+        """
+        Gather the sentences at `indices` into a padded matrix
+
+        Returns:
+            padded: int64 array of shape (len(indices), max_sent_len)
+            lengths: int64 array of shape (len(indices), )
+        """
+        starts = self.offsets[indices]
+        lengths = self.offsets[np.asarray(indices) + 1] - starts
+        positions = np.arange(lengths.max())
+        mask = positions[None, :] < lengths[:, None]
+        padded = np.full(mask.shape, pad_id, dtype=np.int64)
+        padded[mask] = self.ids[(starts[:, None] + positions[None, :])[mask]]
+        return padded, lengths
+
+
+def file_hash(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def corpus_manifest(file_path, source, vocab_path):
+    """
+    The hashes of the text and vocab files a binarized corpus is made from
+    """
+    return {'text_hash': file_hash(file_path), 'vocab_hash': file_hash(vocab_path), 'source': source}
+
+
+def binarize_corpus(file_path, source, vocab_entry, vocab_path, output_prefix=None):
+    """
+    Convert a corpus to word indices and save it at `output_prefix`, next to the text file by default.
+    <output_prefix>.manifest.json records the hashes of the files it was made from.
+    """
+    output_prefix = output_prefix or file_path
+    corpus = NumericCorpus.from_sents(vocab_entry.words2indices(read_corpus(file_path, source)))
+    corpus.save(output_prefix)
+    with open(output_prefix + '.manifest.json', 'w') as f:
+        json.dump(corpus_manifest(file_path, source, vocab_path), f, indent=2, sort_keys=True)
+    return corpus
+
+
+def is_binarized(file_path, source, vocab_path):
+    """
+    Whether the corpus was binarized next to the text file from the current text and vocab files
+    """
+    manifest_path = file_path + '.manifest.json'
+    if not NumericCorpus.exists(file_path) or not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path) as f:
+        return json.load(f) == corpus_manifest(file_path, source, vocab_path)
+
+
+def load_corpus(file_path, source, vocab_entry, vocab_path):
+    """
+    Load a corpus as word indices. If the corpus was binarized next to the text file (see binarize.py)
+    the binary files are memory-mapped, a binarized corpus made from another text or vocab file is
+    binarized again. Otherwise the text file is read and converted in memory.
+    """
+    if is_binarized(file_path, source, vocab_path):
+        return NumericCorpus.load(file_path)
+    if NumericCorpus.exists(file_path):
+        print('%s was binarized from another text or vocab file, binarizing it again' % file_path)
+        binarize_corpus(file_path, source, vocab_entry, vocab_path)
+        return NumericCorpus.load(file_path)
+    return NumericCorpus.from_sents(vocab_entry.words2indices(read_corpus(file_path, source)))
+
+
+def bucket_batches(src_lengths, tgt_lengths, batch_size, batch_tokens=None):
     """
-    Given a list of examples, shuffle and slice them into mini-batches
+    Sort the examples by source and target length and cut the sorted order into batches of
+    examples with similar lengths. With `batch_tokens` a batch grows as long as neither its padded
+    source nor its padded target has more than `batch_tokens` tokens, otherwise every batch has
+    `batch_size` examples.
+
+    Returns:
+        batches: a list of index arrays, the examples in each batch sorted by decreasing source length
     """
-    batch_num = math.ceil(len(data) / batch_size)
-    index_array = list(range(len(data)))
+    src_lengths = np.asarray(src_lengths)
+    tgt_lengths = np.asarray(tgt_lengths)
+    # sort by decreasing source length, then by decreasing target length
+    order = np.lexsort((-tgt_lengths, -src_lengths))
+    if batch_tokens is None:
+        return [order[i: i + batch_size] for i in range(0, len(order), batch_size)]
+
+    batches = []
+    start = 0
+    max_tgt_len = 0
+    for i in range(len(order)):
+        max_tgt_len = max(max_tgt_len, tgt_lengths[order[i]])
+        # the first example of a batch has the longest source
+        if i > start and max(src_lengths[order[start]], max_tgt_len) * (i - start + 1) > batch_tokens:
+            batches.append(order[start:i])
+            start = i
+            max_tgt_len = tgt_lengths[order[i]]
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+
+def prepare_batch(data, indices):
+    """
+    Gather the examples at `indices` from a pair of source and target NumericCorpus into padded tensors
+    """
+    src_corpus, tgt_corpus = data
+    src_indices, src_lengths = src_corpus.pad_batch(indices)
+    tgt_indices, tgt_lengths = tgt_corpus.pad_batch(indices)
+
+    return torch.from_numpy(src_indices), torch.from_numpy(src_lengths), \
+        torch.from_numpy(tgt_indices), torch.from_numpy(tgt_lengths)
+
+
+class BatchPrefetcher(object):
+    """
+    Prepares batches in background worker threads, so that the training loop only picks up ready
+    (and optionally pinned) tensors. At most `prefetch` batches are prepared ahead of the consumer
+    and they are handed out in order. `wait_time` accumulates the seconds the consumer was blocked
+    waiting for a batch.
+    """
+
+    def __init__(self, num_workers=2, prefetch=8, pin_memory=False):
+        self.prefetch = max(prefetch, 1)
+        self.pin_memory = pin_memory
+        self.wait_time = 0.
+        self.executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
 
-    # sort the pairs w.r.t. the length of the src sent
-    data = sorted(data, key=lambda e: len(e[0]), reverse=True)
+    def _prepare(self, prepare_fn, task):
+        batch = prepare_fn(task)
+        if self.pin_memory:
+            # only the padded index matrices are copied to the device, the lengths stay on the host
+            batch = tuple(t.pin_memory() if torch.is_tensor(t) and t.dim() > 1 else t for t in batch)
+        return batch
 
-    batch_idx = list(range(batch_num))
+    def __call__(self, prepare_fn, tasks):
+        tasks = iter(tasks)
+        if self.executor is None:
+            for task in tasks:
+                start = time.time()
+                batch = self._prepare(prepare_fn, task)
+                self.wait_time += time.time() - start
+                yield batch
+            return
+
+        pending = deque(self.executor.submit(self._prepare, prepare_fn, task)
+                        for task in itertools.islice(tasks, self.prefetch))
+        while len(pending) > 0:
+            start = time.time()
+            batch = pending.popleft().result()
+            self.wait_time += time.time() - start
+            # keep the window full
+            for task in itertools.islice(tasks, 1):
+                pending.append(self.executor.submit(self._prepare, prepare_fn, task))
+            yield batch
+
+
+def batch_iter(data, batch_size, shuffle=True, batch_tokens=None, batches=None, prefetcher=None, skip=0, rng=None):
+    """
+    Given a pair of source and target NumericCorpus, shuffle and slice them into mini-batches.
+    The batches are bucketed by length, see `bucket_batches`; pass the precomputed `batches`
+    to reuse the buckets across epochs. With a `prefetcher` the batches are prepared in the
+    background. The order is shuffled with `rng` (the global numpy RNG by default), the first
+    `skip` batches are left out, which resumes an epoch when `rng` is in the state it had at the
+    beginning of the epoch.
+
+    Yields:
+        src_indices: LongTensor of shape (batch_size, max_src_len), sorted by decreasing source length
+        src_lengths: LongTensor of shape (batch_size, )
+        tgt_indices: LongTensor of shape (batch_size, max_tgt_len)
+        tgt_lengths: LongTensor of shape (batch_size, )
+    """
+    src_corpus, tgt_corpus = data
+    if batches is None:
+        batches = bucket_batches(src_corpus.lengths, tgt_corpus.lengths, batch_size, batch_tokens)
+
+    batch_idx = list(range(len(batches)))
     if shuffle:
-        np.random.shuffle(batch_idx)
-    for i in batch_idx:
-        indices = index_array[i * batch_size: (i + 1) * batch_size]
-        examples = [data[idx] for idx in indices]
+        (np.random if rng is None else rng).shuffle(batch_idx)
+    tasks = (batches[i] for i in batch_idx[skip:])
+    if prefetcher is None:
+        for indices in tasks:
+            yield prepare_batch(data, indices)
+    else:
+        yield from prefetcher(functools.partial(prepare_batch, data), tasks)
 
-        src_sents = [e[0] for e in examples]
-        tgt_sents = [e[1] for e in examples]
 
-        yield src_sents, tgt_sents
+def get_rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
 
-def load_matrix(fname, vocabs, emb_dim):
-    words = []
-    word2idx = {}
-    word2vec = {}
 
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(state, half=False):
+    """
+    Copies the tensors of a (nested) state, e.g. a state_dict, to the host. The copy can be written
+    while the training goes on updating the original tensors. With `half` the floating point tensors
+    are copied to fp16.
+    """
+    if torch.is_tensor(state):
+        dtype = torch.half if half and state.is_floating_point() else state.dtype
+        return state.detach().to('cpu', dtype=dtype, copy=True)
+    if isinstance(state, dict):
+        copied = type(state)((key, snapshot(value, half)) for key, value in state.items())
+        # the versions of the modules kept by state_dict
+        if hasattr(state, '_metadata'):
+            copied._metadata = state._metadata
+        return copied
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value, half) for value in state)
+    return state
+
+
+class BestState(object):
+    """
+    Host memory copies of the state_dicts of the best model and of its optimizer. The patience reload
+    restores them in place, so the optimizer stays bound to the parameters of the model. `update`
+    takes snapshots, which are kept as they are, except that with `half` the floating point tensors
+    of the model are kept in fp16.
+    """
+
+    def __init__(self, half=False):
+        self.half = half
+        self.model_state = None
+        self.optimizer_state = None
+
+    def update(self, model_state, optimizer_state):
+        self.model_state = snapshot(model_state, half=True) if self.half else model_state
+        self.optimizer_state = optimizer_state
+
+    def restore(self, model, optimizer):
+        # the params are copied into (and cast back to the dtype of) the tensors of the model, the
+        # optimizer may keep the given state tensors, so it gets a copy of them
+        model.load_state_dict(self.model_state)
+        optimizer.load_state_dict(copy.deepcopy(self.optimizer_state))
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints with torch.save in a background thread. `write` snapshots the state on the
+    calling thread, so the training only waits for the copy, unless the previous checkpoints are
+    still being written. A state that is already a snapshot is written with `copy=False`. A
+    checkpoint replaces the file only once it is completely written.
+    """
+
+    def __init__(self):
+        # the interpreter waits for the thread at exit, so a pending checkpoint is not lost
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def write(self, state, path, copy=True):
+        self.write_all([(state, path)], copy=copy)
+
+    def write_all(self, checkpoints, copy=True):
+        """
+        Writes the (state, path) pairs of `checkpoints` one after the other in one background job
+        """
+        self.wait()
+        if copy:
+            checkpoints = [(snapshot(state), path) for state, path in checkpoints]
+        self.pending = self.executor.submit(self._save_all, checkpoints)
+
+    @staticmethod
+    def _save_all(checkpoints):
+        for state, path in checkpoints:
+            tmp_path = path + '.tmp'
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+
+    def wait(self):
+        # re-raises the error of a failed write
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+
+def convert_vec_to_bin(fname, bin_prefix):
+    """
+    Convert a fastText `.vec` text file once into a binary store:
+        `<bin_prefix>.npy`: the float32 embedding matrix, in the row order of the text file
+        `<bin_prefix>.words`: the words sorted, one per line
+        `<bin_prefix>.rows.npy`: the matrix row of each of the sorted words
+        `<bin_prefix>.manifest.json`: the hash of the text file, written last
+    The matrix is meant to be memory-mapped, see `load_matrix`
+    """
     fin = io.open(fname, 'r', encoding='utf-8', newline='\n', errors='ignore')
     n, d = map(int, fin.readline().split())
-    data = {}
+    matrix = np.lib.format.open_memmap(bin_prefix + '.npy', mode='w+', dtype=np.float32, shape=(n, d))
+    words = []
     for line in fin:
         tokens = line.rstrip().split(' ')
-        word = tokens[0]
-        word2idx[word] = len(words)
-        words.append(word)
-        word2vec[word] = np.array(tokens[1:]).astype(np.float)
+        # skip broken lines
+        if len(tokens) != d + 1 or len(words) == n:
+            continue
+        matrix[len(words)] = np.array(tokens[1:], dtype=np.float32)
+        words.append(tokens[0])
+    fin.close()
+    matrix.flush()
+    del matrix
 
-    matrix_len = len(vocabs)
-    weights_matrix = np.zeros((matrix_len, emb_dim))
-    words_found = 0
+    # sort the words for the lookup, the last vector of a duplicated word wins
+    word_order = sorted(range(len(words)), key=lambda i: (words[i], -i))
+    sorted_words = []
+    rows = []
+    for i in word_order:
+        if len(sorted_words) == 0 or sorted_words[-1] != words[i]:
+            sorted_words.append(words[i])
+            rows.append(i)
+    with io.open(bin_prefix + '.words', 'w', encoding='utf-8', newline='\n') as fout:
+        fout.write('\n'.join(sorted_words))
+    np.save(bin_prefix + '.rows.npy', np.array(rows, dtype=np.int64))
+    with open(bin_prefix + '.manifest.json', 'w') as f:
+        json.dump({'text_hash': file_hash(fname)}, f)
 
+
+def is_converted(fname, bin_prefix):
+    """
+    Whether the binary store was converted from the current text file
+    """
+    manifest_path = bin_prefix + '.manifest.json'
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path) as f:
+        return json.load(f) == {'text_hash': file_hash(fname)}
+
+
+def load_matrix(fname, vocabs, emb_dim):
+    """
+    Build the embedding matrix of the vocab from the pretrained vectors in `fname`.
+    The text file is converted to a binary store next to it the first time and whenever its content
+    changes (see `convert_vec_to_bin`), otherwise only the rows of the words in the vocab are read
+    from the memory-mapped matrix.
+    Words without a pretrained vector are initialized randomly.
+    """
+    bin_prefix = fname
+    if not is_converted(fname, bin_prefix):
+        print('converting %s to binary, this is only done once' % fname)
+        convert_vec_to_bin(fname, bin_prefix)
+
+    matrix = np.load(bin_prefix + '.npy', mmap_mode='r')
+    rows = np.load(bin_prefix + '.rows.npy')
+    with io.open(bin_prefix + '.words', 'r', encoding='utf-8', newline='\n') as fin:
+        sorted_words = fin.read().split('\n')
+
+    # look up the matrix row of every word in the vocab
+    vocab_rows = []
+    found = []
+    missing = []
     for i, word in enumerate(vocabs):
-        try:
-            weights_matrix[i] = word2vec[word]
-            words_found += 1
-        except KeyError:
-            weights_matrix[i] = np.random.random(size=(emb_dim,))
+        pos = bisect.bisect_left(sorted_words, word)
+        if pos < len(sorted_words) and sorted_words[pos] == word:
+            found.append(i)
+            vocab_rows.append(rows[pos])
+        else:
+            missing.append(i)
+
+    weights_matrix = np.zeros((len(found) + len(missing), emb_dim))
+    if len(found) > 0:
+        weights_matrix[found] = matrix[np.array(vocab_rows)]
+    if len(missing) > 0:
+        weights_matrix[missing] = np.random.random(size=(len(missing), emb_dim))
     return weights_matrix